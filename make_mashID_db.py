@@ -3,6 +3,11 @@ import os
 import pathlib
 from multiprocessing import cpu_count
 import subprocess
+import json
+import gzip
+import hashlib
+from concurrent import futures
+from mashID_taxonomy import Taxonomy
 
 
 __author__ = 'duceppemo'
@@ -13,6 +18,7 @@ class MakeDB(object):
     accepted_extensions = ['.fna', '.fna.gz',
                            '.fa', '.fa.gz',
                            '.fasta', '.fasta.gz']
+    dereplicate_block_size = 1000  # Genomes compared to the whole database per mash dist
 
     def __init__(self, args):
         # Check input
@@ -22,6 +28,12 @@ class MakeDB(object):
         self.cpu = args.threads
         self.sketch_size = args.sketch_size
         self.kmer_size = args.kmer_size
+        self.shards = args.shards
+        self.tiered = args.tiered
+        self.cluster_rank = args.cluster_rank
+        self.incremental = args.incremental
+        self.dereplicate = args.dereplicate
+        self.taxid_map = args.taxid_map
 
         # Checks
         if self.cpu > cpu_count():
@@ -41,11 +53,44 @@ class MakeDB(object):
         if self.sketch_size < 1:
             raise Exception('At least one sketch per sample must be used.')
 
+        if self.shards < 1:
+            raise Exception('The database must have at least one shard.')
+
+        if self.dereplicate is not None and not 0 <= self.dereplicate < 1:
+            raise Exception('Dereplication distance must be between 0 and 1.')
+
         # Write a temporary file with all fasta
         fasta_list_file = self.output + '/sample_list.txt'
-        self.list_fasta(self.input, self.accepted_extensions, fasta_list_file)
+        fasta_list = self.list_fasta(self.input, self.accepted_extensions, fasta_list_file)
+
+        # Only sketch new or changed genomes. Dereplication needs the per-genome sketches too.
+        store = None
+        if self.incremental or self.dereplicate is not None:
+            store = SketchStore(self.output + '/sketch_store', self.kmer_size, self.sketch_size)
+            store.update(fasta_list, self.cpu)
+
+        # Keep one representative per cluster of similar genomes
+        db_list = fasta_list
+        if self.dereplicate is not None:
+            db_list = self.dereplicate_genomes(fasta_list, store, self.output, self.db_name(self.prefix),
+                                               self.dereplicate, self.cpu)
+
+        if self.tiered:
+            self.make_tiers(db_list, self.output, self.prefix, self.shards, self.cluster_rank, self.cpu,
+                            self.sketch_size, self.kmer_size, store)
+        elif self.shards == 1:
+            self.sketch_list(db_list, fasta_list_file, self.output, self.prefix, self.cpu, self.sketch_size,
+                             self.kmer_size, store)
+        else:
+            self.make_shards(db_list, self.output, self.prefix, self.shards, self.cpu, self.sketch_size,
+                             self.kmer_size, store)
 
-        self.run_mash_sketch(fasta_list_file, self.output, self.prefix, self.cpu, self.sketch_size, self.kmer_size)
+        # Accession and taxonomy of each reference, used by mashID.py to annotate the hits
+        self.write_taxonomy(db_list, self.output, self.db_name(self.prefix), self.cpu, self.taxid_map)
+
+        if store:
+            store.report(fasta_list, self.output, self.db_name(self.prefix))
+            store.clean(fasta_list)
 
     @staticmethod
     def list_fasta(input_folder, ext, list_file):
@@ -61,14 +106,253 @@ class MakeDB(object):
             raise Exception('No valid fasta files found in {}. Please make sure file ends with {}.'.format(
                 input_folder, ','.join(ext)))
 
+        MakeDB.write_list(input_list, list_file)
+
+        return input_list
+
+    @staticmethod
+    def write_list(input_list, list_file):
         with open(list_file, 'w') as f:
             for fasta_file in input_list:
                 f.write(fasta_file + '\n')
 
+    @staticmethod
+    def split_groups(groups, n):
+        # Balance the shards on total file size, largest groups first. A group is never split.
+        shards = [list() for _ in range(min(n, len(groups)))]
+        sizes = [0] * len(shards)
+        group_sizes = [sum(os.path.getsize(x) for x in group) for group in groups]
+        for size, group in sorted(zip(group_sizes, groups), key=lambda x: x[0], reverse=True):
+            i = sizes.index(min(sizes))
+            shards[i].extend(group)
+            sizes[i] += size
+        return shards
+
+    @staticmethod
+    def split_list(input_list, n):
+        return MakeDB.split_groups([[x] for x in input_list], n)
+
+    @staticmethod
+    def db_name(prefix):
+        return prefix[:-4] if prefix.endswith('.msh') else prefix
+
+    @staticmethod
+    def sketch_shards(shard_lists, output_folder, name, cpu, sketch_size, kmer_size, store=None):
+        def sketch_shard(i, shard_list, shard_cpu):
+            print('Sketching shard {}/{} ({} genomes)'.format(i, len(shard_lists), len(shard_list)))
+            shard_prefix = '{}_shard{}'.format(name, i)
+            shard_list_file = '{}/{}_list.txt'.format(output_folder, shard_prefix)
+            MakeDB.sketch_list(shard_list, shard_list_file, output_folder, shard_prefix, shard_cpu, sketch_size,
+                               kmer_size, store)
+            return shard_prefix + '.msh'
+
+        # Small shards (e.g. one per cluster) are sketched side by side
+        n_workers = max(1, min(len(shard_lists), cpu))
+        shard_cpu = max(1, int(cpu / n_workers))
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            args = ((i, shard_list, shard_cpu) for i, shard_list in enumerate(shard_lists, start=1))
+            return list(executor.map(lambda x: sketch_shard(*x), args))
+
+    @staticmethod
+    def write_manifest(manifest, output_folder, name):
+        # Manifest to use as database with mashID.py. Shard paths are relative to the manifest.
+        with open('{}/{}_shards.json'.format(output_folder, name), 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+    @staticmethod
+    def make_shards(input_list, output_folder, prefix, n, cpu, sketch_size, kmer_size, store=None):
+        name = MakeDB.db_name(prefix)
+        shard_files = MakeDB.sketch_shards(MakeDB.split_list(input_list, n), output_folder, name,
+                                           cpu, sketch_size, kmer_size, store)
+        manifest = {'kmer_size': kmer_size,
+                    'sketch_size': sketch_size,
+                    'shards': shard_files}
+        MakeDB.write_manifest(manifest, output_folder, name)
+
+    @staticmethod
+    def read_first_header(fasta_file):
+        with gzip.open(fasta_file, 'rt') if fasta_file.endswith('.gz') else open(fasta_file, 'r') as f:
+            for line in f:
+                if line.startswith('>'):
+                    return line[1:].strip()
+        return ''
+
+    @staticmethod
+    def read_taxid_map(taxid_map):
+        # Accession (or file name) and taxid, tab-separated
+        taxids = dict()
+        with open(taxid_map, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 2 and not line.startswith('#'):
+                    taxids[fields[0]] = fields[1]
+        return taxids
+
+    @staticmethod
+    def write_taxonomy(input_list, output_folder, name, cpu, taxid_map=None):
+        """
+        Write "<name>.tax.tsv": sketch ID (fasta path), accession, genus, species, subspecies and taxid of each
+        genome of the database, from its first fasta header.
+        """
+        taxids = MakeDB.read_taxid_map(taxid_map) if taxid_map else dict()
+        with futures.ThreadPoolExecutor(max_workers=cpu) as executor:
+            headers = executor.map(MakeDB.read_first_header, input_list)
+            rows = list()
+            for fasta_file, header in zip(input_list, headers):
+                accession = Taxonomy.accession(fasta_file)
+                row = Taxonomy.parse_header(header)
+                row.update({'ID': fasta_file,
+                            'Accession': accession,
+                            'Taxid': taxids.get(accession, taxids.get(os.path.basename(fasta_file), ''))})
+                rows.append(row)
+        Taxonomy.write('{}/{}.tax.tsv'.format(output_folder, name), rows)
+
+    @staticmethod
+    def cluster_name(header, rank):
+        # Same genus and species as the taxonomy table, e.g. "[Mycobacterium] species" is in Mycobacterium
+        taxonomy = Taxonomy.parse_header(header)
+        if not taxonomy['Genus'] or not taxonomy['Species']:
+            return 'unknown'
+        if rank == 'genus':
+            return taxonomy['Genus']
+        else:
+            return '{} {}'.format(taxonomy['Genus'], taxonomy['Species'])
+
+    @staticmethod
+    def make_tiers(input_list, output_folder, prefix, n, rank, cpu, sketch_size, kmer_size, store=None):
+        """
+        Two-tier database. Tier 1 has one representative (the largest assembly) per genus or species cluster
+        and tier 2 has all the genomes, in shards that never split a cluster. mashID.py screens tier 1 first and
+        then only the tier 2 shards of the best clusters.
+        """
+        name = MakeDB.db_name(prefix)
+
+        clusters = dict()
+        for fasta_file in input_list:
+            cluster = MakeDB.cluster_name(MakeDB.read_first_header(fasta_file), rank)
+            clusters.setdefault(cluster, list()).append(fasta_file)
+        print('Found {} {} clusters'.format(len(clusters), rank))
+
+        representatives = {cluster: max(genomes, key=os.path.getsize) for cluster, genomes in clusters.items()}
+        tier1_list_file = '{}/{}_tier1_list.txt'.format(output_folder, name)
+        print('Sketching tier 1 ({} representatives)'.format(len(representatives)))
+        MakeDB.sketch_list(list(representatives.values()), tier1_list_file, output_folder, name + '_tier1', cpu, sketch_size,
+                           kmer_size, store)
+
+        # One shard per cluster unless a number of shards is given
+        groups = list(clusters.values())
+        shard_lists = MakeDB.split_groups(groups, n if n > 1 else len(groups))
+        shard_files = MakeDB.sketch_shards(shard_lists, output_folder, name, cpu, sketch_size, kmer_size, store)
+
+        shard_index = {fasta_file: i for i, shard_list in enumerate(shard_lists) for fasta_file in shard_list}
+        manifest = {'kmer_size': kmer_size,
+                    'sketch_size': sketch_size,
+                    'shards': shard_files,
+                    'tier1': name + '_tier1.msh',
+                    'rank': rank,
+                    # Query-ID file name in tier 1: cluster
+                    'representatives': {os.path.basename(x): c for c, x in representatives.items()},
+                    'clusters': {cluster: shard_index[genomes[0]] for cluster, genomes in clusters.items()}}
+        MakeDB.write_manifest(manifest, output_folder, name)
+
     @staticmethod
     def make_folder(folder):
         pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
 
+    @staticmethod
+    def dist_block(reference, block_list_file, distance, cpu):
+        # Only pairs within the distance are reported, so the output stays small
+        cmd = ['mash', 'dist',
+               '-p', str(cpu),
+               '-d', str(distance),
+               reference,
+               '-l', block_list_file]
+        edges = list()
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) as p:
+            for line in p.stdout:
+                fields = line.split('\t')
+                if len(fields) >= 3 and fields[0] != fields[1] and float(fields[2]) <= distance:
+                    edges.append((fields[0], fields[1]))
+        if p.returncode != 0:
+            raise Exception('mash dist failed on {}'.format(block_list_file))
+        return edges
+
+    @staticmethod
+    def dereplicate_genomes(fasta_list, store, output_folder, name, distance, cpu):
+        """
+        Single-linkage clustering of the genomes within the mash distance, keeping the largest genome of each
+        cluster. The genomes are compared to all the others in blocks and only the close pairs are kept, so
+        memory grows with the number of genomes and close pairs, never with the full distance matrix.
+        """
+        print('Dereplicating {} genomes at distance {}'.format(len(fasta_list), distance))
+        reference = '{}/{}_all'.format(output_folder, name)
+        store.paste(fasta_list, reference + '_list.txt', output_folder, name + '_all')
+
+        blocks = [fasta_list[i:i + MakeDB.dereplicate_block_size]
+                  for i in range(0, len(fasta_list), MakeDB.dereplicate_block_size)]
+        block_lists = list()
+        for i, block in enumerate(blocks, start=1):
+            block_list_file = '{}_block{}.txt'.format(reference, i)
+            MakeDB.write_list([store.sketch_path(x) for x in block], block_list_file)
+            block_lists.append(block_list_file)
+
+        # Each mash dist loads the whole reference, so only a few blocks run at once
+        n_workers = max(1, min(len(blocks), int(cpu / 8)))
+        block_cpu = max(1, int(cpu / n_workers))
+
+        # Sequence names are the paths of the genomes (base names for databases sketched elsewhere)
+        index = {x: i for i, x in enumerate(fasta_list)}
+        index.update({os.path.basename(x): i for i, x in enumerate(fasta_list)})
+        parent = list(range(len(fasta_list)))
+        # Identical files are only once in the reference, so they are put in the same cluster here
+        first = dict()
+        for i, fasta_file in enumerate(fasta_list):
+            parent[i] = first.setdefault(store.hashes[fasta_file], i)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]  # Path halving
+                i = parent[i]
+            return i
+
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            args = ((reference + '.msh', x, distance, block_cpu) for x in block_lists)
+            for edges in executor.map(lambda x: MakeDB.dist_block(*x), args):
+                for seq1, seq2 in edges:
+                    i = index.get(seq1, index.get(os.path.basename(seq1)))
+                    j = index.get(seq2, index.get(os.path.basename(seq2)))
+                    if i is not None and j is not None:
+                        parent[find(i)] = find(j)
+
+        clusters = dict()
+        for i, fasta_file in enumerate(fasta_list):
+            clusters.setdefault(find(i), list()).append(fasta_file)
+        representatives = dict()
+        for genomes in clusters.values():
+            representative = max(genomes, key=os.path.getsize)  # Largest assembly
+            for fasta_file in genomes:
+                representatives[fasta_file] = representative
+
+        with open('{}/{}_clusters.tsv'.format(output_folder, name), 'w') as f:
+            f.write('Genome\tRepresentative\n')
+            for fasta_file in fasta_list:
+                f.write('{}\t{}\n'.format(fasta_file, representatives[fasta_file]))
+
+        for tmp_file in block_lists + [reference + '.msh', reference + '_list.txt']:
+            os.remove(tmp_file)
+
+        db_list = [x for x in fasta_list if representatives[x] == x]
+        print('Kept {} representatives out of {} genomes'.format(len(db_list), len(fasta_list)))
+        return db_list
+
+    @staticmethod
+    def sketch_list(input_list, list_file, output_folder, prefix, cpu, sketch_size, kmer_size, store=None):
+        if store:
+            store.paste(input_list, list_file, output_folder, prefix)
+        else:
+            MakeDB.write_list(input_list, list_file)
+            MakeDB.run_mash_sketch(list_file, output_folder, prefix, cpu, sketch_size, kmer_size)
+
     @staticmethod
     def run_mash_sketch(input_list, output_folder, prefix, cpu, sketch_size, kmer_size):
         cmd = ['mash', 'sketch',
@@ -79,6 +363,146 @@ class MakeDB(object):
                '-k', str(kmer_size)]
         subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
 
+    @staticmethod
+    def run_mash_sketch_file(fasta_file, output_prefix, sketch_size, kmer_size):
+        cmd = ['mash', 'sketch',
+               '-p', '1',
+               '-o', output_prefix,
+               '-s', str(sketch_size),
+               '-k', str(kmer_size),
+               fasta_file]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True)
+
+
+class SketchStore(object):
+    """
+    Store of one sketch per genome, keyed on the genome file hash, its path and the k-mer and sketch sizes.
+    Databases are pasted from the stored sketches, so only new, changed or moved genomes are sketched when a
+    database is rebuilt. The path is part of the key because it is the ID of the sketch (see write_taxonomy).
+    """
+    def __init__(self, folder, kmer_size, sketch_size):
+        self.folder = folder
+        self.kmer_size = kmer_size
+        self.sketch_size = sketch_size
+        self.index_file = folder + '/store.json'
+        self.hashes = dict()  # fasta path: content hash
+
+        MakeDB.make_folder(self.folder)
+        # Hashes of the previous builds, to avoid hashing files that did not change
+        self.index = dict()
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+
+    @staticmethod
+    def hash_file(fasta_file):
+        h = hashlib.blake2b(digest_size=16)
+        with open(fasta_file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def file_hash(self, fasta_file):
+        stat = os.stat(fasta_file)
+        known = self.index.get(fasta_file)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['hash']
+        return SketchStore.hash_file(fasta_file)
+
+    def sketch_path(self, fasta_file):
+        path_hash = hashlib.blake2b(fasta_file.encode(), digest_size=8).hexdigest()
+        return '{}/{}_{}_k{}_s{}.msh'.format(self.folder, self.hashes[fasta_file], path_hash, self.kmer_size,
+                                             self.sketch_size)
+
+    def unique(self, fasta_list):
+        # First genome of each content, identical files at other paths would be duplicate references
+        seen = set()
+        unique = list()
+        for fasta_file in fasta_list:
+            if self.hashes[fasta_file] not in seen:
+                seen.add(self.hashes[fasta_file])
+                unique.append(fasta_file)
+        return unique
+
+    def update(self, fasta_list, cpu):
+        with futures.ThreadPoolExecutor(max_workers=cpu) as executor:
+            for fasta_file, file_hash in zip(fasta_list, executor.map(self.file_hash, fasta_list)):
+                self.hashes[fasta_file] = file_hash
+
+        missing = [x for x in fasta_list if not os.path.exists(self.sketch_path(x))]
+        print('Sketching {} new or changed genomes ({} already sketched)'.format(
+            len(missing), len(fasta_list) - len(missing)))
+
+        def sketch(fasta_file):
+            # Write to a temporary name so an interrupted build never leaves a partial sketch in the store
+            sketch_file = self.sketch_path(fasta_file)
+            tmp_prefix = sketch_file[:-4] + '.tmp'
+            MakeDB.run_mash_sketch_file(fasta_file, tmp_prefix, self.sketch_size, self.kmer_size)
+            os.replace(tmp_prefix + '.msh', sketch_file)
+
+        with futures.ThreadPoolExecutor(max_workers=cpu) as executor:
+            list(executor.map(sketch, missing))
+
+        index = dict(self.index)
+        for fasta_file in fasta_list:
+            stat = os.stat(fasta_file)
+            index[fasta_file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': self.hashes[fasta_file]}
+        self.index = {x: index[x] for x in fasta_list}  # Forget removed genomes
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def paste(self, fasta_list, list_file, output_folder, prefix):
+        unique = self.unique(fasta_list)
+        if len(unique) < len(fasta_list):
+            print('Skipping {} duplicate genomes (same file content as another genome)'.format(
+                len(fasta_list) - len(unique)))
+        MakeDB.write_list([self.sketch_path(x) for x in unique], list_file)
+        output_file = '{}/{}.msh'.format(output_folder, MakeDB.db_name(prefix))
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        cmd = ['mash', 'paste',
+               output_file[:-4],
+               '-l', list_file]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True)
+
+    def report(self, fasta_list, output_folder, name):
+        # Compare with the genomes of the previous build of this database
+        state_file = '{}/{}_genomes.json'.format(output_folder, name)
+        previous = dict()
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                previous = json.load(f)
+        current = {x: self.hashes[x] for x in fasta_list}
+
+        changes = list()
+        for fasta_file in sorted(set(previous) | set(current)):
+            if fasta_file not in previous:
+                changes.append(('added', fasta_file))
+            elif fasta_file not in current:
+                changes.append(('removed', fasta_file))
+            elif previous[fasta_file] != current[fasta_file]:
+                changes.append(('changed', fasta_file))
+
+        with open('{}/{}_changes.tsv'.format(output_folder, name), 'w') as f:
+            f.write('Status\tGenome\n')
+            for status, fasta_file in changes:
+                f.write('{}\t{}\n'.format(status, fasta_file))
+        with open(state_file, 'w') as f:
+            json.dump(current, f)
+
+        counts = {x: sum(1 for y in changes if y[0] == x) for x in ['added', 'changed', 'removed']}
+        print('{} genomes added, {} changed, {} removed, {} unchanged'.format(
+            counts['added'], counts['changed'], counts['removed'], len(current) - counts['added'] - counts['changed']))
+
+    def clean(self, fasta_list):
+        # Drop the sketches of removed or changed genomes
+        keep = {os.path.basename(self.sketch_path(x)) for x in fasta_list}
+        suffix = '_k{}_s{}.msh'.format(self.kmer_size, self.sketch_size)
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(suffix) and entry.name not in keep:
+                os.remove(entry.path)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Create a mash database.')
@@ -100,6 +524,35 @@ if __name__ == "__main__":
     parser.add_argument('-k', '--kmer-size', metavar='21',
                         help='Hashes will be based on strings of this many nucleotides (1-32) . Default is 21.',
                         type=int, required=False, default=21)
+    parser.add_argument('--shards', metavar='1',
+                        help='Split the database in this many shards of similar size, screened in parallel by '
+                             'mashID.py. A "<prefix>_shards.json" manifest is written to use as database. '
+                             'Default is 1 (no sharding).',
+                        type=int, required=False, default=1)
+    parser.add_argument('--tiered', action='store_true',
+                        help='Also build a small tier 1 database with one representative genome per cluster '
+                             '(see --cluster-rank). Genomes of a cluster are kept in the same shard and mashID.py '
+                             'only screens the shards of the best tier 1 clusters. Without --shards, each cluster '
+                             'gets its own shard.',
+                        required=False)
+    parser.add_argument('--cluster-rank', choices=['genus', 'species'],
+                        help='Taxonomic rank used to cluster genomes for --tiered, from the first fasta header. '
+                             'Default is "species".',
+                        type=str, required=False, default='species')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep one sketch per genome in "<output>/sketch_store" and only sketch new or changed '
+                             'genomes. Removed genomes are dropped and the changes since the last build are '
+                             'written to "<prefix>_changes.tsv".',
+                        required=False)
+    parser.add_argument('--dereplicate', metavar='0.001',
+                        help='Cluster genomes within this mash distance (single linkage) and only keep the largest '
+                             'genome of each cluster in the database. Clusters are written to '
+                             '"<prefix>_clusters.tsv". Optional.',
+                        type=float, required=False)
+    parser.add_argument('--taxid-map', metavar='/path/to/taxids.tsv',
+                        help='Tab-separated accession (file name without its last extension, or file name) and '
+                             'NCBI taxid of the genomes, added to the taxonomy table "<prefix>.tax.tsv". Optional.',
+                        type=str, required=False)
     parser.add_argument('-v', '--version', action='version',
                         version=f'{os.path.basename(__file__)}: version {__version__}')
 
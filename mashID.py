@@ -1,8 +1,13 @@
 import os
 from argparse import ArgumentParser
 from mashID_methods import Methods
+from mashID_cache import ResultCache
+from mashID_watch import RunWatcher
+from mashID_distributed import DistributedRun
+from mashID_metrics import RunMetrics
+from mashID_discovery import FileDiscovery
+from mashID_dataset import HitDataset
 import pkg_resources
-import shutil
 from multiprocessing import cpu_count
 from psutil import virtual_memory
 
@@ -28,11 +33,45 @@ class Identification(object):
         else:  # use the default Mycobacteria DB
             self.mash_db = pkg_resources.resource_filename('dependencies', 'mycobacteria_mash_sketches.msh')
 
+        # Saved layout of the input folder (see FileDiscovery)
+        self.layout_file = None if args.rescan else os.path.join(self.output_folder, 'mashID_layout.json')
+
+        # Cache
+        self.cache = None
+        if args.cache:
+            self.cache = ResultCache(os.path.abspath(args.cache), args.cache_size)
+
         # Filter
         self.identity = args.identity
         self.p_value = args.p_value
         self.n_hits = args.n_hits
         self.sort_by = args.sort_by
+        self.early_stop = args.early_stop
+        self.max_bp = args.max_bp
+        if args.max_depth:
+            depth_bp = int(args.max_depth * args.genome_size)
+            self.max_bp = min(self.max_bp, depth_bp) if self.max_bp else depth_bp
+
+        # Backend
+        Methods.backend = args.backend
+        Methods.by_species = args.by_species
+
+        # Watch
+        self.watch = args.watch
+        self.watch_interval = args.watch_interval
+        self.watch_settle = args.watch_settle
+        self.watch_idle = args.watch_idle
+
+        # Distributed
+        self.distributed = args.distributed
+        self.lease_time = args.lease_time
+
+        # Dataset
+        self.dataset = os.path.abspath(args.dataset) if args.dataset else None
+        self.dataset_format = args.dataset_format
+
+        # Metrics
+        self.metrics = os.path.abspath(args.metrics) if args.metrics else None
 
         # Data
         self.sample_dict = dict()
@@ -42,44 +81,91 @@ class Identification(object):
 
     def run(self):
         # Checks
-        Methods.check_cpus(self.cpu, self.parallel)
-        Methods.check_mem(self.mem)
+        self.cpu, self.parallel = Methods.check_cpus(self.cpu, self.parallel)
+        self.mem = Methods.check_mem(self.mem)
         Methods.check_identity_range(self.identity)
         Methods.check_p_value(self.p_value)
+        if self.dataset:
+            HitDataset.check()
         # Methods.check_input(self.input)
 
         # Create output folders
         Methods.make_folder(self.output_folder)
 
-        # Get input files and place info in dictionary
-        print('Gathering fastq files...')
-        self.sample_dict = Methods.get_files(self.input)
+        if self.metrics:
+            RunMetrics.start(self.metrics, self.cpu, self.parallel)
+        try:
+            self.identify()
+        finally:
+            if self.metrics:
+                RunMetrics.active.close()
+
+    def identify(self):
+        if self.watch:
+            # Screen the new files of a live sequencing run as they are written
+            hit_tables = dict()
+            samples_df = RunWatcher(self.input, self.output_folder, self.mash_db, self.identity, self.p_value,
+                                    self.cpu, self.parallel, self.n_hits, self.sort_by, self.watch_interval,
+                                    self.watch_settle, idle=self.watch_idle, mem=self.mem, cache=self.cache,
+                                    max_bp=self.max_bp).run(tables=hit_tables)
+            if samples_df is not None:
+                print('\nIdentification results:\n')
+                print(samples_df.to_string(index=False, justify='left'))
+                self.write_dataset(samples_df, hit_tables)
+            return
 
-        # Merge paired-end fastq files is present and update sample dict
-        tmp_folder = self.output_folder + '/tmp'
-        Methods.make_folder(tmp_folder)
-        self.sample_dict = Methods.merge_fastq_pair(self.sample_dict, tmp_folder)
+        if self.distributed:
+            # Share the samples with the other workers using the same input and output folders
+            hit_tables = dict()
+            samples_df = DistributedRun(self.input, self.output_folder, self.mash_db, self.identity, self.p_value,
+                                        self.cpu, self.mem, self.parallel, self.n_hits, self.sort_by, self.cache,
+                                        self.early_stop, self.max_bp, self.lease_time).run(tables=hit_tables)
+            print('\nIdentification results:\n')
+            print(samples_df.to_string(index=False, justify='left'))
+            self.write_dataset(samples_df, hit_tables)  # Same run file from all the workers
+            return
 
-        # Get file stats (number of reads/contigs and bp)
-        print('Getting input file(s) stats...')
-        Methods.get_stats_parallel(self.sample_dict, self.mem, self.cpu, self.parallel)
+        # Get input files and place info in dictionary
+        print('Gathering fastq files...')
+        with RunMetrics.stage(None, 'discovery'):
+            self.sample_dict = Methods.get_files(self.input, self.layout_file)
+        if os.path.isdir(self.input):
+            # Files found for each sample, can be edited and given back as input (-i)
+            FileDiscovery.write_samplesheet(os.path.join(self.output_folder, 'samples.tsv'),
+                                            {x: y['path'] for x, y in self.sample_dict.items()})
 
-        # Screen samples and create summary report
-        print('Identifying samples...')
+        # Get file stats (number of reads/contigs and bp), screen samples and create summary report
+        print('Getting input file(s) stats and identifying samples...')
+        hit_tables = dict()  # Hits of each sample, for the dataset
         samples_df = Methods.mash_screen_parallel(self.mash_db, self.output_folder, self.sample_dict,
-                                                  self.identity, self.p_value, self.cpu, self.parallel, self.n_hits, self.sort_by)
+                                                  self.identity, self.p_value, self.cpu, self.mem, self.parallel,
+                                                  self.n_hits, self.sort_by, self.cache, self.early_stop,
+                                                  self.max_bp, tables=hit_tables)
 
         # Print summary report to terminal
         print('\nIdentification results:\n')
         print(samples_df.to_string(index=False, justify='left'))
 
-        # Write output file
+        # Write output file, sorted by sample (rows were appended in completion order during the run)
         # if len(self.sample_dict) > 1:
         output_tsv = self.output_folder + '/topID.tsv'
-        samples_df.to_csv(output_tsv, sep="\t", index=False)
+        samples_df.to_csv(output_tsv + '.tmp', sep="\t", index=False)
+        os.replace(output_tsv + '.tmp', output_tsv)
+        self.write_dataset(samples_df, hit_tables)
 
-        # Delete tmp folder (needed to merged paired-end fastq files, if present)
-        shutil.rmtree(tmp_folder)
+    def write_dataset(self, samples_df, hit_tables):
+        if not self.dataset:
+            return
+        params = {'version': __version__,
+                  'min_identity': self.identity,
+                  'max_p_value': self.p_value,
+                  'n_hits': self.n_hits,
+                  'sort_by': self.sort_by,
+                  'early_stop': self.early_stop,
+                  'max_bp': self.max_bp,
+                  'backend': Methods.backend}
+        HitDataset.write_run(self.dataset, self.output_folder, samples_df, hit_tables, self.mash_db, params,
+                             self.dataset_format)
 
 
 if __name__ == "__main__":
@@ -88,13 +174,16 @@ if __name__ == "__main__":
 
     parser = ArgumentParser(description='Species identification from NGS data using Mash.')
     parser.add_argument('-i', '--input', metavar='/input/folder/',
-                        help='Input directory with fastq/fasta files or a single fastq/fasta file, gzipped or not.',
+                        help='Input directory with fastq/fasta files or a single fastq/fasta file, gzipped or not. '
+                             'Can also be a sample sheet (.tsv), with the sample name and its file(s) on each line '
+                             '(tab-separated).',
                         type=str, required=True)
     parser.add_argument('-o', '--output', metavar='/output/folder/',
                         help='Output directory',
                         type=str, required=True)
     parser.add_argument('-d', '--database', metavar='/path/to/mash_databse.msh',
-                        help='Mash sketch database. Will run a Mycobacteria mash database by default.',
+                        help='Mash sketch database, or the "_shards.json" manifest of a sharded database made with '
+                             'make_mashID_db.py. Will run a Mycobacteria mash database by default.',
                         type=str, required=False)
     parser.add_argument('--identity', metavar='0.9',
                         help='Minimum identity to report. [0-1]. Default is 0.9',
@@ -110,6 +199,83 @@ if __name__ == "__main__":
                         required=False,
                         type=str,
                         help='How to sort the result tables. Will impact the "Top hit" table. Default is "similarity". Optional.')
+    parser.add_argument('--rescan', action='store_true',
+                        help='List the input folder again instead of reusing the files found by a previous run with '
+                             'the same output folder ("mashID_layout.json"). The saved layout is only reused when '
+                             'no folder changed since. Optional.')
+    parser.add_argument('--by-species', action='store_true',
+                        help='Also write the top hits of each sample per species ("_mashID_species.tsv"), using the '
+                             'taxonomy table written by make_mashID_db.py next to the database. Optional.')
+    parser.add_argument('--early-stop', metavar='10000',
+                        required=False,
+                        type=int, const=10000, nargs='?',
+                        help='For large long read samples. Screen the first 10000 reads (or the given number), then '
+                             'twice as many at each round, and stop as soon as the top hit is stable. The number of '
+                             'reads and bp screened is added to the summary. Optional.')
+    parser.add_argument('--max-bp', metavar='500000000',
+                        required=False,
+                        type=int,
+                        help='Subsample the reads of samples larger than this many bp before screening them. Reads '
+                             'are streamed to mash, nothing is written to disk. Optional.')
+    parser.add_argument('--max-depth', metavar='50',
+                        required=False,
+                        type=float,
+                        help='Same as --max-bp, as a depth of coverage of --genome-size. Optional.')
+    parser.add_argument('--genome-size', metavar='5000000',
+                        required=False,
+                        type=int, default=5000000,
+                        help='Expected genome size in bp, for --max-depth. Default is 5000000. Optional.')
+    parser.add_argument('--backend', choices=['mash', 'native'],
+                        default='mash',
+                        required=False,
+                        type=str,
+                        help='Screen with mash, or in-process with the NumPy engine of mashID_msh.py, which keeps '
+                             'the database loaded between samples. Default is "mash". Optional.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Watch the input folder of a sequencing run that is going (e.g. MinKNOW output) and '
+                             'screen the new files as they are written. Results are updated after each round and a '
+                             'sample is marked as resolved once its top hit is stable (or once --max-bp were '
+                             'screened), after which its new files are only counted. Stops when the run is over '
+                             '("final_summary" file), after --watch-idle or with Ctrl-C. Can not be used with '
+                             '--early-stop. Optional.')
+    parser.add_argument('--watch-interval', metavar='30',
+                        required=False,
+                        type=float, default=30,
+                        help='Seconds between two scans of the input folder in watch mode. Default is 30. Optional.')
+    parser.add_argument('--watch-settle', metavar='10',
+                        required=False,
+                        type=float, default=10,
+                        help='Seconds a file must stay unchanged before it is screened in watch mode. Default is 10. '
+                             'Optional.')
+    parser.add_argument('--watch-idle', metavar='3600',
+                        required=False,
+                        type=float,
+                        help='Stop watching after that many seconds without new files. Optional.')
+    parser.add_argument('--distributed', action='store_true',
+                        help='Work with the other mashID.py workers (e.g. on other nodes) started with the same '
+                             'input and output folders. Samples are claimed through lease files in the output '
+                             'folder and "topID.tsv" is made from all the results at the end. Optional.')
+    parser.add_argument('--lease-time', metavar='600',
+                        required=False,
+                        type=float, default=600,
+                        help='Seconds after which the samples claimed by a worker that stopped responding are '
+                             'taken over by the others, in distributed mode. Default is 600. Optional.')
+    parser.add_argument('--dataset', metavar='/path/to/dataset/',
+                        help='Also add the hits of all the samples, with their stats, the run parameters and the '
+                             'database digest, to this columnar dataset shared by many runs (one file per run, '
+                             'needs pyarrow). Query it with mashID_dataset.py. Optional.',
+                        type=str, required=False)
+    parser.add_argument('--dataset-format', choices=['parquet', 'feather'],
+                        default='parquet',
+                        required=False,
+                        type=str,
+                        help='File format of the run in --dataset. Default is "parquet". Optional.')
+    parser.add_argument('--metrics', metavar='/path/to/metrics.jsonl',
+                        required=False,
+                        type=str,
+                        help='Write the wall time, CPU time, queue wait, peak memory of the child processes (mash, '
+                             'pigz) and bytes read of each stage of each sample as JSON lines, followed by a summary '
+                             'of the run. Optional.')
     parser.add_argument('-t', '--threads', metavar=str(max_cpu),
                         required=False,
                         type=int, default=max_cpu,
@@ -117,13 +283,27 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--parallel', metavar='2',
                         required=False,
                         type=int, default=2,
-                        help='Number of samples to process in parallel. Default is 2. Optional.')
+                        help='Typical number of samples to process in parallel. Threads are shared according to sample '
+                             'size, so more small samples may run at once. Default is 2. Optional.')
     parser.add_argument('-m', '--memory', metavar=str(max_mem),
                         required=False,
                         type=int, default=max_mem,
                         help='Memory in GB. Default is 85%% of total memory ({})'.format(max_mem))
+    parser.add_argument('--cache', metavar='/cache/folder/',
+                        required=False,
+                        type=str,
+                        help='Folder to cache the mash screen results and file stats. Samples that were already '
+                             'screened with the same database and parameters are not screened again. Optional.')
+    parser.add_argument('--cache-size', metavar='10',
+                        required=False,
+                        type=float, default=10,
+                        help='Maximum size of the cache in GB. Least recently used results are removed first. '
+                             'Default is 10. Optional.')
     parser.add_argument('-v', '--version', action='version',
                         version=f'{os.path.basename(__file__)}: version {__version__}')
 
     arguments = parser.parse_args()
+    if arguments.watch and arguments.early_stop is not None:
+        # A sample being watched is already screened until its top hit is stable, chunk by chunk
+        parser.error('--early-stop can not be used with --watch.')
     Identification(arguments)
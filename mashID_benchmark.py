@@ -0,0 +1,311 @@
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+import numpy as np
+from psutil import virtual_memory
+from mashID_methods import Methods
+from mashID_msh import KmerHasher, MshWriter
+
+
+__author__ = 'duceppemo'
+__version__ = '0.1.1'
+
+
+# Stand-in for mash: waits "latency" seconds, reads the whole input like mash would and reports hits on the
+# references listed next to the database
+MASH_STAND_IN = '''#!{python}
+import os, sys, time, zlib
+args = sys.argv[1:]
+if args[0] != 'screen':
+    sys.exit('Only "mash screen" is simulated')
+positional = list()
+i = 1
+while i < len(args):
+    if args[i] in ('-i', '-v', '-p'):
+        i += 2
+        continue
+    if args[i] != '-w':
+        positional.append(args[i])
+    i += 1
+db_file, queries = positional[0], positional[1:]
+time.sleep(float(os.environ.get('MASHID_BENCH_LATENCY', '0')))
+checksum = 0
+for query in queries:
+    handle = sys.stdin.buffer if query == '-' else open(query, 'rb')
+    while True:
+        chunk = handle.read(1 << 20)
+        if not chunk:
+            break
+        checksum = zlib.crc32(chunk, checksum)
+with open(db_file + '.refs.tsv') as f:
+    for n, line in enumerate(f):
+        name, comment = line.rstrip('\\n').split('\\t')
+        shared = 900 + (checksum + n * 7919) % 100
+        print('{{:g}}\\t{{}}/1000\\t{{}}\\t0\\t{{}}\\t{{}}'.format((shared / 1000) ** (1 / 21), shared,
+                                                           1 + (checksum + n) % 50, name, comment))
+'''
+
+
+class Benchmark(object):
+    """
+    Reproducible throughput benchmark of the mashID pipeline on synthetic data, offline. Samples of several
+    layouts (fastq, fastq.gz, fasta and paired fastq.gz) are made from random genomes, with a small sketch
+    database of the same genomes and a stand-in "mash" with a configurable latency. File discovery, stats,
+    screening (full pipeline) and the summary are timed for each number of samples.
+    """
+    kmer_size = 21
+    sketch_size = 1000
+    genome_size = 50000
+    n_genomes = 20
+    read_length = 150
+    layouts = ['fastq', 'fastq.gz', 'fasta', 'paired']
+
+    def __init__(self, work_folder, sizes, reads, latency, cpu, parallel, backend, seed=42):
+        self.work_folder = work_folder
+        self.sizes = sorted(sizes)
+        self.reads = reads
+        self.latency = latency
+        self.cpu = cpu
+        self.parallel = parallel
+        self.backend = backend
+        self.random = random.Random(seed)
+
+        self.template_folder = os.path.join(work_folder, 'templates')
+        self.bin_folder = os.path.join(work_folder, 'bin')
+        self.mash_db = os.path.join(work_folder, 'db', 'benchmark.msh')
+
+    @staticmethod
+    def write_msh(path, kmer_size, references):
+        """
+        Write a mash sketch file from (name, comment, length, hashes), see MshWriter.
+        """
+        MshWriter.write(path, kmer_size, references)
+
+    def make_genomes(self):
+        return [bytes(self.random.choice(b'ACGT') for _ in range(Benchmark.genome_size))
+                for _ in range(Benchmark.n_genomes)]
+
+    def make_database(self, genomes):
+        Methods.make_folder(os.path.dirname(self.mash_db))
+        meta = {'kmer_size': Benchmark.kmer_size, 'preserve_case': False, 'alphabet': 'ACGT',
+                'noncanonical': False, 'hash_seed': 42, 'use64': True}
+        references = list()
+        for i, genome in enumerate(genomes):
+            name = 'NZ_BENCH{:04d}.1.fna'.format(i)
+            comment = '[1 seqs] NZ_BENCH{:04d}.1 Mycobacterium species{} strain bench'.format(i, i)
+            hashes = np.unique(KmerHasher.kmer_hashes([genome], meta))[:Benchmark.sketch_size]
+            references.append((name, comment, len(genome), hashes))
+        Benchmark.write_msh(self.mash_db, Benchmark.kmer_size, references)
+        with open(self.mash_db + '.refs.tsv', 'w') as f:
+            for name, comment, _, _ in references:
+                f.write('{}\t{}\n'.format(name, comment))
+
+    def make_stand_in(self):
+        Methods.make_folder(self.bin_folder)
+        mash = os.path.join(self.bin_folder, 'mash')
+        with open(mash, 'w') as f:
+            f.write(MASH_STAND_IN.format(python=sys.executable))
+        os.chmod(mash, 0o755)
+
+    def reads_of(self, genome, n):
+        for _ in range(n):
+            start = self.random.randrange(0, len(genome) - Benchmark.read_length)
+            yield genome[start:start + Benchmark.read_length].decode()
+
+    def make_templates(self, genomes):
+        """
+        One sample of each layout per genome. Benchmark samples are links to these files.
+        """
+        Methods.make_folder(self.template_folder)
+        templates = list()
+        for i, genome in enumerate(genomes):
+            for layout in Benchmark.layouts:
+                base = os.path.join(self.template_folder, 'T{}{}'.format(i, layout.replace('.', '')))
+                if layout == 'fasta':
+                    paths = [base + '.fasta']
+                    with open(paths[0], 'w') as f:
+                        for j, read in enumerate(self.reads_of(genome, self.reads)):
+                            f.write('>r{}\n{}\n'.format(j, read))
+                    templates.append([(paths[0], '.fasta')])
+                    continue
+                if layout == 'paired':
+                    files = [(base + '_R1.fastq.gz', '_R1.fastq.gz'), (base + '_R2.fastq.gz', '_R2.fastq.gz')]
+                else:
+                    files = [(base + '.' + layout, '.' + layout)]
+                for path, _ in files:
+                    lines = ''.join('@r{}\n{}\n+\n{}\n'.format(j, read, 'I' * len(read))
+                                    for j, read in enumerate(self.reads_of(genome, self.reads)))
+                    if path.endswith('.gz'):
+                        with gzip.open(path, 'wt', compresslevel=1) as f:
+                            f.write(lines)
+                    else:
+                        with open(path, 'w') as f:
+                            f.write(lines)
+                templates.append(files)
+        return templates
+
+    def make_samples(self, templates, n_samples):
+        folder = os.path.join(self.work_folder, 'samples_{}'.format(n_samples))
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        Methods.make_folder(folder)
+        for i in range(n_samples):
+            for path, suffix in templates[i % len(templates)]:
+                os.symlink(path, os.path.join(folder, 'S{:05d}{}'.format(i, suffix)))
+        return folder
+
+    @staticmethod
+    def timed(function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, round(time.perf_counter() - start, 4)
+
+    def run_size(self, templates, n_samples):
+        input_folder = self.make_samples(templates, n_samples)
+        output_folder = os.path.join(self.work_folder, 'output_{}'.format(n_samples))
+        Methods.make_folder(output_folder)
+
+        sample_dict, discovery = Benchmark.timed(Methods.get_files, input_folder)
+        _, stats = Benchmark.timed(lambda: [Methods.get_stats(x['path'], sample, self.cpu)
+                                            for sample, x in sample_dict.items()])
+        for info_dict in sample_dict.values():  # Fresh sample info for the pipeline
+            info_dict['reads'], info_dict['bp'] = list(), list()
+        hit_tables = dict()
+        samples_df, screen = Benchmark.timed(Methods.mash_screen_parallel, self.mash_db, output_folder, sample_dict,
+                                             0.9, 0.05, self.cpu, virtual_memory().total / 1000000000,
+                                             self.parallel, 10, 'identity', tables=hit_tables)
+
+        def summary():
+            # Summary of the hit tables of the screen step
+            rows = list()
+            for sample, info_dict in sample_dict.items():
+                rows.append(Methods.summary_row(sample, info_dict, hit_tables[sample]))
+            Methods.summary_df(rows).to_csv(os.path.join(output_folder, 'summary_bench.tsv'), sep='\t',
+                                            index=False)
+        _, summary_time = Benchmark.timed(summary)
+
+        n_files = sum(len(x['path']) for x in sample_dict.values())
+        n_bytes = sum(Methods.file_bytes(x['path']) for x in sample_dict.values())
+        return {'samples': len(sample_dict),
+                'files': n_files,
+                'bytes': n_bytes,
+                'identified': int((samples_df['Accession'] != 'NA').sum()),
+                'discovery': discovery,
+                'stats': stats,
+                'screen': screen,
+                'summary': summary_time,
+                'samples_per_second': round(len(sample_dict) / screen, 2) if screen else None}
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__) or '.',
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                                  text=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def run(self):
+        print('Making synthetic genomes, database and samples...')
+        genomes = self.make_genomes()
+        self.make_database(genomes)
+        self.make_stand_in()
+        templates = self.make_templates(genomes)
+
+        os.environ['PATH'] = self.bin_folder + os.pathsep + os.environ['PATH']
+        os.environ['MASHID_BENCH_LATENCY'] = str(self.latency)
+        Methods.backend = self.backend
+
+        results = list()
+        for n_samples in self.sizes:
+            print('Benchmarking {} sample(s)...'.format(n_samples))
+            results.append(self.run_size(templates, n_samples))
+            print('\t' + ', '.join('{}: {}'.format(x, results[-1][x])
+                                   for x in ('discovery', 'stats', 'screen', 'summary')))
+
+        return {'version': __version__,
+                'commit': Benchmark.git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': cpu_count(),
+                'settings': {'reads': self.reads, 'latency': self.latency, 'threads': self.cpu,
+                             'parallel': self.parallel, 'backend': self.backend},
+                'results': results}
+
+    @staticmethod
+    def compare(previous, current):
+        # Time ratio (current / previous) of each step, for the sizes found in both
+        old = {x['samples']: x for x in previous['results']}
+        print('\nSamples\tStep\tPrevious ({})\tCurrent ({})\tRatio'.format(previous.get('commit'),
+                                                                       current.get('commit')))
+        for result in current['results']:
+            if result['samples'] not in old:
+                continue
+            for step in ('discovery', 'stats', 'screen', 'summary'):
+                before = old[result['samples']][step]
+                print('{}\t{}\t{}\t{}\t{}'.format(result['samples'], step, before, result[step],
+                                                  round(result[step] / before, 2) if before else 'NA'))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark mashID on synthetic samples with a stand-in mash.')
+    parser.add_argument('-o', '--output', metavar='benchmark.json',
+                        type=str, required=True,
+                        help='Output JSON file with the timings.')
+    parser.add_argument('-w', '--work', metavar='/work/folder/',
+                        type=str, required=False,
+                        help='Folder for the synthetic data. Default is a temporary folder, removed at the end. '
+                             'Optional.')
+    parser.add_argument('--sizes', metavar='N',
+                        type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='Numbers of samples to benchmark (up to 10000). Default is 1 10 100 1000. Optional.')
+    parser.add_argument('--reads', metavar='1000',
+                        type=int, default=1000,
+                        help='Reads per file. Default is 1000. Optional.')
+    parser.add_argument('--latency', metavar='0.05',
+                        type=float, default=0.05,
+                        help='Seconds each stand-in mash screen waits before reading its input. Default is 0.05. '
+                             'Optional.')
+    parser.add_argument('--backend', choices=['mash', 'native'],
+                        default='mash', type=str,
+                        help='Screen with the stand-in mash or with the native engine. Default is "mash". '
+                             'Optional.')
+    parser.add_argument('-t', '--threads', metavar=str(cpu_count()),
+                        type=int, default=cpu_count(),
+                        help='Number of threads. Default is maximum available({}). Optional.'.format(cpu_count()))
+    parser.add_argument('-p', '--parallel', metavar='2',
+                        type=int, default=2,
+                        help='Typical number of samples to process in parallel. Default is 2. Optional.')
+    parser.add_argument('--compare', metavar='previous.json',
+                        type=str, required=False,
+                        help='Previous benchmark output to compare with. Optional.')
+    parser.add_argument('-v', '--version', action='version',
+                        version=f'{os.path.basename(__file__)}: version {__version__}')
+
+    arguments = parser.parse_args()
+    if max(arguments.sizes) > 10000 or min(arguments.sizes) < 1:
+        raise Exception('Sizes must be between 1 and 10000 samples.')
+    threads, parallel = Methods.check_cpus(arguments.threads, arguments.parallel)
+
+    work = arguments.work or tempfile.mkdtemp(prefix='mashID_benchmark_')
+    try:
+        report = Benchmark(os.path.abspath(work), arguments.sizes, arguments.reads, arguments.latency, threads,
+                           parallel, arguments.backend).run()
+    finally:
+        if not arguments.work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(arguments.output, 'w') as out:
+        json.dump(report, out, indent=2)
+    if arguments.compare:
+        with open(arguments.compare, 'r') as previous_file:
+            Benchmark.compare(json.load(previous_file), report)
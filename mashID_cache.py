@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import pathlib
+import threading
+from contextlib import contextmanager
+
+
+class ResultCache(object):
+    """
+    Persistent cache of the raw mash screen outputs and read/bp stats.
+    Entries are keyed on a fingerprint of the input file content (size, modification time and a few sampled
+    blocks), the digest of the database and the screening parameters, so unchanged samples are not screened
+    again. The cache is bounded in size and the least recently used entries are evicted first.
+    """
+    block_size = 1024 * 1024  # Size of the blocks sampled to fingerprint a file
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = int(max_size * 1000000000)  # GB to bytes
+        self.lock = threading.Lock()
+        self.digests = dict()  # Path: (size, mtime, fingerprint), computed again when the file changes
+
+        ResultCache.make_folder(self.folder)
+        self.size = sum(os.path.getsize(x) for x in self.entries())
+
+    @staticmethod
+    def make_folder(folder):
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(file_path):
+        stat = os.stat(file_path)
+        h = hashlib.blake2b(digest_size=16)
+        h.update('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+        with open(file_path, 'rb') as f:
+            # First, middle and last blocks
+            for offset in sorted({0, max(0, stat.st_size // 2 - ResultCache.block_size // 2),
+                                  max(0, stat.st_size - ResultCache.block_size)}):
+                f.seek(offset)
+                h.update(f.read(ResultCache.block_size))
+        return h.hexdigest()
+
+    def digest(self, file_path):
+        # A long-lived cache (mashID_server.py) sees files rewritten at the same path, e.g. a rebuilt database
+        file_path = os.path.realpath(file_path)
+        stat = os.stat(file_path)
+        with self.lock:
+            known = self.digests.get(file_path)
+            if known and known[:2] == (stat.st_size, stat.st_mtime_ns):
+                return known[2]
+        file_digest = ResultCache.fingerprint(file_path)
+        with self.lock:
+            self.digests[file_path] = (stat.st_size, stat.st_mtime_ns, file_digest)
+        return file_digest
+
+    @staticmethod
+    def make_key(kind, values):
+        return kind + '-' + hashlib.blake2b(json.dumps(values).encode(), digest_size=20).hexdigest()
+
+    def stats_key(self, seq_file):
+        return ResultCache.make_key('stats', [self.digest(seq_file)])
+
+    def screen_key(self, sample_paths, db_files, identity, p_value, extra=None):
+        return ResultCache.make_key('screen', [[self.digest(x) for x in sample_paths],
+                                               [self.digest(x) for x in db_files], identity, p_value, extra])
+
+    def entry_path(self, key):
+        return os.path.join(self.folder, key.split('-')[1][:2], key + '.txt')
+
+    def entries(self):
+        for sub_folder in os.scandir(self.folder):
+            if sub_folder.is_dir():
+                for entry in os.scandir(sub_folder.path):
+                    if entry.name.endswith('.txt'):
+                        yield entry.path
+
+    def get(self, key):
+        entry = self.open_entry(key)
+        if entry is None:
+            return None
+        with entry:
+            return entry.read()
+
+    def open_entry(self, key):
+        # Open an entry for reading, or None if not cached
+        entry = self.entry_path(key)
+        try:
+            handle = open(entry, 'r')
+        except FileNotFoundError:
+            return None
+        os.utime(entry)  # Mark as recently used
+        return handle
+
+    def put(self, key, value):
+        with self.writer(key) as f:
+            f.write(value)
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Write an entry in a temporary file that replaces the entry when done, so readers never see a partial
+        entry. Nothing is stored if an exception is raised or if discard() is called.
+        """
+        entry = self.entry_path(key)
+        ResultCache.make_folder(os.path.dirname(entry))
+        tmp_entry = '{}.{}.{}.tmp'.format(entry, os.getpid(), threading.get_ident())
+        handle = CacheWriter(tmp_entry)
+        try:
+            with handle:
+                yield handle
+        except BaseException:
+            os.remove(tmp_entry)
+            raise
+        if handle.discarded:
+            os.remove(tmp_entry)
+            return
+
+        old_size = os.path.getsize(entry) if os.path.exists(entry) else 0
+        os.replace(tmp_entry, entry)
+        with self.lock:
+            self.size += os.path.getsize(entry) - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Remove least recently used entries until the cache is 10% under its maximum size
+        entries = list()
+        for entry in self.entries():
+            try:
+                stat = os.stat(entry)
+                entries.append((stat.st_mtime, stat.st_size, entry))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        self.size = sum(x[1] for x in entries)
+        for _, size, entry in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(entry)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+
+class CacheWriter(object):
+    def __init__(self, path):
+        self.handle = open(path, 'w')
+        self.discarded = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.handle.close()
+
+    def write(self, value):
+        self.handle.write(value)
+
+    def discard(self):
+        self.discarded = True
@@ -0,0 +1,330 @@
+import os
+import sys
+import glob
+import socket
+import hashlib
+from datetime import datetime
+from argparse import ArgumentParser
+import pandas as pd
+from mashID_cache import ResultCache
+from mashID_methods import Methods
+from mashID_taxonomy import Taxonomy
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for --dataset
+    pa = None
+
+
+class HitDataset(object):
+    """
+    Hits of all the samples of many runs in one columnar dataset (Parquet or Feather), for dashboards and
+    cross-run queries. Each run is one file with a line per hit of each sample (and one for samples without hit),
+    with the sample stats, run parameters and database digest:
+        <dataset>/run_date=2024-05-01/<run>.parquet
+    The run ID is derived from the output folder, so a run started again replaces its previous file.
+    Queries read the files by batches of rows with pyarrow, only the columns needed and the dates asked for.
+    """
+    formats = {'parquet': '.parquet', 'feather': '.feather'}
+    hit_columns = ['rank', 'identity', 'shared_hashes', 'sketch_hashes', 'median_multiplicity', 'p_value',
+                   'accession', 'comment', 'genus', 'species', 'subspecies', 'name', 'taxid']
+    group_columns = ['name', 'genus', 'accession', 'sample', 'run', 'run_date']
+
+    @staticmethod
+    def check():
+        if pa is None:
+            raise Exception('Writing or reading a dataset needs pyarrow (conda install -c conda-forge pyarrow).')
+
+    @staticmethod
+    def schema():
+        return pa.schema([('run', pa.string()),
+                          ('run_time', pa.timestamp('ms')),
+                          ('host', pa.string()),
+                          ('output', pa.string()),
+                          ('version', pa.string()),
+                          ('database', pa.string()),
+                          ('database_digest', pa.string()),
+                          ('min_identity', pa.float64()),
+                          ('max_p_value', pa.float64()),
+                          ('n_hits', pa.int32()),
+                          ('sort_by', pa.string()),
+                          ('early_stop', pa.int64()),
+                          ('max_bp', pa.int64()),
+                          ('backend', pa.string()),
+                          ('sample', pa.string()),
+                          ('reads', pa.int64()),
+                          ('bp', pa.int64()),
+                          ('screened_reads', pa.int64()),
+                          ('screened_bp', pa.int64()),
+                          ('rank', pa.int32()),
+                          ('identity', pa.float64()),
+                          ('shared_hashes', pa.int32()),
+                          ('sketch_hashes', pa.int32()),
+                          ('median_multiplicity', pa.int64()),
+                          ('p_value', pa.float64()),
+                          ('accession', pa.string()),
+                          ('comment', pa.string()),
+                          ('genus', pa.string()),
+                          ('species', pa.string()),
+                          ('subspecies', pa.string()),
+                          ('name', pa.string()),
+                          ('taxid', pa.string())])
+
+    @staticmethod
+    def partitioning():
+        return ds.partitioning(pa.schema([('run_date', pa.string())]), flavor='hive')
+
+    @staticmethod
+    def run_id(output_folder):
+        return hashlib.blake2b(os.path.realpath(output_folder).encode(), digest_size=8).hexdigest()
+
+    @staticmethod
+    def database_digest(mash_db):
+        h = hashlib.blake2b(digest_size=16)
+        for db_file in Methods.get_db_files(mash_db):
+            h.update(ResultCache.fingerprint(db_file).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def sample_hits(df):
+        # Hits of a sample (see Methods.hits_df, ranked by the index), with the dataset column names
+        if df is None or df.empty:
+            return pd.DataFrame([{x: None for x in HitDataset.hit_columns}])
+
+        df = df.reset_index()
+        shared = df['Shared-Hashes'].astype(str).str.split('/', expand=True)
+        hits = pd.DataFrame({'rank': pd.to_numeric(df['Rank']),
+                             'identity': pd.to_numeric(df['Identity']),
+                             'shared_hashes': pd.to_numeric(shared[0]),
+                             'sketch_hashes': pd.to_numeric(shared[1]),
+                             'median_multiplicity': pd.to_numeric(df['Median-Multiplicity']),
+                             'p_value': pd.to_numeric(df['P-Value']),
+                             'accession': df['Query-ID'],
+                             'comment': df['Query-Comment']})
+        if 'Name' in df:  # Annotated with the taxonomy table of the database
+            for column in ['Genus', 'Species', 'Subspecies', 'Name', 'Taxid']:
+                values = df[column].astype(object)
+                hits[column.lower()] = values.where(values.notna() & (values != ''), None)
+        else:
+            taxonomy = pd.DataFrame([Taxonomy.parse_header(x) for x in df['Query-Comment']])
+            for column in ['Genus', 'Species', 'Subspecies', 'Name']:
+                hits[column.lower()] = taxonomy[column].mask(taxonomy[column] == '').values
+            hits['taxid'] = None
+        return hits
+
+    @staticmethod
+    def run_table(samples_df, tables, params):
+        frames = list()
+        for row in samples_df.to_dict(orient='records'):
+            sample = str(row['Sample'])
+            hits = HitDataset.sample_hits(tables.get(sample))
+            hits['sample'] = sample
+            hits['reads'] = row['Reads']
+            hits['bp'] = row['Length']
+            hits['screened_reads'] = row.get('Screened-Reads', row['Reads'])
+            hits['screened_bp'] = row.get('Screened-Length', row['Length'])
+            frames.append(hits)
+        df = pd.concat(frames, ignore_index=True)
+        for key, value in params.items():
+            df[key] = value
+        return pa.Table.from_pandas(df, schema=HitDataset.schema(), preserve_index=False)
+
+    @staticmethod
+    def write_run(dataset_folder, output_folder, samples_df, tables, mash_db, params, file_format='parquet'):
+        """
+        Write the hits of a run: summary "samples_df" and hits of each sample in "tables" (as filled by
+        Methods.mash_screen_parallel). "params" are the run parameters, see schema().
+        """
+        HitDataset.check()
+        run = HitDataset.run_id(output_folder)
+        now = datetime.now().replace(microsecond=0)
+        params = dict(params, run=run, run_time=now, host=socket.gethostname(),
+                      output=os.path.realpath(output_folder), database=mash_db,
+                      database_digest=HitDataset.database_digest(mash_db))
+        table = HitDataset.run_table(samples_df, tables, params)
+
+        partition = os.path.join(dataset_folder, 'run_date={:%Y-%m-%d}'.format(now))
+        Methods.make_folder(partition)
+        run_file = os.path.join(partition, run + HitDataset.formats[file_format])
+        tmp_file = os.path.join(partition, '.{}.{}.tmp'.format(run, os.getpid()))  # Hidden from the readers
+        if file_format == 'parquet':
+            pq.write_table(table, tmp_file, compression='zstd')
+        else:
+            feather.write_feather(table, tmp_file, compression='zstd')
+        os.replace(tmp_file, run_file)
+
+        # Previous files of the same run (started again on another day or in the other format)
+        for old_file in glob.glob(os.path.join(dataset_folder, 'run_date=*', run + '.*')):
+            if old_file != run_file:
+                os.remove(old_file)
+        print('Hits of {} sample(s) added to {}'.format(len(samples_df), run_file))
+        return run_file
+
+    @staticmethod
+    def open(dataset_folder):
+        HitDataset.check()
+        parts = list()
+        for file_format, extension in HitDataset.formats.items():
+            files = sorted(glob.glob(os.path.join(dataset_folder, 'run_date=*', '*' + extension)))
+            if files:
+                parts.append(ds.dataset(files, format=file_format, partitioning=HitDataset.partitioning(),
+                                        partition_base_dir=dataset_folder))
+        if not parts:
+            raise Exception('No run found in {}.'.format(dataset_folder))
+        return parts[0] if len(parts) == 1 else ds.dataset(parts)
+
+    @staticmethod
+    def row_filter(since=None, until=None, samples=None, name=None, min_identity=None, top=False):
+        conditions = list()
+        if since:
+            conditions.append(pc.field('run_date') >= since)
+        if until:
+            conditions.append(pc.field('run_date') <= until)
+        if samples:
+            conditions.append(pc.field('sample').isin(samples))
+        if name:
+            conditions.append(pc.starts_with(pc.field('name'), name))
+        if min_identity is not None:
+            conditions.append(pc.field('identity') >= min_identity)
+        if top:
+            conditions.append(pc.field('rank') == 1)
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    @staticmethod
+    def named(table, keys, columns):
+        # Group keys and aggregates of a pyarrow group_by, under the names of "columns" (name: aggregate column)
+        return pa.table({**{x: table.column(x) for x in keys}, **{x: table.column(y) for x, y in columns.items()}})
+
+    @staticmethod
+    def aggregate(dataset, keys, row_filter=None):
+        """
+        Per group of "keys": number of runs, samples and hits, mean and best identity, lowest p-value and first and
+        last run dates. A file of the dataset is one run: each file is reduced to one line per group and folded
+        into the totals, so memory depends on the size of a run and the number of groups, not on the number of
+        runs or hits.
+        """
+        sample_keys = list(dict.fromkeys(keys + ['run', 'sample']))
+        hit_filter = pc.field('rank').is_valid()  # Samples without hit have no group
+        row_filter = hit_filter if row_filter is None else row_filter & hit_filter
+        columns = list(dict.fromkeys(sample_keys + ['identity', 'p_value', 'run_date']))
+        children = dataset.children if isinstance(dataset, ds.UnionDataset) else [dataset]
+
+        totals = None
+        for child in children:
+            for fragment in child.get_fragments(filter=row_filter):
+                table = fragment.to_table(schema=child.schema, columns=columns, filter=row_filter)
+                if not table.num_rows:
+                    continue
+                per_sample = table.group_by(sample_keys).aggregate(
+                    [('identity', 'count'), ('identity', 'sum'), ('identity', 'max'), ('p_value', 'min'),
+                     ('run_date', 'min'), ('run_date', 'max')])
+                per_group = HitDataset.named(per_sample.group_by(keys).aggregate(
+                    [('run', 'count_distinct'), ('sample', 'count'), ('identity_count', 'sum'),
+                     ('identity_sum', 'sum'), ('identity_max', 'max'), ('p_value_min', 'min'),
+                     ('run_date_min', 'min'), ('run_date_max', 'max')]), keys,
+                    {'runs': 'run_count_distinct', 'samples': 'sample_count', 'hits': 'identity_count_sum',
+                     'identity_sum': 'identity_sum_sum', 'max_identity': 'identity_max_max',
+                     'min_p_value': 'p_value_min_min', 'first_run_date': 'run_date_min_min',
+                     'last_run_date': 'run_date_max_max'})
+                if totals is None:
+                    totals = per_group
+                    continue
+                # Runs are in a single file, so runs and samples of different files add up
+                totals = HitDataset.named(pa.concat_tables([totals, per_group]).group_by(keys).aggregate(
+                    [('runs', 'sum'), ('samples', 'sum'), ('hits', 'sum'), ('identity_sum', 'sum'),
+                     ('max_identity', 'max'), ('min_p_value', 'min'), ('first_run_date', 'min'),
+                     ('last_run_date', 'max')]), keys,
+                    {'runs': 'runs_sum', 'samples': 'samples_sum', 'hits': 'hits_sum',
+                     'identity_sum': 'identity_sum_sum', 'max_identity': 'max_identity_max',
+                     'min_p_value': 'min_p_value_min', 'first_run_date': 'first_run_date_min',
+                     'last_run_date': 'last_run_date_max'})
+        if totals is None:
+            return pd.DataFrame(columns=keys)
+
+        df = totals.to_pandas()
+        df.insert(len(keys) + 3, 'mean_identity', (df.pop('identity_sum') / df['hits']).round(6))
+        df.sort_values(by=['samples', 'max_identity'], ascending=False, inplace=True, ignore_index=True)
+        return df
+
+    @staticmethod
+    def write_rows(dataset, output_file, row_filter=None):
+        # Matching lines of all runs, written batch by batch (TSV, or Parquet if the output ends with .parquet)
+        scanner = dataset.scanner(filter=row_filter)
+        schema = scanner.projected_schema
+        if output_file and output_file.endswith('.parquet'):
+            writer = pq.ParquetWriter(output_file, schema, compression='zstd')
+        else:
+            sink = output_file if output_file else sys.stdout.buffer
+            writer = pacsv.CSVWriter(sink, schema, write_options=pacsv.WriteOptions(delimiter='\t'))
+        n = 0
+        with writer:
+            for batch in scanner.to_batches():
+                writer.write_batch(batch)
+                n += batch.num_rows
+        return n
+
+    @staticmethod
+    def query(args):
+        dataset = HitDataset.open(args.dataset)
+        row_filter = HitDataset.row_filter(args.since, args.until, args.sample, args.name, args.min_identity,
+                                           args.top)
+        if args.group_by:
+            df = HitDataset.aggregate(dataset, args.group_by, row_filter)
+            if args.output:
+                if args.output.endswith('.parquet'):
+                    df.to_parquet(args.output, index=False)
+                else:
+                    df.to_csv(args.output, sep='\t', index=False)
+            else:
+                print(df.to_string(index=False, justify='left'))
+        else:
+            n = HitDataset.write_rows(dataset, args.output, row_filter)
+            if args.output:
+                print('{} line(s) written to {}'.format(n, args.output))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Query the hits dataset written by mashID.py --dataset.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    query_parser = subparsers.add_parser('query', help='Select hits from all the runs of a dataset, or aggregate '
+                                                       'them.')
+    query_parser.add_argument('-d', '--dataset', metavar='/path/to/dataset/',
+                              help='Dataset folder given to mashID.py --dataset.',
+                              type=str, required=True)
+    query_parser.add_argument('-o', '--output', metavar='/path/to/output.tsv',
+                              help='Output file, TSV or Parquet (.parquet). Printed to the terminal by default. '
+                                   'Optional.',
+                              type=str, required=False)
+    query_parser.add_argument('--group-by', choices=HitDataset.group_columns, nargs='+',
+                              help='Aggregate the hits per species name, genus, accession, sample, run or date: '
+                                   'number of runs, samples and hits, mean and best identity, first and last run. '
+                                   'Optional.',
+                              required=False)
+    query_parser.add_argument('--since', metavar='2024-01-01',
+                              help='Only runs from this date. Optional.',
+                              type=str, required=False)
+    query_parser.add_argument('--until', metavar='2024-12-31',
+                              help='Only runs up to this date (included). Optional.',
+                              type=str, required=False)
+    query_parser.add_argument('--sample', metavar='sample1', nargs='+',
+                              help='Only these samples. Optional.',
+                              type=str, required=False)
+    query_parser.add_argument('--name', metavar='"Mycobacterium tuberculosis"',
+                              help='Only hits whose name starts with this (e.g. a genus or species). Optional.',
+                              type=str, required=False)
+    query_parser.add_argument('--min-identity', metavar='0.95',
+                              help='Only hits with at least this identity. Optional.',
+                              type=float, required=False)
+    query_parser.add_argument('--top', action='store_true',
+                              help='Only the top hit of each sample. Optional.')
+
+    arguments = parser.parse_args()
+    HitDataset.query(arguments)
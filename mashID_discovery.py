@@ -0,0 +1,154 @@
+import os
+import json
+import queue
+from concurrent import futures
+
+
+class FileDiscovery(object):
+    """
+    Find the sequence files of an input folder and group them by sample.
+    Folders are listed with os.scandir in parallel (one job per folder) and only symbolic links are resolved.
+    The layout found can be saved with the modification time of each folder; it is reused as long as no folder
+    changed (files added, removed or renamed), so large trees are only listed again when needed.
+    A sample sheet (TSV) can be given instead to name the samples and their files explicitly.
+    """
+    workers = 16  # Folders listed at the same time (I/O bound, network file systems benefit the most)
+    samplesheet_extensions = ('.tsv', '.txt')
+
+    @staticmethod
+    def scan_folder(folder, extensions):
+        files = list()
+        folders = list()
+        # Before listing: a file added during the listing changes the mtime, so the folder is listed next time
+        mtime = os.stat(folder).st_mtime_ns
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.name.endswith(extensions):
+                        # Follow symbolic links, other paths are already real
+                        file_path = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+                        files.append((entry.name, file_path))
+                except OSError:  # Removed while listing
+                    pass
+        return folder, mtime, files, folders
+
+    @staticmethod
+    def scan(root, extensions, workers=None):
+        """
+        Return the (file name, path) of the sequence files under root and the modification time of each folder.
+        """
+        files = list()
+        folders = dict()
+        with futures.ThreadPoolExecutor(max_workers=workers or FileDiscovery.workers) as executor:
+            completed = queue.Queue()  # Listings in completion order, without polling all the pending ones
+
+            def submit(folder):
+                executor.submit(FileDiscovery.scan_folder, folder, extensions).add_done_callback(completed.put)
+
+            submit(root)
+            n_pending = 1
+            while n_pending:
+                folder, mtime, folder_files, sub_folders = completed.get().result()
+                n_pending -= 1
+                folders[folder] = mtime
+                files.extend(folder_files)
+                for sub_folder in sub_folders:
+                    submit(sub_folder)
+                n_pending += len(sub_folders)
+        return files, folders
+
+    @staticmethod
+    def group(files, sample_name):
+        samples = dict()
+        for filename, file_path in files:
+            samples.setdefault(sample_name(filename), list()).append(file_path)
+        return {x: sorted(samples[x]) for x in sorted(samples)}  # Same order whatever the listing order
+
+    @staticmethod
+    def changed(folders, workers=None):
+        def folder_changed(item):
+            try:
+                return os.stat(item[0]).st_mtime_ns != item[1]
+            except FileNotFoundError:
+                return True
+
+        with futures.ThreadPoolExecutor(max_workers=workers or FileDiscovery.workers) as executor:
+            return any(executor.map(folder_changed, folders.items()))
+
+    @staticmethod
+    def load_layout(layout_file, root, extensions):
+        try:
+            with open(layout_file, 'r') as f:
+                layout = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if layout.get('input') != root or layout.get('extensions') != list(extensions):
+            return None
+        if FileDiscovery.changed(layout['folders']):
+            return None
+        return layout['samples']
+
+    @staticmethod
+    def save_layout(layout_file, root, extensions, folders, samples):
+        tmp_file = '{}.{}.tmp'.format(layout_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'input': root, 'extensions': list(extensions), 'folders': folders, 'samples': samples}, f)
+        os.replace(tmp_file, layout_file)
+
+    @staticmethod
+    def discover(root, extensions, sample_name, layout_file=None):
+        """
+        Return {sample: [paths]} for the sequence files under root, from the saved layout if still valid.
+        """
+        root = os.path.realpath(root)
+        extensions = tuple(extensions)
+        if layout_file:
+            samples = FileDiscovery.load_layout(layout_file, root, extensions)
+            if samples is not None:
+                print('\tReusing the file layout of {}'.format(layout_file))
+                return samples
+
+        files, folders = FileDiscovery.scan(root, extensions)
+        samples = FileDiscovery.group(files, sample_name)
+        if layout_file:
+            FileDiscovery.save_layout(layout_file, root, extensions, folders, samples)
+        return samples
+
+    @staticmethod
+    def is_samplesheet(my_input):
+        return os.path.isfile(my_input) and my_input.endswith(FileDiscovery.samplesheet_extensions)
+
+    @staticmethod
+    def read_samplesheet(samplesheet, extensions):
+        """
+        Sample sheet: one sample per line, "sample<TAB>file[<TAB>file...]". A sample can span several lines.
+        Lines starting with "#" and a "sample" header are skipped and relative paths are relative to the sheet.
+        """
+        folder = os.path.dirname(os.path.abspath(samplesheet))
+        samples = dict()
+        with open(samplesheet, 'r') as f:
+            for n, line in enumerate(f, 1):
+                fields = [x.strip() for x in line.rstrip('\n').split('\t') if x.strip()]
+                if not fields or fields[0].startswith('#') or (n == 1 and fields[0].lower() == 'sample'):
+                    continue
+                if len(fields) < 2:
+                    raise Exception('Line {} of {} has no file for sample {}.'.format(n, samplesheet, fields[0]))
+                for file_path in fields[1:]:
+                    file_path = os.path.realpath(os.path.join(folder, os.path.expanduser(file_path)))
+                    if not file_path.endswith(tuple(extensions)):
+                        raise Exception('{} (line {} of {}) is not a fastq/fasta file.'.format(
+                            file_path, n, samplesheet))
+                    if not os.path.isfile(file_path):
+                        raise Exception('{} (line {} of {}) does not exist.'.format(file_path, n, samplesheet))
+                    samples.setdefault(fields[0], list()).append(file_path)
+        return samples
+
+    @staticmethod
+    def write_samplesheet(samplesheet, samples):
+        # Same format as read_samplesheet, e.g. to fix how files were grouped in samples and run again with it
+        with open(samplesheet, 'w') as f:
+            f.write('sample\tfiles\n')
+            for sample, paths in samples.items():
+                f.write('{}\t{}\n'.format(sample, '\t'.join(paths)))
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import queue
+import socket
+import threading
+from concurrent import futures
+import pandas as pd
+from mashID_methods import Methods
+from mashID_scheduler import ResourcePool, JobPlanner
+
+
+class LeaseBoard(object):
+    """
+    Lease files shared by the workers of a distributed run, in the output folder. A sample is claimed by creating
+    its lease file with O_EXCL, which only one worker can do (also on NFS). The owner renews its leases while it
+    works on them and a lease that was not renewed for "lease_time" seconds is from a crashed worker, so it can
+    be taken over. Times are compared to the clock of the file server, not the clock of the node.
+    """
+    def __init__(self, folder, worker_id, lease_time=600):
+        self.folder = folder
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.held = set()
+        self.lock = threading.Lock()
+        Methods.make_folder(self.folder)
+
+    def lease_path(self, sample):
+        return os.path.join(self.folder, sample + '.lease')
+
+    def now(self):
+        # Time of the file server
+        clock = os.path.join(self.folder, '.clock.' + self.worker_id)
+        with open(clock, 'w'):
+            pass
+        return os.stat(clock).st_mtime
+
+    def create(self, sample):
+        try:
+            fd = os.open(self.lease_path(sample), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}\n'.format(self.worker_id))
+        with self.lock:
+            self.held.add(sample)
+        return True
+
+    def expired(self, sample):
+        try:
+            return self.now() - os.stat(self.lease_path(sample)).st_mtime > self.lease_time
+        except FileNotFoundError:
+            return True
+
+    def claim(self, sample):
+        """
+        Try to get the lease of a sample, taking it over if it expired.
+        """
+        if self.create(sample):
+            return True
+        if not self.expired(sample):
+            return False
+        # Only one worker can move the expired lease away, the others get FileNotFoundError
+        stale = '{}.{}.stale'.format(self.lease_path(sample), self.worker_id)
+        try:
+            os.rename(self.lease_path(sample), stale)
+        except FileNotFoundError:
+            return False
+        if self.now() - os.stat(stale).st_mtime <= self.lease_time:
+            # Renewed or taken over by another worker since it was checked, put it back
+            try:
+                os.link(stale, self.lease_path(sample))
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        print('\tTaking over expired lease of {}'.format(sample))
+        return self.create(sample)
+
+    def renew(self):
+        with self.lock:
+            held = list(self.held)
+        for sample in held:
+            try:
+                os.utime(self.lease_path(sample))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        try:
+            os.remove(os.path.join(self.folder, '.clock.' + self.worker_id))
+        except FileNotFoundError:
+            pass
+
+    def release(self, sample):
+        with self.lock:
+            self.held.discard(sample)
+        try:
+            os.remove(self.lease_path(sample))
+        except FileNotFoundError:
+            pass
+
+
+class DistributedRun(object):
+    """
+    One of several workers (processes or nodes) identifying the samples of the same input folder into the same
+    output folder. Each worker screens up to "parallel" samples at a time and claims the next sample through the
+    lease board as soon as one is done, saving each result (summary line and hits) in its own file, until no sample
+    is left. The last worker to finish writes "topID.tsv" from the per-sample results.
+    """
+    work_folder = '.mashID_work'
+    poll_interval = 5  # Seconds between two checks of the samples of the other workers
+
+    def __init__(self, input_folder, output_folder, mash_db, identity, p_value, cpu, mem, parallel, n_hit, sortby,
+                 cache=None, early_stop=None, max_bp=None, lease_time=600):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.mash_db = mash_db
+        self.identity = identity
+        self.p_value = p_value
+        self.cpu = cpu
+        self.mem = mem
+        self.parallel = parallel
+        self.n_hit = n_hit
+        self.sortby = sortby
+        self.cache = cache
+        self.early_stop = early_stop
+        self.max_bp = max_bp
+        self.lease_time = lease_time
+
+        self.worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.folder = os.path.join(self.output_folder, DistributedRun.work_folder)
+        self.leases = LeaseBoard(os.path.join(self.folder, 'leases'), self.worker_id, lease_time)
+        self.results = os.path.join(self.folder, 'results')
+        Methods.make_folder(self.results)
+        self.stop = threading.Event()
+        self.pool = ResourcePool(cpu, mem)  # Shared by the samples screened at the same time
+
+    def result_path(self, sample):
+        return os.path.join(self.results, sample + '.json')
+
+    def is_done(self, sample):
+        return os.path.exists(self.result_path(sample))
+
+    def save_result(self, sample, row, df):
+        # Hits are kept with the summary line, for the dataset of the worker writing the summary
+        result = {'summary': row, 'hits': json.loads(df.reset_index().to_json(orient='records', double_precision=15))}
+        tmp_path = '{}.{}.tmp'.format(self.result_path(sample), self.worker_id)
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, self.result_path(sample))
+
+    def heartbeat(self):
+        while not self.stop.wait(self.lease_time / 4):
+            self.leases.renew()
+
+    def claim_next(self, samples, running):
+        for sample in samples:
+            if sample in running or self.is_done(sample) or not self.leases.claim(sample):
+                continue
+            if self.is_done(sample):  # Finished between the check and the claim
+                self.leases.release(sample)
+                continue
+            return sample
+        return None
+
+    def process(self, sample_dict, sample):
+        print('Worker {} screening {}'.format(self.worker_id, sample))
+        progress_tsv = os.path.join(self.folder, 'topID.{}.{}.tsv'.format(self.worker_id, sample))
+        # Same share of the threads as a sample of average size in a single run
+        cpu = max(1, int(self.cpu / self.parallel))
+        hit_tables = dict()
+        samples_df = Methods.mash_screen_parallel(self.mash_db, self.output_folder, {sample: sample_dict[sample]},
+                                                  self.identity, self.p_value, cpu, self.mem, 1, self.n_hit,
+                                                  self.sortby, self.cache, self.early_stop, self.max_bp, self.pool,
+                                                  output_tsv=progress_tsv, tables=hit_tables)
+        os.remove(progress_tsv)
+        for row in json.loads(samples_df.to_json(orient='records')):
+            self.save_result(row['Sample'], row, hit_tables[row['Sample']])
+        self.leases.release(sample)
+
+    def summary(self, samples, tables=None):
+        rows = list()
+        for sample in samples:
+            with open(self.result_path(sample), 'r') as f:
+                result = json.load(f)
+            rows.append(result['summary'])
+            if tables is not None:
+                hits = pd.DataFrame(result['hits'])
+                tables[sample] = hits.set_index('Rank') if 'Rank' in hits else hits
+        samples_df = pd.DataFrame(rows)
+        samples_df.sort_values(by=['Sample'], axis='index', ascending=True, inplace=True, ignore_index=True)
+        return samples_df
+
+    def run(self, tables=None):
+        """
+        Work until all the samples are done, then return the summary of all the samples (from all the workers).
+        If "tables" is a dict, it is filled with the hits of each sample (Sample: DataFrame).
+        """
+        # Workers started later reuse the layout saved by the first one
+        sample_dict = Methods.get_files(self.input_folder, os.path.join(self.folder, 'layout.json'))
+        samples = list(JobPlanner.plan(sample_dict, Methods.get_db_size(self.mash_db), self.cpu,
+                                       self.parallel))  # Largest first
+
+        heartbeat = threading.Thread(target=self.heartbeat, daemon=True)
+        heartbeat.start()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                jobs = dict()
+                completed = queue.Queue()  # Samples in completion order
+                while True:
+                    # A new sample is claimed as soon as one is done, a slow sample doesn't hold up the others
+                    while len(jobs) < self.parallel:
+                        sample = self.claim_next(samples, set(jobs.values()))
+                        if sample is None:
+                            break
+                        job = executor.submit(self.process, sample_dict, sample)
+                        jobs[job] = sample
+                        job.add_done_callback(completed.put)
+                    if jobs:
+                        job = completed.get()
+                        del jobs[job]
+                        job.result()
+                        continue
+                    pending = [x for x in samples if not self.is_done(x)]
+                    if not pending:
+                        break
+                    # Other workers are on the remaining samples, wait in case one of them crashes
+                    time.sleep(min(DistributedRun.poll_interval, self.lease_time / 4))
+        finally:
+            self.stop.set()
+            self.leases.close()
+
+        samples_df = self.summary(samples, tables)
+        output_tsv = self.output_folder + '/topID.tsv'
+        samples_df.to_csv('{}.{}.tmp'.format(output_tsv, self.worker_id), sep="\t", index=False)
+        os.replace('{}.{}.tmp'.format(output_tsv, self.worker_id), output_tsv)
+        return samples_df
@@ -1,16 +1,27 @@
 import subprocess
 import os
-import pathlib
+import atexit
 import shutil
-from io import StringIO
-from io import TextIOWrapper
+import pathlib
+import tempfile
+import heapq
+import queue
+import threading
+import time
+from itertools import chain
 import pandas as pd
 from concurrent import futures
-import gzip
-from itertools import groupby
 from multiprocessing import cpu_count
 from psutil import virtual_memory
 import sys
+import json
+from mashID_stats import SeqStats
+from mashID_reads import ReadStream
+from mashID_scheduler import ResourcePool, JobPlanner
+from mashID_msh import MshWriter, NativeScreen
+from mashID_metrics import RunMetrics
+from mashID_discovery import FileDiscovery
+from mashID_taxonomy import Taxonomy
 
 
 class Methods(object):
@@ -19,28 +30,39 @@ class Methods(object):
                            '.fasta', '.fasta.gz',
                            '.fa', '.fa.gz',
                            '.fna', '.fna.gz']
+    summary_columns = ['Sample', 'Reads', 'Length', 'Identity', 'Shared-Hashes', 'Median-Multiplicity', 'P-Value',
+                       'Query-ID', 'Query-Comment']
+    summary_names = {'Identity': '%-Identity', 'Query-ID': 'Accession', 'Query-Comment': 'Identification'}
+    tier1_margin = 0.05  # Identity threshold of tier 1 screens is lowered by this much
+    early_stop_delta = 0.001  # Maximum change of the top hit identity between two rounds to stop early
+    early_stop_margin = 0.002  # Minimum identity margin of the top hit over the runner-up to stop early
+    backend = 'mash'  # 'mash' or 'native' (in-process screen, see mashID_msh.py)
+    by_species = False  # Also write the hits of each sample per species (needs the taxonomy table of the database)
+    combined_folder = None  # Temporary folder of the combined tier 2 shards (see combine_shards)
+    combined = dict()  # State of the shard files: combined sketch file
+    combine_lock = threading.Lock()
 
     @staticmethod
     def check_cpus(requested_cpu, n_proc):
         total_cpu = cpu_count()
 
-        if 1 > requested_cpu > total_cpu:
+        if requested_cpu < 1 or requested_cpu > total_cpu:
             requested_cpu = total_cpu
-            sys.stderr.write("Number of threads was set to {}".format(requested_cpu))
-        if 1 > n_proc > total_cpu:
-            n_proc = total_cpu
-            sys.stderr.write("Number of samples to parallel process was set to {}".format(total_cpu))
+            sys.stderr.write("Number of threads was set to {}\n".format(requested_cpu))
+        if n_proc < 1 or n_proc > requested_cpu:
+            n_proc = max(1, min(n_proc, requested_cpu))
+            sys.stderr.write("Number of samples to parallel process was set to {}\n".format(n_proc))
 
         return requested_cpu, n_proc
 
     @staticmethod
     def check_mem(requested_mem):
         max_mem = int(virtual_memory().total * 0.85 / 1000000000)  # in GB
-        if requested_mem:
+        if requested_mem and requested_mem > 0:
             if requested_mem > max_mem:
                 requested_mem = max_mem
-                sys.stderr.write("Requested memory was set higher than available system memory ({})".format(max_mem))
-                sys.stderr.write("Memory was set to {}".format(requested_mem))
+                sys.stderr.write("Requested memory was set higher than available system memory ({})\n".format(max_mem))
+                sys.stderr.write("Memory was set to {}\n".format(requested_mem))
         else:
             requested_mem = max_mem
 
@@ -69,224 +91,536 @@ class Methods(object):
         pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
 
     @staticmethod
-    def get_files(my_input):
+    def sample_name(filename):
+        # sample = filename.split('.')[0].replace('_pass', '').replace('_filtered', '')
+        sample = filename.split('.')[0].split('_')[0]
+        if filename.endswith('.gz'):
+            sample = sample.split('.')[0]
+        return sample
+
+    @staticmethod
+    def get_files(my_input, layout_file=None):
+        """
+        Input is a folder (searched recursively, see FileDiscovery), a single fastq/fasta file or a sample sheet.
+        With "layout_file", the files found in a folder are saved and reused until a folder changes.
+        """
         sample_dict = dict()
 
         if os.path.isdir(my_input):  # Input is a folder
-            # Look for input sequence files recursively
-            for root, directories, filenames in os.walk(my_input):
-                for filename in filenames:
-                    if filename.endswith(tuple(Methods.accepted_extensions)):  # accept a tuple or string
-                        file_path = os.path.join(root, filename)
-                        file_path = os.path.realpath(file_path)  # follow symbolic links
-
-                        # Get sample name
-                        # sample = filename.split('.')[0].replace('_pass', '').replace('_filtered', '')
-                        sample = filename.split('.')[0].split('_')[0]
-                        if filename.endswith('.gz'):
-                            sample = sample.split('.')[0]
-
-                        # Get total reads and bp for fastq/fasta
-
-                        # Create dictionary entries
-                        if sample not in sample_dict.keys():
-                            sample_dict[sample] = dict()
-                            sample_dict[sample]['path'] = list()
-                            sample_dict[sample]['reads'] = list()
-                            sample_dict[sample]['bp'] = list()
-
-                        sample_dict[sample]['path'].append(file_path)
+            samples = FileDiscovery.discover(my_input, Methods.accepted_extensions, Methods.sample_name, layout_file)
+        elif FileDiscovery.is_samplesheet(my_input):  # Input is a sample sheet
+            samples = FileDiscovery.read_samplesheet(my_input, Methods.accepted_extensions)
         elif os.path.isfile(my_input):  # Input is a file
             sample = os.path.basename(my_input).split('.')[0].replace('_pass', '')
-            sample_dict[sample] = dict()
-            sample_dict[sample] = {'path': [os.path.realpath(my_input)]}  # Follow symbolic links
+            samples = {sample: [os.path.realpath(my_input)]}  # Follow symbolic links
         else:
             raise Exception('Hmmm... something went terribly wrong!')
 
+        # Create dictionary entries
+        for sample, paths in samples.items():
+            sample_dict[sample] = {'path': paths,
+                                   'reads': list(),
+                                   'bp': list()}
+
         if not sample_dict:
             raise Exception('Sample dictionary empty!')
 
         return sample_dict
 
     @staticmethod
-    def merge_fastq_pair(sample_dict, output_folder):
-        # Check if multiple files per sample (if paired-end)
-        for sample, info_dict in sample_dict.items():
-            if len(info_dict['path']) == 2:  # Paired-end
-                # Figure out if input file is gzipped or not
-                file_ext = info_dict['path'][0].split('.')[-1]
-                if file_ext == 'gz':
-                    file_ext = info_dict['path'][0].split('.')[-2]
-                    merged_file = output_folder + '/' + sample + '.' + file_ext + '.gz'
-                else:
-                    merged_file = output_folder + '/' + sample + '.' + file_ext
+    def read_manifest(mash_db):
+        if mash_db.endswith('.json'):  # Manifest of a sharded database (see make_mashID_db.py)
+            with open(mash_db, 'r') as f:
+                return json.load(f)
+        return None
 
-                with open(merged_file, 'wb') as wfp:
-                    for seq_file in info_dict['path']:
-                        with open(seq_file, 'rb') as rfp:
-                            shutil.copyfileobj(rfp, wfp)
-            else:
-                try:
-                    # just create symbolic link
-                    os.symlink(info_dict['path'][0], output_folder +
-                               '/' + os.path.basename(info_dict['path'][0]))
-                except FileExistsError:
-                    pass
+    @staticmethod
+    def get_db_files(mash_db):
+        manifest = Methods.read_manifest(mash_db)
+        if manifest is None:
+            return [mash_db]
 
-        # Update sample dict with new merged files
-        return Methods.get_files(output_folder)
+        db_files = manifest['shards'] + ([manifest['tier1']] if 'tier1' in manifest else [])
+        return [os.path.join(os.path.dirname(mash_db), x) for x in db_files]
 
     @staticmethod
-    def mash_screen(sample, mash_db, sample_path, output_folder, identity, p_value, cpu, n_hit, sortby):
-        print('\t{}'.format(sample))
+    def file_bytes(paths):
+        return sum(os.path.getsize(x) for x in paths)
+
+    @staticmethod
+    def get_db_size(mash_db):
+        return sum(os.path.getsize(x) for x in Methods.get_db_files(mash_db))
+
+    @staticmethod
+    def stream_mash_screen_db(db_file, sample_paths, identity, p_value, cpu, returncodes, records=None):
+        """
+        Screen the files of a sample, or the records given by the "records" function through the standard input.
+        """
+        if Methods.backend == 'native':
+            # Same output as "mash screen -w", the database stays loaded between samples
+            reads = records() if records else ReadStream.records(sample_paths, cpu)
+            yield from NativeScreen.screen_lines(db_file, reads, identity, p_value)
+            returncodes.append(0)
+            return
 
         cmd = ["mash", "screen",
                '-i', str(identity),
                '-v', str(p_value),
                '-w',  # to reduce redundancy in output
                '-p', str(cpu),
-               mash_db,
-               sample_path]
+               db_file]
+        if records:
+            cmd.append('-')
+        else:
+            cmd += sample_paths  # All the files of a sample are screened together (e.g. R1 and R2)
+
+        # Hits are passed on as mash writes them, nothing is buffered
+        with subprocess.Popen(cmd, stdin=subprocess.PIPE if records else None, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL) as p:
+            RunMetrics.track_process(p.pid)
+            if records:
+                # Child processes of the records (e.g. pigz) count for the same stage as mash
+                feed_errors = list()
+                feeder = threading.Thread(target=Methods.feed_stdin,
+                                          args=(p.stdin, records, feed_errors, RunMetrics.current()), daemon=True)
+                feeder.start()
+            for line in p.stdout:
+                yield line.decode('utf-8')
+            if records:
+                feeder.join()
+            RunMetrics.wait_process(p)  # Final CPU time of mash
+            if records and feed_errors:
+                # mash only saw part of the reads, don't let the screen pass (or be cached) as complete
+                raise feed_errors[0]
+        returncodes.append(p.returncode)
 
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    @staticmethod
+    def feed_stdin(stdin, records, errors, stage_record=None):
+        try:
+            with RunMetrics.attach(stage_record):
+                for record, _ in records():
+                    try:
+                        stdin.write(record)
+                    except (BrokenPipeError, ValueError):  # mash exited or the pipe was closed
+                        break
+        except Exception as e:  # e.g. truncated gzip file, given back to the thread reading mash's output
+            errors.append(e)
+        finally:
+            try:
+                stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
 
-        my_stringio = StringIO(p.communicate()[0].decode('utf-8'))
-        # 'Identity', 'Shared-Hashes', 'Median-Multiplicity', 'P-Value', 'Query-ID', 'Query-Comment'
-        df = pd.read_csv(my_stringio, sep="\t", names=['Identity', 'Shared-Hashes', 'Median-Multiplicity',
-                                                       'P-Value', 'Query-ID', 'Query-Comment'])
-        if sortby == 'multiplicity':
-            df = df.sort_values(by=['Median-Multiplicity'], kind='mergesort', ascending=False)
-        else:  # elif sortby == 'identity'
-            df = df.sort_values(by=['Identity'], kind='mergesort', ascending=False)
-        df = df.head(n=n_hit)  # Only keep the top 5
-
-        df = df.reset_index(drop=True)  # Renumber indexes
-        df.index = df.index + 1  # Change Index column to starts at 1 instead of 0
-        df.index.name = 'Rank'  # Change index column name
+    @staticmethod
+    def run_mash_screen_db(db_file, sample_paths, identity, p_value, cpu, records=None):
+        returncodes = list()
+        screen_output = ''.join(Methods.stream_mash_screen_db(db_file, sample_paths, identity, p_value, cpu,
+                                                              returncodes, records))
+        return screen_output, returncodes[0]
+
+    @staticmethod
+    def select_shards(mash_db, manifest, sample_paths, identity, p_value, cpu, n_hit, sortby, records=None):
+        # Tier 1 has one representative per cluster. Its identity threshold is relaxed because the representative
+        # can be further from the sample than the best genome of its cluster.
+        tier1 = os.path.join(os.path.dirname(mash_db), manifest['tier1'])
+        tier1_output, returncode = Methods.run_mash_screen_db(tier1, sample_paths,
+                                                              max(0, identity - Methods.tier1_margin),
+                                                              p_value, cpu, records)
+        hits = Methods.top_hits(tier1_output.splitlines(), len(manifest['representatives']), sortby)
+
+        # Shards of the top n_hit clusters
+        clusters = list()
+        for hit in hits:
+            cluster = manifest['representatives'].get(os.path.basename(hit[4]))
+            if cluster is not None and cluster not in clusters:
+                clusters.append(cluster)
+                if len(clusters) == n_hit:
+                    break
+        shard_index = sorted({manifest['clusters'][x] for x in clusters})
+        return [os.path.join(os.path.dirname(mash_db), manifest['shards'][i]) for i in shard_index]
 
-        # Reformat Query-ID to only keep the accession number
-        df['Query-ID'] = list(map(lambda x: '.'.join(os.path.basename(x).split(".")[:-1]), df['Query-ID'].tolist()))
+    @staticmethod
+    def combine_shards(shard_files):
+        """
+        One sketch file with the tier 2 shards selected for a sample, so its reads are screened (and hashed) once
+        instead of once per shard. Combined files are reused by the samples that select the same shards.
+        """
+        if len(shard_files) == 1:
+            return shard_files[0]
+        state = tuple((x, os.stat(x).st_size, os.stat(x).st_mtime_ns) for x in shard_files)  # Rebuilt database
+        with Methods.combine_lock:
+            if state not in Methods.combined:
+                if Methods.combined_folder is None:
+                    Methods.combined_folder = tempfile.mkdtemp(prefix='mashID_tier2_')
+                    atexit.register(shutil.rmtree, Methods.combined_folder, True)
+                prefix = os.path.join(Methods.combined_folder, 'shards{}'.format(len(Methods.combined)))
+                if Methods.backend == 'native':
+                    MshWriter.paste(prefix + '.msh', shard_files)
+                else:
+                    subprocess.run(['mash', 'paste', prefix] + shard_files, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.STDOUT, check=True)
+                Methods.combined[state] = prefix + '.msh'
+            return Methods.combined[state]
+
+    @staticmethod
+    def stream_mash_screen(mash_db, sample_paths, identity, p_value, cpu, n_hit, sortby, returncodes,
+                           records=None):
+        manifest = Methods.read_manifest(mash_db)
+        if manifest is None:
+            yield from Methods.stream_mash_screen_db(mash_db, sample_paths, identity, p_value, cpu, returncodes,
+                                                     records)
+            return
+
+        shard_files = [os.path.join(os.path.dirname(mash_db), x) for x in manifest['shards']]
+        if 'tier1' in manifest:
+            # Screen everything if nothing is close enough in tier 1, like a flat database would
+            selected = Methods.select_shards(mash_db, manifest, sample_paths, identity, p_value, cpu, n_hit, sortby,
+                                             records)
+            if selected:
+                shard_files = [Methods.combine_shards(selected)]
+
+        # Sharded database: screen the shards at the same time with the threads of the sample.
+        # Hits of all the shards are merged as they come, then sorted and filtered like for a single database.
+        n_workers = max(1, min(len(shard_files), cpu))
+        shard_cpu = max(1, int(cpu / n_workers))
+        lines = queue.Queue(maxsize=10000)
+        record = RunMetrics.current()
+
+        def pump(db_file):
+            try:
+                with RunMetrics.attach(record):
+                    for line in Methods.stream_mash_screen_db(db_file, sample_paths, identity, p_value, shard_cpu,
+                                                              returncodes, records):
+                        lines.put(line)
+            finally:
+                lines.put(None)  # This shard is done
+
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            jobs = [executor.submit(pump, db_file) for db_file in shard_files]
+            done = 0
+            while done < len(jobs):
+                line = lines.get()
+                if line is None:
+                    done += 1
+                else:
+                    yield line
+            for job in jobs:
+                job.result()  # Raise errors from the shards
+
+    @staticmethod
+    def top_hits(lines, n_hit, sortby):
+        """
+        Best n_hit hits of mash screen output lines, kept in a bounded heap. Ties keep their original order.
+        """
+        column = 2 if sortby == 'multiplicity' else 0  # Median-Multiplicity or Identity
+        hits = (line.rstrip('\n').split('\t', 5) for line in lines if line.strip() and not line.startswith('#'))
+        return heapq.nlargest(n_hit, hits, key=lambda x: float(x[column]))
+
+    @staticmethod
+    def converged(previous, hits):
+        # Same top hit as the previous round, with a stable identity and a clear margin over the runner-up
+        if not previous or not hits or hits[0][4] != previous[0][4]:
+            return False
+        if abs(float(hits[0][0]) - float(previous[0][0])) > Methods.early_stop_delta:
+            return False
+        if len(hits) > 1 and float(hits[0][0]) - float(hits[1][0]) < Methods.early_stop_margin:
+            return False
+        return True
+
+    @staticmethod
+    def early_stop_screen(mash_db, sample_paths, identity, p_value, cpu, n_hit, sortby, first_batch, returncodes,
+                          fraction=None):
+        """
+        Screen the first reads of a sample, doubling their number at each round, until the top hits are stable.
+        Return the mash screen output of the last round and the number of reads and bp that were screened.
+        """
+        n = first_batch
+        previous = None
+        while True:
+            counts = dict()
+            round_returncodes = list()
+            lines = list(Methods.stream_mash_screen(mash_db, sample_paths, identity, p_value, cpu, n_hit, sortby,
+                                                    round_returncodes,
+                                                    lambda: ReadStream.head(sample_paths, n, counts,
+                                                                            fraction=fraction)))
+            hits = Methods.top_hits(lines, max(2, n_hit), sortby)
+            exhausted = counts.get('reads', 0) < n  # Whole input was screened
+            if exhausted or any(round_returncodes) or Methods.converged(previous, hits):
+                returncodes.extend(round_returncodes)
+                return lines, counts
+            previous = hits
+            n *= 2
+
+    @staticmethod
+    def screened_marker(screened):
+        # Evaluated once the screened records were all given to mash
+        yield '#Screened\t{}\t{}\n'.format(screened['reads'], screened['bp'])
+
+    @staticmethod
+    def read_screened(lines, screened):
+        for line in lines:
+            if line.startswith('#Screened'):
+                fields = line.split('\t')
+                screened.update({'reads': int(fields[1]), 'bp': int(fields[2])})
+            yield line
+
+    @staticmethod
+    def screen_cache_key(cache, mash_db, sample_paths, identity, p_value, n_hit, sortby, early_stop=None,
+                         fraction=None):
+        # Which tier 2 shards are screened depends on n_hit and sortby
+        extra = [n_hit, sortby] if mash_db.endswith('.json') else None
+        if Methods.backend != 'mash':
+            extra = [extra, Methods.backend]
+        if early_stop or fraction:
+            extra = [extra, early_stop, Methods.early_stop_delta, Methods.early_stop_margin, fraction,
+                     n_hit, sortby]
+        return cache.screen_key(sample_paths, Methods.get_db_files(mash_db), identity, p_value, extra)
+
+    @staticmethod
+    def mash_screen(sample, mash_db, sample_paths, output_folder, identity, p_value, cpu, n_hit, sortby,
+                    cache=None, early_stop=None, fraction=None):
+        """
+        Screen a sample and write its top hits. With "early_stop", only the reads needed for a stable top hit are
+        screened, and with "fraction" the reads are subsampled on their way to mash. Also return the number of
+        reads and bp screened in these cases.
+        """
+        print('\t{}'.format(sample))
+
+        returncodes = list()
+        screened = dict()  # Reads and bp screened, if not the whole input
+        cached = None
+        if cache:
+            key = Methods.screen_cache_key(cache, mash_db, sample_paths, identity, p_value, n_hit, sortby,
+                                           early_stop, fraction)
+            cached = cache.open_entry(key)
+
+        if cached:
+            with cached:
+                hits = Methods.top_hits(Methods.read_screened(cached, screened), n_hit, sortby)
+        else:
+            if early_stop:
+                lines, counts = Methods.early_stop_screen(mash_db, sample_paths, identity, p_value, cpu,
+                                                          n_hit, sortby, early_stop, returncodes, fraction)
+                screened.update(counts)
+                lines = chain(lines, Methods.screened_marker(screened))
+            elif fraction:
+                # Subsampled reads are streamed to mash, nothing is written to disk
+                lines = Methods.stream_mash_screen(mash_db, sample_paths, identity, p_value, cpu, n_hit, sortby,
+                                                   returncodes,
+                                                   lambda: ReadStream.head(sample_paths, None, screened,
+                                                                           fraction=fraction))
+                lines = chain(lines, Methods.screened_marker(screened))
+            else:
+                lines = Methods.stream_mash_screen(mash_db, sample_paths, identity, p_value, cpu, n_hit, sortby,
+                                                   returncodes)
+            if cache:
+                # Raw output goes to the cache as it is parsed
+                with cache.writer(key) as entry:
+                    hits = Methods.top_hits(Methods.tee(lines, entry), n_hit, sortby)
+                    if any(returncodes):  # Don't cache failed runs
+                        entry.discard()
+            else:
+                hits = Methods.top_hits(lines, n_hit, sortby)
 
         # Write output file
+        df = Methods.hits_df(hits, mash_db)
         output_tsv = output_folder + '/' + sample + "_mashID.tsv"
         df.to_csv(output_tsv, sep="\t")
+        if Methods.by_species and 'Genus' in df:
+            Taxonomy.species_hits(df).to_csv(output_folder + '/' + sample + "_mashID_species.tsv", sep="\t")
+
+        return sample, df, screened or None
+
+    @staticmethod
+    def hits_df(hits, mash_db=None):
+        # 'Identity', 'Shared-Hashes', 'Median-Multiplicity', 'P-Value', 'Query-ID', 'Query-Comment'
+        df = pd.DataFrame(hits, columns=['Identity', 'Shared-Hashes', 'Median-Multiplicity',
+                                         'P-Value', 'Query-ID', 'Query-Comment'])
+        for column in ['Identity', 'Median-Multiplicity', 'P-Value']:
+            df[column] = pd.to_numeric(df[column])
+
+        df.index = df.index + 1  # Change Index column to starts at 1 instead of 0
+        df.index.name = 'Rank'  # Change index column name
+
+        # Reformat Query-ID to only keep the accession number, and add the taxonomy if the database has a table
+        table = Taxonomy.load(mash_db) if mash_db else None
+        if table is not None:
+            df = Taxonomy.annotate(df, table)
+        else:
+            df['Query-ID'] = Taxonomy.accessions(df['Query-ID'])
+
+        return df
+
+    @staticmethod
+    def tee(lines, handle):
+        for line in lines:
+            handle.write(line)
+            yield line
+
+    @staticmethod
+    def summary_row(sample, info_dict, df):
+        # Only keep best hit
+        df = df.head(n=1)
+
+        try:
+            ident = df['Identity'].iloc[0]
+            hashes = df['Shared-Hashes'].iloc[0]
+            mult = df['Median-Multiplicity'].iloc[0]
+            p_value = df['P-Value'].iloc[0]
+            query_id = df['Query-ID'].iloc[0]
+            comment = df['Query-Comment'].iloc[0]  # Get the ID
+            if 'Name' in df and pd.notna(df['Name'].iloc[0]):  # From the taxonomy table
+                org_id = df['Name'].iloc[0]
+            else:
+                org_id = Methods.species_from_header(comment)  # Change name
+        except IndexError:
+            ident = hashes = mult = p_value = query_id = 'NA'
+            org_id = 'No significant hit in database'
+
+        return {'Sample': sample,
+                'Reads': sum(info_dict['reads']),
+                'Length': sum(info_dict['bp']),
+                'Identity': ident,
+                'Shared-Hashes': hashes,
+                'Median-Multiplicity': mult,
+                'P-Value': p_value,
+                'Query-ID': query_id,
+                'Query-Comment': org_id,
+                'Screened-Reads': info_dict.get('screened_reads', sum(info_dict['reads'])),
+                'Screened-Length': info_dict.get('screened_bp', sum(info_dict['bp']))}
 
-        return sample, df
-
-    @staticmethod
-    def mash_screen_parallel(mash_db, output_folder, sample_dict, identity, p_value, cpu, parallel, n_hit, sortby):
-        df = pd.DataFrame(columns=['Sample', 'Reads', 'Length', 'Identity', 'Shared-Hashes',
-                                   'Median-Multiplicity', 'P-Value', 'Query-ID'])
-
-        with futures.ThreadPoolExecutor(max_workers=parallel) as executor:
-            args = ((sample, mash_db, info_dict['path'][0], output_folder,
-                     identity, p_value, int(cpu / parallel), n_hit, sortby) for sample, info_dict in sample_dict.items())
-            for sample, my_df in executor.map(lambda x: Methods.mash_screen(*x), args):
-                # Only keep best hit
-                my_df = my_df.head(n=1)
-
-                try:
-                    ident = my_df['Identity'].iloc[0]
-                    hashes = my_df['Shared-Hashes'].iloc[0]
-                    mult = my_df['Median-Multiplicity'].iloc[0]
-                    p_value = my_df['P-Value'].iloc[0]
-                    query_id = my_df['Query-ID'].iloc[0]
-                    comment = my_df['Query-Comment'].iloc[0]  # Get the ID
-                    org_id = Methods.species_from_header(comment)  # Change name
-                except IndexError:
-                    ident = hashes = mult = p_value = query_id = 'NA'
-                    org_id = 'No significant hit in database'
-
-                results_dict = {'Sample': sample,
-                                'Reads': sample_dict[sample]['reads'][0],
-                                'Length': sample_dict[sample]['bp'][0],
-                                'Identity': [ident],
-                                'Shared-Hashes': [hashes],
-                                'Median-Multiplicity': [mult],
-                                'P-Value': [p_value],
-                                'Query-ID': [query_id],
-                                'Query-Comment': [org_id]
-                                }
-                new_df = pd.DataFrame.from_dict(results_dict)
-                df = pd.concat([df, pd.DataFrame.from_dict(results_dict)], axis='index', ignore_index=True)
+    @staticmethod
+    def get_summary_columns(screened=False):
+        # Reads and bp actually screened are only reported when not the whole input is screened
+        return Methods.summary_columns + (['Screened-Reads', 'Screened-Length'] if screened else [])
+
+    @staticmethod
+    def summary_df(rows, screened=False):
+        df = pd.DataFrame(rows, columns=Methods.get_summary_columns(screened))
         # Sort df by sample
         df.sort_values(by=['Sample'], axis='index', ascending=True, inplace=True, ignore_index=True)
 
         # rename some columns
-        df.rename(columns={'Identity': '%-Identity', 'Query-ID': 'Accession', 'Query-Comment': 'Identification'},
-                  inplace=True)
+        df.rename(columns=Methods.summary_names, inplace=True)
 
         return df
 
+    @staticmethod
+    def write_summary_header(output_tsv, screened=False):
+        with open(output_tsv, 'w') as f:
+            f.write('\t'.join(Methods.summary_names.get(x, x) for x in Methods.get_summary_columns(screened)) + '\n')
+
+    @staticmethod
+    def append_summary_row(output_tsv, row, screened=False):
+        # Rows are added as samples complete so an interrupted run still has its results
+        with open(output_tsv, 'a') as f:
+            f.write('\t'.join(str(row[x]) for x in Methods.get_summary_columns(screened)) + '\n')
+
+    @staticmethod
+    def mash_screen_parallel(mash_db, output_folder, sample_dict, identity, p_value, cpu, mem, parallel, n_hit,
+                             sortby, cache=None, early_stop=None, max_bp=None, pool=None, output_tsv=None,
+                             tables=None):
+        """
+        Get the stats and screen all the samples. The stats and the screen of a sample are independent jobs that
+        start as soon as threads and memory are free in the shared pool, so there is no barrier between the two
+        stages. Jobs are sized from the size of the input files and of the database (see JobPlanner).
+        With "max_bp", the screen of a sample starts after its stats, which give the fraction of reads to keep.
+        A pool can be given to share the resources with other runs going at the same time (see mashID_server.py).
+        Rows are written to "output_tsv" (topID.tsv by default) as samples complete.
+        The hits table of each sample is also kept in "tables" if a dict is given.
+        """
+        if pool is None:
+            # Don't plan on memory that is already used by something else
+            pool = ResourcePool(cpu, min(mem, virtual_memory().available / 1000000000))
+        plan = JobPlanner.plan(sample_dict, Methods.get_db_size(mash_db), cpu, parallel)
+
+        def stats_job(sample, info_dict, submitted):
+            with pool.reserve(plan[sample]['stats_cpu'], plan[sample]['stats_mem']) as n_cpu:
+                with RunMetrics.stage(sample, 'stats', submitted, Methods.file_bytes(info_dict['path']), n_cpu):
+                    return Methods.get_stats(info_dict['path'], sample, n_cpu, cache)
+
+        def screen_job(sample, info_dict, submitted):
+            fraction = None
+            if max_bp and sum(info_dict['bp']) > max_bp:
+                fraction = max_bp / sum(info_dict['bp'])
+            with pool.reserve(plan[sample]['screen_cpu'], plan[sample]['screen_mem']) as n_cpu:
+                with RunMetrics.stage(sample, 'screen', submitted, Methods.file_bytes(info_dict['path']), n_cpu):
+                    return Methods.mash_screen(sample, mash_db, info_dict['path'], output_folder, identity,
+                                               p_value, n_cpu, n_hit, sortby, cache, early_stop, fraction)
+
+        screened = early_stop is not None or max_bp is not None
+        if output_tsv is None:
+            output_tsv = output_folder + '/topID.tsv'
+        Methods.write_summary_header(output_tsv, screened)
+
+        rows = list()
+        screen_results = dict()
+        stats_done = set()
+        # Enough workers for the pool to run many small jobs at once; the pool decides what actually runs
+        with futures.ThreadPoolExecutor(max_workers=min(2 * len(plan), max(2 * parallel, cpu))) as executor:
+            jobs = dict()
+            completed = queue.Queue()  # Jobs in completion order, without polling all the pending ones
+
+            def submit(stage, function, sample, submitted):
+                future = executor.submit(function, sample, sample_dict[sample], submitted)
+                jobs[future] = (stage, sample)
+                future.add_done_callback(completed.put)
+
+            for sample in plan:  # Largest samples first
+                submitted = time.perf_counter()  # For the queue wait of the metrics
+                submit('stats', stats_job, sample, submitted)
+                if not max_bp:
+                    submit('screen', screen_job, sample, submitted)
+
+            while jobs:
+                job = completed.get()
+                stage, sample = jobs.pop(job)
+                if stage == 'stats':
+                    _, sample_dict[sample]['reads'], sample_dict[sample]['bp'] = job.result()
+                    stats_done.add(sample)
+                    if max_bp:  # Screen depends on the stats
+                        submit('screen', screen_job, sample, time.perf_counter())
+                else:
+                    _, screen_results[sample], screen_counts = job.result()
+                    if screen_counts:
+                        sample_dict[sample]['screened_reads'] = screen_counts['reads']
+                        sample_dict[sample]['screened_bp'] = screen_counts['bp']
+
+                # Sample is complete when both its stats and screen are done
+                if sample in stats_done and sample in screen_results:
+                    df = screen_results.pop(sample)
+                    if tables is not None:
+                        tables[sample] = df
+                    rows.append(Methods.summary_row(sample, sample_dict[sample], df))
+                    Methods.append_summary_row(output_tsv, rows[-1], screened)
+
+        return Methods.summary_df(rows, screened)
+
     @staticmethod
     def species_from_header(header):
-        if header.startswith('['):
-            header_list = header.split()[2:]
-        else:
-            header_list = header.split()
-        genus = header_list[1]
-        species = header_list[2]
-
-        if 'variant' in header:
-            variant = header_list[4]
-            new_name = '{} {} variant {}'.format(genus, species, variant)
-        elif any(x in header for x in ['subsp', 'sub']):
-            subsp = header_list[4]
-            new_name = '{} {} subsp. {}'.format(genus, species, subsp)
-        else:
-            new_name = '{} {}'.format(genus, species)
-
-        return new_name
-
-    @staticmethod
-    def get_read_bp(seq_file):
-        total_reads = 0
-        total_bp = 0
-        with gzip.open(seq_file, 'rb', 1024 * 1024) if seq_file.endswith('.gz') \
-                else open(seq_file, 'r', 1024 * 1024) as f:
-            if any(x in seq_file for x in ['.fq', '.fastq']):  # if fastq
-                counter = 0
-                for line in f:
-                    counter += 1
-                    if counter == 2:
-                        line = line.rstrip()
-                        total_reads += 1
-                        total_bp += len(line)
-                    if counter == 4:
-                        counter = 0
-            else:  # if fasta
-                # Need to be tested
-                # https://www.biostars.org/p/710/#120760
-                faiter = (x[1] for x in groupby(f, lambda line: line[0] == ">"))
-                total_reads = len([x for x in faiter])
-                total_bp = sum([len("".join(s.strip() for s in faiter.__next__())) for header in faiter])
-
-        return total_reads, total_bp
-
-    @staticmethod
-    def get_stats(seq_file, sample, mem, cpu):
-        cmd = ['stats.sh',
-               '-Xmx{}g'.format(mem),
-               'in={}'.format(seq_file),
-               'threads={}'.format(cpu),
-               'format=2']
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-
-        reads = 0
-        bp = 0
-        for line in TextIOWrapper(p.stdout, encoding="utf-8"):
-            line = line.strip()
-            if 'Main genome contig total' in line:
-                reads = line.split(':')[1].split('\t')[1].strip()
-            if 'Main genome contig sequence total' in line:
-                bp = line.split(':')[1].split('\t')[1].split()[0]
-        return sample, reads, bp
+        # For databases without taxonomy table
+        return Taxonomy.parse_header(header)['Name']
 
     @staticmethod
-    def get_stats_parallel(sample_dict, mem, cpu, parallel):
-        with futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
-            args = ((info_dict['path'][0], sample, int(mem / parallel), int(cpu / parallel))
-                    for sample, info_dict in sample_dict.items())
-            for sample, reads, bp in executor.map(lambda x: Methods.get_stats(*x), args):
-                sample_dict[sample]['reads'].append(reads)
-                sample_dict[sample]['bp'].append(bp)
+    def get_read_bp(seq_file, cpu=1):
+        return SeqStats.count(seq_file, cpu)
+
+    @staticmethod
+    def get_stats(seq_files, sample, cpu, cache=None):
+        # Per file counts, in the same order as the sample's paths
+        reads = list()
+        bp = list()
+        for seq_file in seq_files:
+            if cache:
+                key = cache.stats_key(seq_file)
+                cached = cache.get(key)
+                if cached is not None:
+                    file_reads, file_bp = map(int, cached.split('\t'))
+                else:
+                    file_reads, file_bp = Methods.get_read_bp(seq_file, cpu)
+                    cache.put(key, '{}\t{}'.format(file_reads, file_bp))
+            else:
+                file_reads, file_bp = Methods.get_read_bp(seq_file, cpu)
+            reads.append(file_reads)
+            bp.append(file_bp)
+        return sample, reads, bp
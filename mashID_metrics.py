@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import psutil
+
+
+class RunMetrics(object):
+    """
+    Timings and resource use of each stage (discovery, stats, screen) of each sample, written as JSON lines, with
+    a summary of the run at the end. Wall and CPU time are measured in the thread running the stage and the child
+    processes it starts (mash, pigz, counting processes) are sampled with psutil for their CPU time, peak RSS and
+    bytes read. Queue wait is the time a job waited for threads and memory in the shared pool.
+    Nothing is recorded unless a run was started with RunMetrics.start().
+    """
+    active = None  # Metrics of the current run
+    sample_interval = 0.2  # Seconds between two samples of the child processes
+
+    def __init__(self, path, cpu, parallel):
+        self.path = path
+        self.cpu = cpu
+        self.parallel = parallel
+        self.handle = open(path, 'w')
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Stage record of each thread
+        self.records = list()
+        self.processes = dict()  # pid: (psutil.Process, stage record)
+        self.process = psutil.Process()
+        self.peak_rss = self.process.memory_info().rss
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = self.process.cpu_times()
+        self.stop = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+        self.sampler.start()
+
+    @staticmethod
+    def start(path, cpu, parallel):
+        RunMetrics.active = RunMetrics(path, cpu, parallel)
+        return RunMetrics.active
+
+    @staticmethod
+    def current():
+        metrics = RunMetrics.active
+        return getattr(metrics.local, 'record', None) if metrics else None
+
+    @staticmethod
+    @contextmanager
+    def stage(sample, stage, submitted=None, input_bytes=None, threads=None):
+        """
+        Record a stage of a sample. "submitted" is the time.perf_counter() when its job was queued.
+        """
+        metrics = RunMetrics.active
+        if metrics is None:
+            yield None
+            return
+
+        start = time.perf_counter()
+        record = {'sample': sample,
+                  'stage': stage,
+                  'start': round(time.time() - metrics.start_time, 3),
+                  'queue_wait': round(start - submitted, 3) if submitted is not None else 0.0,
+                  'threads': threads,
+                  'input_bytes': input_bytes,
+                  'child_cpu': dict(),  # pid: CPU time
+                  'child_peak_rss': 0,
+                  'child_read_bytes': dict()}  # pid: bytes read
+        start_cpu = time.thread_time()
+        with RunMetrics.attach(record):
+            try:
+                yield record
+            finally:
+                record['wall'] = round(time.perf_counter() - start, 3)
+                record['cpu'] = round(time.thread_time() - start_cpu, 3)
+                metrics.finish(record)
+
+    @staticmethod
+    @contextmanager
+    def attach(record):
+        # Child processes started by this thread count for "record" (e.g. stage running in several threads)
+        metrics = RunMetrics.active
+        if metrics is None or record is None:
+            yield
+            return
+        previous = getattr(metrics.local, 'record', None)
+        metrics.local.record = record
+        try:
+            yield
+        finally:
+            metrics.local.record = previous
+
+    @staticmethod
+    def track_process(pid):
+        record = RunMetrics.current()
+        if record is None:
+            return
+        metrics = RunMetrics.active
+        try:
+            process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+        with metrics.lock:
+            metrics.processes[pid] = (process, record)
+        metrics.sample_process(pid, process, record)
+
+    @staticmethod
+    def wait_process(p):
+        """
+        Wait for a tracked subprocess.Popen and record its final CPU time and peak RSS from its resource usage,
+        so the time since it was last sampled is counted too. Return its exit code.
+        """
+        metrics = RunMetrics.active
+        if metrics is None or p.returncode is not None or not hasattr(os, 'wait4'):
+            return p.wait()
+        with metrics.lock:
+            tracked = metrics.processes.get(p.pid)
+        if tracked is None:
+            return p.wait()
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+        except ChildProcessError:  # Already reaped
+            return p.wait()
+        p.returncode = os.waitstatus_to_exitcode(status)
+        record = tracked[1]
+        with metrics.lock:
+            metrics.processes.pop(p.pid, None)
+            record['child_cpu'][p.pid] = rusage.ru_utime + rusage.ru_stime
+            record['child_peak_rss'] = max(record['child_peak_rss'], rusage.ru_maxrss * 1024)  # KB on Linux
+        return p.returncode
+
+    @staticmethod
+    def sample_process(pid, process, record):
+        try:
+            with process.oneshot():
+                rss = process.memory_info().rss
+                cpu_times = process.cpu_times()
+                read_bytes = process.io_counters().read_chars if hasattr(process, 'io_counters') else None
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess, AttributeError):
+            return False
+        record['child_peak_rss'] = max(record['child_peak_rss'], rss)
+        # Never lower than the final reading of wait_process, if this sample was taken just before
+        record['child_cpu'][pid] = max(record['child_cpu'].get(pid, 0), cpu_times.user + cpu_times.system)
+        if read_bytes is not None:
+            record['child_read_bytes'][pid] = read_bytes
+        return True
+
+    def sample_loop(self):
+        while not self.stop.wait(RunMetrics.sample_interval):
+            try:
+                self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            except psutil.Error:
+                pass
+            with self.lock:
+                processes = list(self.processes.items())
+            for pid, (process, record) in processes:
+                if not RunMetrics.sample_process(pid, process, record):
+                    with self.lock:
+                        self.processes.pop(pid, None)  # Exited
+
+    def finish(self, record):
+        with self.lock:
+            for pid in [x for x, (_, y) in self.processes.items() if y is record]:
+                del self.processes[pid]
+        record['child_cpu'] = round(sum(record['child_cpu'].values()), 3)
+        record['child_read_bytes'] = sum(record['child_read_bytes'].values()) or None
+        self.write(record)
+
+    def write(self, record):
+        with self.lock:
+            self.records.append(record)
+            self.handle.write(json.dumps(record) + '\n')
+            self.handle.flush()
+
+    def summary(self):
+        """
+        Totals per stage and for the whole run. "cpu_efficiency" is the CPU time used over the CPU time available
+        (wall time times threads): low values mean threads were idle, e.g. --parallel could be raised.
+        """
+        wall = time.perf_counter() - self.start_wall
+        cpu_times = self.process.cpu_times()
+        cpu = sum(cpu_times[:4]) - sum(self.start_cpu[:4])  # Own and children user and system time
+        stages = dict()
+        for record in self.records:
+            stage = stages.setdefault(record['stage'], {'count': 0, 'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0,
+                                                        'queue_wait': 0.0, 'max_queue_wait': 0.0,
+                                                        'child_peak_rss': 0, 'child_read_bytes': 0})
+            stage['count'] += 1
+            stage['wall'] += record['wall']
+            stage['max_wall'] = max(stage['max_wall'], record['wall'])
+            stage['cpu'] += record['cpu'] + record['child_cpu']
+            stage['queue_wait'] += record['queue_wait']
+            stage['max_queue_wait'] = max(stage['max_queue_wait'], record['queue_wait'])
+            stage['child_peak_rss'] = max(stage['child_peak_rss'], record['child_peak_rss'])
+            stage['child_read_bytes'] += record['child_read_bytes'] or 0
+        for stage in stages.values():
+            for key in ('wall', 'max_wall', 'cpu', 'queue_wait', 'max_queue_wait'):
+                stage[key] = round(stage[key], 3)
+
+        return {'stage': 'run',
+                'wall': round(wall, 3),
+                'cpu': round(cpu, 3),
+                'threads': self.cpu,
+                'parallel': self.parallel,
+                'cpu_efficiency': round(cpu / (wall * self.cpu), 3) if wall > 0 else None,
+                'peak_rss': self.peak_rss,
+                'stages': stages}
+
+    def close(self):
+        self.stop.set()
+        self.sampler.join()
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        summary = self.summary()
+        self.write(summary)
+        self.handle.close()
+        RunMetrics.active = None
+
+        print('\nRun metrics ({}):'.format(os.path.basename(self.path)))
+        print('\tWall time: {}s, CPU time: {}s, CPU efficiency: {}, peak RSS: {:.1f} MB'.format(
+            summary['wall'], summary['cpu'], summary['cpu_efficiency'], summary['peak_rss'] / 1000000))
+        for name, stage in summary['stages'].items():
+            print('\t{}: {} job(s), {}s wall (max {}s), {}s CPU, {}s queue wait (max {}s)'.format(
+                name, stage['count'], stage['wall'], stage['max_wall'], stage['cpu'], stage['queue_wait'],
+                stage['max_queue_wait']))
+        return summary
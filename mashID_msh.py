@@ -0,0 +1,711 @@
+import os
+import sys
+import json
+import shutil
+import threading
+from argparse import ArgumentParser
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+__author__ = 'duceppemo'
+__version__ = '0.1.1'
+
+
+class MshReader(object):
+    """
+    Reader of the .msh sketch files written by mash (Cap'n Proto message, not packed). Only the fields needed to
+    screen are read: k-mer size, hash seed, alphabet and, for each reference, its name, comment, length and hashes.
+    Field positions follow mash's MinHash.capnp schema.
+    """
+    # MinHash struct
+    kmer_size_offset = 0  # UInt32 index in the data section
+    hash_seed_offset = 5  # UInt32 index, stored XOR its default value
+    hash_seed_default = 42
+    noncanonical_bit = 97
+    preserve_case_bit = 98
+    reference_list_old_ptr = 0
+    alphabet_ptr = 2
+    reference_list_ptr = 3
+    # Reference struct
+    length_offset = 0  # UInt32 index
+    length64_offset = 1  # UInt64 index
+    name_ptr = 2
+    comment_ptr = 3
+    hashes32_ptr = 4
+    hashes64_ptr = 5
+
+    def __init__(self, buf):
+        self.buf = buf
+        n_segments = int(np.frombuffer(buf, dtype='<u4', count=1)[0]) + 1
+        sizes = np.frombuffer(buf, dtype='<u4', count=n_segments, offset=4).astype(np.int64)
+        header = 4 + 4 * n_segments
+        header += header % 8  # Segments are word aligned
+        self.header = header
+        self.words = np.frombuffer(buf, dtype='<u8', count=int(sizes.sum()), offset=header)
+        self.bytes = self.words.view(np.uint8)
+        self.segment_starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    @staticmethod
+    def signed_offset(ptr):
+        offset = (ptr >> 2) & 0x3fffffff
+        return offset - (1 << 30) if offset & (1 << 29) else offset
+
+    def resolve(self, index):
+        """
+        Follow the pointer at word "index" (far pointers included). Return the pointer word describing the object
+        and the word index of its content, or None for a null pointer.
+        """
+        ptr = int(self.words[index])
+        if ptr == 0:
+            return None
+        if ptr & 3 == 2:  # Far pointer, to a landing pad in another segment
+            pad = int(self.segment_starts[ptr >> 32]) + ((ptr >> 3) & 0x1fffffff)
+            if not (ptr >> 2) & 1:
+                return self.resolve(pad)
+            far = int(self.words[pad])  # Double far: content position, then the tag describing it
+            tag = int(self.words[pad + 1])
+            return tag, int(self.segment_starts[far >> 32]) + ((far >> 3) & 0x1fffffff)
+        return ptr, index + 1 + MshReader.signed_offset(ptr)
+
+    def struct(self, index):
+        # (data start, data words, pointers start, pointer count)
+        resolved = self.resolve(index)
+        if resolved is None:
+            return None
+        ptr, start = resolved
+        data_words = (ptr >> 32) & 0xffff
+        return start, data_words, start + data_words, ptr >> 48
+
+    def list_bounds(self, index):
+        # (content start, element size code, element count)
+        resolved = self.resolve(index)
+        if resolved is None:
+            return None
+        ptr, start = resolved
+        return start, (ptr >> 32) & 7, ptr >> 35
+
+    def struct_list(self, index):
+        bounds = self.list_bounds(index)
+        if bounds is None:
+            return list()
+        start, size_code, _ = bounds
+        if size_code != 7:
+            raise Exception('Expected a list of structs in the sketch file.')
+        tag = int(self.words[start])
+        data_words = (tag >> 32) & 0xffff
+        ptr_count = tag >> 48
+        step = data_words + ptr_count
+        return [(start + 1 + i * step, data_words, start + 1 + i * step + data_words, ptr_count)
+                for i in range(MshReader.signed_offset(tag))]
+
+    def uint(self, struct, offset, size):
+        # Field of "size" bytes at index "offset" of the data section, 0 if the section is too small
+        start, data_words = struct[0], struct[1]
+        if (offset + 1) * size > data_words * 8:
+            return 0
+        position = start * 8 + offset * size
+        return int.from_bytes(self.bytes[position:position + size].tobytes(), 'little')
+
+    def bit(self, struct, offset):
+        start, data_words = struct[0], struct[1]
+        if offset >= data_words * 64:
+            return False
+        return bool(self.bytes[start * 8 + offset // 8] >> (offset % 8) & 1)
+
+    def pointer(self, struct, i):
+        return struct[2] + i if i < struct[3] else None
+
+    def text(self, struct, i):
+        index = self.pointer(struct, i)
+        bounds = None if index is None else self.list_bounds(index)
+        if bounds is None:
+            return ''
+        start, _, count = bounds
+        return self.bytes[start * 8:start * 8 + max(0, count - 1)].tobytes().decode()  # Drop the final NUL
+
+    def array(self, struct, i, dtype):
+        index = self.pointer(struct, i)
+        bounds = None if index is None else self.list_bounds(index)
+        if bounds is None:
+            return np.zeros(0, dtype=dtype)
+        start, _, count = bounds
+        return np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.header + start * 8)
+
+    def read(self):
+        """
+        Return the sketch parameters and, for each reference, its name, comment, length and hashes.
+        """
+        root = self.struct(0)
+        kmer_size = self.uint(root, MshReader.kmer_size_offset, 4)
+        use64 = kmer_size > 16  # Like mash
+        alphabet = self.text(root, MshReader.alphabet_ptr) or 'ACGT'
+
+        references = list()
+        for list_ptr in (MshReader.reference_list_ptr, MshReader.reference_list_old_ptr):
+            index = self.pointer(root, list_ptr)
+            reference_list = None if index is None else self.struct(index)
+            if reference_list is not None and reference_list[3]:
+                references = self.struct_list(reference_list[2])  # "references" is its first pointer
+            if references:
+                break
+
+        names, comments, lengths, hashes = list(), list(), list(), list()
+        for reference in references:
+            names.append(self.text(reference, MshReader.name_ptr))
+            comments.append(self.text(reference, MshReader.comment_ptr))
+            lengths.append(self.uint(reference, MshReader.length64_offset, 8)
+                           or self.uint(reference, MshReader.length_offset, 4))
+            if use64:
+                hashes.append(self.array(reference, MshReader.hashes64_ptr, '<u8'))
+            else:
+                hashes.append(self.array(reference, MshReader.hashes32_ptr, '<u4').astype(np.uint64))
+
+        return {'kmer_size': kmer_size,
+                'hash_seed': self.uint(root, MshReader.hash_seed_offset, 4) ^ MshReader.hash_seed_default,
+                'use64': use64,
+                'alphabet': alphabet,
+                'noncanonical': self.bit(root, MshReader.noncanonical_bit),
+                'preserve_case': self.bit(root, MshReader.preserve_case_bit),
+                'names': names,
+                'comments': comments,
+                'lengths': lengths,
+                'hashes': hashes}
+
+
+class MshWriter(object):
+    """
+    Writer of small .msh files (single segment Cap'n Proto message), e.g. synthetic databases for the benchmark
+    and the tests, or the selected shards of a tiered database for the native screen. Field positions and section
+    sizes come from MshReader, so both stay in line.
+    """
+    @staticmethod
+    def section_words(data_bytes):
+        return (data_bytes + 7) // 8
+
+    @staticmethod
+    def minhash_layout():
+        # (data words, pointers) of the MinHash struct
+        data_bytes = max((MshReader.kmer_size_offset + 1) * 4, (MshReader.hash_seed_offset + 1) * 4,
+                         MshReader.preserve_case_bit // 8 + 1, MshReader.noncanonical_bit // 8 + 1)
+        pointers = max(MshReader.reference_list_old_ptr, MshReader.alphabet_ptr, MshReader.reference_list_ptr) + 1
+        return MshWriter.section_words(data_bytes), pointers
+
+    @staticmethod
+    def reference_layout():
+        # (data words, pointers) of the Reference struct
+        data_bytes = max((MshReader.length_offset + 1) * 4, (MshReader.length64_offset + 1) * 8)
+        pointers = max(MshReader.name_ptr, MshReader.comment_ptr, MshReader.hashes32_ptr,
+                       MshReader.hashes64_ptr) + 1
+        return MshWriter.section_words(data_bytes), pointers
+
+    @staticmethod
+    def write(path, kmer_size, references, hash_seed=MshReader.hash_seed_default, alphabet='ACGT',
+              noncanonical=False, preserve_case=False):
+        """
+        Write (name, comment, length, hashes) references. Hashes are 64-bit when k > 16, like mash.
+        """
+        words = [0]  # Root pointer
+
+        def alloc(n):
+            words.extend([0] * n)
+            return len(words) - n
+
+        def point(at, content, bits, kind):
+            words[at] = kind | (((content - at - 1) & 0x3fffffff) << 2) | bits
+
+        def set_uint(start, offset, size, value):
+            position = start * 8 + offset * size
+            words[position // 8] |= (value & ((1 << (8 * size)) - 1)) << (8 * (position % 8))
+
+        def set_bit(start, offset, value):
+            if value:
+                words[start + offset // 64] |= 1 << (offset % 64)
+
+        def data_list(at, raw, size_code, count):
+            start = alloc(MshWriter.section_words(len(raw)))
+            raw = raw.ljust(MshWriter.section_words(len(raw)) * 8, b'\0')
+            words[start:start + len(raw) // 8] = np.frombuffer(raw, dtype='<u8').tolist()
+            point(at, start, (size_code << 32) | (count << 35), 1)
+
+        def text(at, value):
+            raw = value.encode() + b'\0'
+            data_list(at, raw, 2, len(raw))
+
+        data_words, pointers = MshWriter.minhash_layout()
+        root = alloc(data_words + pointers)
+        point(0, root, (data_words << 32) | (pointers << 48), 0)
+        set_uint(root, MshReader.kmer_size_offset, 4, kmer_size)
+        set_uint(root, MshReader.hash_seed_offset, 4, hash_seed ^ MshReader.hash_seed_default)
+        set_bit(root, MshReader.noncanonical_bit, noncanonical)
+        set_bit(root, MshReader.preserve_case_bit, preserve_case)
+        text(root + data_words + MshReader.alphabet_ptr, alphabet)
+
+        # ReferenceList struct, whose first pointer is the list of references
+        reference_list = alloc(1)
+        point(root + data_words + MshReader.reference_list_ptr, reference_list, 1 << 48, 0)
+        data_words, pointers = MshWriter.reference_layout()
+        step = data_words + pointers
+        tag = alloc(1 + len(references) * step)
+        words[tag] = (len(references) << 2) | (data_words << 32) | (pointers << 48)
+        point(reference_list, tag, (7 << 32) | ((len(references) * step) << 35), 1)
+        use64 = kmer_size > 16
+        for i, (name, comment, length, hashes) in enumerate(references):
+            reference = tag + 1 + i * step
+            set_uint(reference, MshReader.length_offset, 4, length)
+            set_uint(reference, MshReader.length64_offset, 8, length)
+            text(reference + data_words + MshReader.name_ptr, name)
+            text(reference + data_words + MshReader.comment_ptr, comment)
+            if use64:
+                data_list(reference + data_words + MshReader.hashes64_ptr,
+                          np.asarray(hashes, dtype='<u8').tobytes(), 5, len(hashes))
+            else:
+                data_list(reference + data_words + MshReader.hashes32_ptr,
+                          np.asarray(hashes, dtype='<u4').tobytes(), 4, len(hashes))
+
+        with open(path, 'wb') as f:
+            f.write(np.array([0, len(words)], dtype='<u4').tobytes())
+            f.write(np.array(words, dtype='<u8').tobytes())
+
+    @staticmethod
+    def paste(path, sketch_files):
+        """
+        Same as "mash paste": one file with the references of sketch files made with the same parameters.
+        """
+        references = list()
+        first = None
+        for sketch_file in sketch_files:
+            with open(sketch_file, 'rb') as f:
+                sketch = MshReader(f.read()).read()
+            parameters = {x: sketch[x] for x in ('kmer_size', 'hash_seed', 'alphabet', 'noncanonical',
+                                                 'preserve_case')}
+            if first is None:
+                first = parameters
+            elif parameters != first:
+                raise Exception('{} was not sketched with the same parameters as {}.'.format(
+                    sketch_file, sketch_files[0]))
+            references.extend(zip(sketch['names'], sketch['comments'], sketch['lengths'], sketch['hashes']))
+        MshWriter.write(path, first['kmer_size'], references, first['hash_seed'], first['alphabet'],
+                        first['noncanonical'], first['preserve_case'])
+
+
+class SketchDB(object):
+    """
+    Sketches of a .msh file as compact NumPy arrays:
+        hashes:      hashes of all the references, one after the other
+        offsets:     hashes of reference i are hashes[offsets[i]:offsets[i + 1]]
+        keys:        unique hashes of the database, sorted
+        ref_keys:    index in "keys" of each hash of "hashes"
+        inv_refs:    inverted index, references having each key, grouped by key...
+        inv_offsets: ...so the references of keys[j] are inv_refs[inv_offsets[j]:inv_offsets[j + 1]]
+    The arrays are saved as .npy files next to the .msh file and memory-mapped when loaded again, so a database
+    is only parsed once and its pages are shared by all the processes using it.
+    """
+    arrays = ['hashes', 'offsets', 'lengths', 'keys', 'ref_keys', 'inv_refs', 'inv_offsets']
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        for name in SketchDB.arrays:
+            setattr(self, name, arrays[name])
+        self.kmer_size = meta['kmer_size']
+        self.names = meta['names']
+        self.comments = meta['comments']
+        self.sizes = np.diff(self.offsets)
+        self.ref_of_hash = np.repeat(np.arange(len(self.names), dtype=np.int64), self.sizes)
+
+    @staticmethod
+    def cache_folder(msh_file):
+        return msh_file + '.npy'
+
+    @staticmethod
+    def source_state(msh_file):
+        stat = os.stat(msh_file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def build(sketch):
+        hashes = np.concatenate(sketch['hashes']) if sketch['hashes'] else np.zeros(0, dtype=np.uint64)
+        offsets = np.concatenate(([0], np.cumsum([len(x) for x in sketch['hashes']]))).astype(np.int64)
+        keys, ref_keys = np.unique(hashes, return_inverse=True)
+        ref_of_hash = np.repeat(np.arange(len(sketch['names']), dtype=np.int64), np.diff(offsets))
+        order = np.argsort(ref_keys, kind='stable')  # References stay in order within a key
+        inv_offsets = np.concatenate(([0], np.cumsum(np.bincount(ref_keys, minlength=len(keys))))).astype(np.int64)
+        return {'hashes': hashes.astype(np.uint64),
+                'offsets': offsets,
+                'lengths': np.array(sketch['lengths'], dtype=np.uint64),
+                'keys': keys.astype(np.uint64),
+                'ref_keys': ref_keys.astype(np.int64).ravel(),
+                'inv_refs': ref_of_hash[order],
+                'inv_offsets': inv_offsets}
+
+    @staticmethod
+    def save(folder, meta, arrays):
+        tmp_folder = '{}.{}.tmp'.format(folder, os.getpid())
+        os.makedirs(tmp_folder, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_folder, name + '.npy'), array)
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.replace(tmp_folder, folder)
+
+    @staticmethod
+    def load_cache(folder, msh_file):
+        try:
+            with open(os.path.join(folder, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta.get('source') != SketchDB.source_state(msh_file):
+            return None  # Database changed since the cache was made
+        arrays = {x: np.load(os.path.join(folder, x + '.npy'), mmap_mode='r') for x in SketchDB.arrays}
+        return SketchDB(meta, arrays)
+
+    @staticmethod
+    def load(msh_file, cache_folder=None):
+        """
+        Load a .msh file, from its NumPy cache if up to date. The cache is made if missing and the folder is
+        writable.
+        """
+        folder = cache_folder or SketchDB.cache_folder(msh_file)
+        db = SketchDB.load_cache(folder, msh_file)
+        if db is not None:
+            return db
+
+        with open(msh_file, 'rb') as f:
+            sketch = MshReader(f.read()).read()
+        arrays = SketchDB.build(sketch)
+        meta = {x: sketch[x] for x in sketch if x not in ('hashes', 'lengths')}
+        meta['source'] = SketchDB.source_state(msh_file)
+        try:
+            SketchDB.save(folder, meta, arrays)
+            return SketchDB.load_cache(folder, msh_file)
+        except OSError:
+            return SketchDB(meta, arrays)  # Read-only location, keep it in memory
+
+    def references_of(self, hash_value):
+        # Indices of the references having this hash
+        j = int(np.searchsorted(self.keys, np.uint64(hash_value)))
+        if j == len(self.keys) or self.keys[j] != np.uint64(hash_value):
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self.inv_refs[self.inv_offsets[j]:self.inv_offsets[j + 1]])
+
+
+class KmerHasher(object):
+    """
+    Vectorized k-mer hashing, identical to mash: upper case, k-mers with letters outside of the alphabet are
+    skipped, canonical k-mer is the smallest of the k-mer and its reverse complement and the hash is the first
+    64 bits of MurmurHash3_x64_128 (32 bits for k <= 16).
+    """
+    c1 = np.uint64(0x87c37b91114253d5)
+    c2 = np.uint64(0x4cf5ad432745937f)
+    complement = np.frombuffer(bytes.maketrans(b'ACGTacgt', b'TGCAtgca'), dtype=np.uint8)
+
+    @staticmethod
+    def rotl(x, r):
+        return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+    @staticmethod
+    def fmix(k):
+        k ^= k >> np.uint64(33)
+        k *= np.uint64(0xff51afd7ed558ccd)
+        k ^= k >> np.uint64(33)
+        k *= np.uint64(0xc4ceb9fe1a85ec53)
+        k ^= k >> np.uint64(33)
+        return k
+
+    @staticmethod
+    def little_endian(mat, start, stop):
+        # Bytes [start, stop) of each row as a little endian integer
+        value = np.zeros(mat.shape[0], dtype=np.uint64)
+        for i in range(start, stop):
+            value |= mat[:, i].astype(np.uint64) << np.uint64(8 * (i - start))
+        return value
+
+    @staticmethod
+    def murmur3(mat, seed):
+        """
+        MurmurHash3_x64_128 of each row of a (n, length) uint8 matrix. Return h1 and h2.
+        """
+        c1, c2 = KmerHasher.c1, KmerHasher.c2
+        n, length = mat.shape
+        h1 = np.full(n, seed, dtype=np.uint64)
+        h2 = np.full(n, seed, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for block in range(length // 16):
+                k1 = KmerHasher.little_endian(mat, block * 16, block * 16 + 8)
+                k2 = KmerHasher.little_endian(mat, block * 16 + 8, block * 16 + 16)
+                k1 *= c1
+                k1 = KmerHasher.rotl(k1, 31)
+                k1 *= c2
+                h1 ^= k1
+                h1 = KmerHasher.rotl(h1, 27)
+                h1 += h2
+                h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+                k2 *= c2
+                k2 = KmerHasher.rotl(k2, 33)
+                k2 *= c1
+                h2 ^= k2
+                h2 = KmerHasher.rotl(h2, 31)
+                h2 += h1
+                h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+            tail = length // 16 * 16
+            if length - tail > 8:
+                k2 = KmerHasher.little_endian(mat, tail + 8, length)
+                k2 *= c2
+                k2 = KmerHasher.rotl(k2, 33)
+                k2 *= c1
+                h2 ^= k2
+            if length - tail > 0:
+                k1 = KmerHasher.little_endian(mat, tail, min(tail + 8, length))
+                k1 *= c1
+                k1 = KmerHasher.rotl(k1, 31)
+                k1 *= c2
+                h1 ^= k1
+
+            h1 ^= np.uint64(length)
+            h2 ^= np.uint64(length)
+            h1 += h2
+            h2 += h1
+            h1 = KmerHasher.fmix(h1)
+            h2 = KmerHasher.fmix(h2)
+            h1 += h2
+            h2 += h1
+        return h1, h2
+
+    @staticmethod
+    def kmer_hashes(sequences, meta):
+        """
+        Hashes of all the valid k-mers of a list of sequences (bytes).
+        """
+        k = meta['kmer_size']
+        if not meta['preserve_case']:
+            sequences = [x.upper() for x in sequences]
+        buf = np.frombuffer(b'\n'.join(sequences), dtype=np.uint8)  # k-mers can't span two sequences
+        if buf.size < k:
+            return np.zeros(0, dtype=np.uint64)
+
+        valid = np.zeros(256, dtype=bool)
+        valid[np.frombuffer(meta['alphabet'].encode(), dtype=np.uint8)] = True
+        invalid = np.concatenate(([0], np.cumsum(~valid[buf])))
+        starts = np.flatnonzero(invalid[k:] - invalid[:-k] == 0)
+        if starts.size == 0:
+            return np.zeros(0, dtype=np.uint64)
+
+        kmers = sliding_window_view(buf, k)[starts]
+        if not meta['noncanonical']:
+            reverse = sliding_window_view(KmerHasher.complement[buf], k)[starts][:, ::-1]
+            diff = kmers != reverse
+            first = diff.argmax(axis=1)
+            rows = np.arange(kmers.shape[0])
+            forward = ~diff.any(axis=1) | (kmers[rows, first] < reverse[rows, first])
+            kmers = np.where(forward[:, None], kmers, reverse)
+        h1, _ = KmerHasher.murmur3(np.ascontiguousarray(kmers), meta['hash_seed'])
+        if not meta['use64']:
+            h1 &= np.uint64(0xffffffff)
+        return h1
+
+
+class NativeScreen(object):
+    """
+    In-process equivalent of "mash screen -w". Read k-mers are hashed in batches and counted against the hashes
+    of the database, then the identity, shared hashes, median multiplicity and p-value of each reference are
+    computed like mash does. Loaded databases are kept between samples.
+    """
+    batch_bp = 1000000  # Sequence processed at once
+    databases = dict()  # Path: SketchDB
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_db(msh_file):
+        with NativeScreen.lock:
+            db = NativeScreen.databases.get(msh_file)
+            if db is None or db.meta['source'] != SketchDB.source_state(msh_file):
+                db = SketchDB.load(msh_file)
+                NativeScreen.databases[msh_file] = db
+            return db
+
+    @staticmethod
+    def sequences(record):
+        # Sequence of a fastq or fasta record
+        lines = record.split(b'\n')
+        if record.startswith(b'@'):
+            return lines[1].rstrip(b'\r')
+        return b''.join(x.rstrip(b'\r') for x in lines[1:])
+
+    @staticmethod
+    def count_hashes(db, records):
+        # Number of times each key of the database is seen in the reads
+        counts = np.zeros(len(db.keys), dtype=np.uint32)
+        batch, batch_bp = list(), 0
+        for record, bp in NativeScreen.with_end(records):
+            if record is not None:
+                batch.append(NativeScreen.sequences(record))
+                batch_bp += bp
+            if batch and (record is None or batch_bp >= NativeScreen.batch_bp):
+                hashes = KmerHasher.kmer_hashes(batch, db.meta)
+                j = np.searchsorted(db.keys, hashes)
+                j[j == len(db.keys)] = 0
+                j = j[db.keys[j] == hashes]
+                keys, key_counts = np.unique(j, return_counts=True)
+                counts[keys] += key_counts.astype(np.uint32)
+                batch, batch_bp = list(), 0
+        return counts
+
+    @staticmethod
+    def with_end(records):
+        # Records followed by an end marker, so the last batch is processed
+        yield from records
+        yield None, 0
+
+    @staticmethod
+    def identity(shared, total, k):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ident = np.power(shared / np.maximum(total, 1), 1.0 / k)
+        ident[shared == 0] = 0.0
+        ident[shared == total] = 1.0
+        return ident
+
+    @staticmethod
+    def p_value(shared, total, length, k, alphabet_size):
+        """
+        Probability to share at least "shared" hashes by chance, binomial upper tail like mash.
+        """
+        if shared == 0:
+            return 1.0
+        r = 1.0 / (1.0 + float(alphabet_size) ** k / max(1, length))
+        j = np.arange(shared, total + 1)
+        log_fact = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, total + 1)))))
+        logs = log_fact[total] - log_fact[j] - log_fact[total - j] + j * np.log(r) + (total - j) * np.log1p(-r)
+        top = logs.max()
+        return float(min(1.0, np.exp(top) * np.exp(logs - top).sum()))
+
+    @staticmethod
+    def screen(db, records, identity, p_value, winner_take_all=True):
+        """
+        Return mash screen output lines: identity, shared hashes, median multiplicity, p-value, query ID and
+        query comment.
+        """
+        counts = NativeScreen.count_hashes(db, records)
+        k = db.kmer_size
+        present = counts[db.ref_keys] > 0
+        shared = np.bincount(db.ref_of_hash[present], minlength=len(db.names))
+        ident = NativeScreen.identity(shared, db.sizes, k)
+
+        if winner_take_all:
+            # Each hash goes to the reference with the highest identity that has it, the longest one if tied (as
+            # mash screen -w), then the first one
+            key_of_entry = np.repeat(np.arange(len(db.keys), dtype=np.int64), np.diff(db.inv_offsets))
+            entries = np.flatnonzero(counts[key_of_entry] > 0)
+            refs = np.asarray(db.inv_refs)[entries]
+            keys = key_of_entry[entries]
+            order = np.lexsort((refs, -np.asarray(db.lengths, dtype=np.int64)[refs], -ident[refs], keys))
+            first = np.concatenate(([True], keys[order][1:] != keys[order][:-1])) if order.size else order
+            winners = np.zeros(len(db.keys), dtype=np.int64)
+            winners[keys[order][first]] = refs[order][first]
+            present &= winners[db.ref_keys] == db.ref_of_hash
+            shared = np.bincount(db.ref_of_hash[present], minlength=len(db.names))
+            ident = NativeScreen.identity(shared, db.sizes, k)
+
+        lines = list()
+        for i in np.flatnonzero((ident >= identity) & (shared > 0)):
+            start, stop = db.offsets[i], db.offsets[i + 1]
+            depths = np.sort(counts[db.ref_keys[start:stop]][present[start:stop]])
+            p = NativeScreen.p_value(int(shared[i]), int(db.sizes[i]), int(db.lengths[i]), k,
+                                     len(db.meta['alphabet']))
+            if p > p_value:
+                continue
+            lines.append('{:g}\t{}/{}\t{}\t{:g}\t{}\t{}\n'.format(ident[i], shared[i], db.sizes[i],
+                                                                 depths[len(depths) // 2], p, db.names[i],
+                                                                 db.comments[i]))
+        return lines
+
+    @staticmethod
+    def screen_lines(msh_file, records, identity, p_value):
+        return NativeScreen.screen(NativeScreen.get_db(msh_file), records, identity, p_value)
+
+
+def compare(args):
+    """
+    Screen the same input with mash and with the native engine and report the differences.
+    """
+    import pandas as pd
+    from mashID_methods import Methods  # mashID_methods imports this module
+
+    outputs = dict()
+    for backend in ('mash', 'native'):
+        Methods.backend = backend
+        returncodes = list()
+        lines = list(Methods.stream_mash_screen_db(args.database, args.input, args.identity, args.p_value,
+                                                   args.threads, returncodes))
+        if any(returncodes):
+            raise Exception('mash screen failed.')
+        outputs[backend] = pd.DataFrame([x.rstrip('\n').split('\t', 5) for x in lines],
+                                        columns=['Identity', 'Shared-Hashes', 'Median-Multiplicity', 'P-Value',
+                                                 'Query-ID', 'Query-Comment'])
+
+    df = outputs['mash'].merge(outputs['native'], on='Query-ID', how='outer', suffixes=('-mash', '-native'))
+    columns = ['Identity', 'Shared-Hashes', 'Median-Multiplicity']
+    same = np.ones(len(df), dtype=bool)
+    for column in columns:
+        a, b = df[column + '-mash'], df[column + '-native']
+        if column == 'Shared-Hashes':
+            same &= (a == b).to_numpy()
+        else:
+            same &= np.isclose(pd.to_numeric(a), pd.to_numeric(b), atol=float(args.tolerance)).tolist()
+    print(df[['Query-ID'] + [x + y for x in columns for y in ('-mash', '-native')]].to_string(index=False))
+    print('\n{} of {} hits identical.'.format(int(same.sum()), len(df)))
+    return bool(same.all())
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Read mash sketch files (.msh) and screen reads without mash.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    info_parser = subparsers.add_parser('info', help='Print the content of a sketch file.')
+    info_parser.add_argument('-d', '--database', metavar='/path/to/mash_databse.msh',
+                             type=str, required=True,
+                             help='Mash sketch file.')
+
+    index_parser = subparsers.add_parser('index', help='Make the NumPy cache of a sketch file.')
+    index_parser.add_argument('-d', '--database', metavar='/path/to/mash_databse.msh',
+                              type=str, required=True,
+                              help='Mash sketch file.')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare the mash and native screens of a sample.')
+    compare_parser.add_argument('-d', '--database', metavar='/path/to/mash_databse.msh',
+                                type=str, required=True,
+                                help='Mash sketch file.')
+    compare_parser.add_argument('-i', '--input', metavar='sample.fastq.gz',
+                                type=str, nargs='+', required=True,
+                                help='Sequence file(s) of a sample.')
+    compare_parser.add_argument('--identity', metavar='0.9',
+                                type=float, default=0.9, required=False,
+                                help='Minimum identity to report. [0-1]. Default is 0.9')
+    compare_parser.add_argument('--p-value', metavar='0.05',
+                                type=float, default=0.05, required=False,
+                                help='Maximum p-value to report')
+    compare_parser.add_argument('--tolerance', metavar='0',
+                                type=float, default=0, required=False,
+                                help='Maximum difference of identity and multiplicity. Default is 0. Optional.')
+    compare_parser.add_argument('-t', '--threads', metavar='1',
+                                type=int, default=1, required=False,
+                                help='Number of threads for mash. Default is 1. Optional.')
+    parser.add_argument('-v', '--version', action='version',
+                        version=f'{os.path.basename(__file__)}: version {__version__}')
+
+    arguments = parser.parse_args()
+    if arguments.command == 'info':
+        sketch_db = SketchDB.load(os.path.abspath(arguments.database))
+        print('k-mer size: {}\nHash seed: {}\nAlphabet: {}\nReferences: {}\nUnique hashes: {}'.format(
+            sketch_db.kmer_size, sketch_db.meta['hash_seed'], sketch_db.meta['alphabet'], len(sketch_db.names),
+            len(sketch_db.keys)))
+        for name, comment, size in zip(sketch_db.names, sketch_db.comments, sketch_db.sizes):
+            print('{}\t{}\t{}'.format(name, size, comment))
+    elif arguments.command == 'index':
+        SketchDB.load(os.path.abspath(arguments.database))
+    else:
+        if not compare(arguments):
+            sys.exit(1)
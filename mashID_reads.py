@@ -0,0 +1,84 @@
+from itertools import islice
+from mashID_stats import SeqStats
+
+
+class ReadStream(object):
+    """
+    Stream the reads (fastq) or contigs (fasta) of a sample, to feed mash screen through its standard input.
+    """
+    buffer_size = 1024 * 1024
+
+    @staticmethod
+    def open_file(seq_file, cpu=1):
+        if seq_file.endswith('.gz'):
+            return SeqStats.open_decompressed(seq_file, cpu)
+        else:
+            return open(seq_file, 'rb', ReadStream.buffer_size)
+
+    @staticmethod
+    def fastq_records(f):
+        while True:
+            header = f.readline()
+            if not header:
+                break
+            seq = f.readline()
+            plus = f.readline()
+            qual = f.readline()
+            yield header + seq + plus + qual, len(seq.rstrip())
+
+    @staticmethod
+    def fasta_records(f):
+        record = list()
+        length = 0
+        for line in f:
+            if line.startswith(b'>'):
+                if record:
+                    yield b''.join(record), length
+                record = [line]
+                length = 0
+            elif record:
+                record.append(line)
+                length += len(line.rstrip())
+        if record:
+            yield b''.join(record), length
+
+    @staticmethod
+    def all_records(seq_files, cpu=1):
+        for seq_file in seq_files:
+            with ReadStream.open_file(seq_file, cpu) as f:
+                if SeqStats.is_fastq(seq_file):
+                    yield from ReadStream.fastq_records(f)
+                else:
+                    yield from ReadStream.fasta_records(f)
+
+    @staticmethod
+    def records(seq_files, cpu=1, fraction=None):
+        """
+        Yield (record, bp) for the records of the files of a sample, in order. If a fraction is given, records are
+        evenly subsampled with a fixed stride (e.g. one in four for 0.25), so the result is reproducible.
+        """
+        if fraction is None or fraction >= 1:
+            yield from ReadStream.all_records(seq_files, cpu)
+            return
+
+        position = 0.0
+        for record, bp in ReadStream.all_records(seq_files, cpu):
+            position += fraction
+            if position >= 1:
+                position -= 1
+                yield record, bp
+
+    @staticmethod
+    def head(seq_files, n, counts, cpu=1, fraction=None):
+        """
+        First n records (all if None) of a sample, subsampled to "fraction" if given. The number of records and bp
+        actually given is stored in "counts" once they were all given (several mash processes, one per shard, may
+        read the same records).
+        """
+        reads = 0
+        total_bp = 0
+        for record, bp in islice(ReadStream.records(seq_files, cpu, fraction), n):
+            reads += 1
+            total_bp += bp
+            yield record, bp
+        counts.update({'reads': reads, 'bp': total_bp})
@@ -0,0 +1,116 @@
+import os
+import threading
+import itertools
+from contextlib import contextmanager
+from mashID_stats import SeqStats
+
+
+class ResourcePool(object):
+    """
+    Pool of threads and memory (GB) shared by all the stages (stats, screen) of all the samples.
+    A job waits until enough threads and memory are free and gives them back as soon as it is done, so resources
+    freed by a stage are immediately picked up by the next job, whatever its stage.
+    Jobs are admitted in the order they asked, so a large job can't be starved by a stream of small ones and
+    several large jobs never run at once if their memory doesn't fit.
+    """
+    def __init__(self, cpu, mem=None):
+        self.cpu = max(1, cpu)
+        self.mem = mem  # None means memory is not tracked
+        self.free_cpu = self.cpu
+        self.free_mem = mem
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+        self.next_ticket = 0
+
+    def clamp(self, cpu, mem):
+        cpu = min(max(1, cpu), self.cpu)  # A job can't ask for more than the pool
+        if self.mem is None:
+            mem = 0
+        else:
+            mem = min(max(0, mem), self.mem)
+        return cpu, mem
+
+    def fits(self, cpu, mem):
+        return self.free_cpu >= cpu and (self.mem is None or self.free_mem >= mem)
+
+    def acquire(self, cpu, mem=0):
+        cpu, mem = self.clamp(cpu, mem)
+        with self.condition:
+            ticket = next(self.tickets)
+            self.condition.wait_for(lambda: ticket == self.next_ticket and self.fits(cpu, mem))
+            self.free_cpu -= cpu
+            if self.mem is not None:
+                self.free_mem -= mem
+            self.next_ticket += 1
+            self.condition.notify_all()  # Next in line may fit too
+        return cpu, mem
+
+    def release(self, cpu, mem=0):
+        with self.condition:
+            self.free_cpu += cpu
+            if self.mem is not None:
+                self.free_mem += mem
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, cpu, mem=0):
+        cpu, mem = self.acquire(cpu, mem)
+        try:
+            yield cpu
+        finally:
+            self.release(cpu, mem)
+
+
+class JobPlanner(object):
+    """
+    Estimate the cost of the stats and screen jobs of each sample from the size of its files and of the database,
+    and size the jobs accordingly. A sample of average size gets "cpu / parallel" threads like before, larger
+    samples get proportionally more and small samples a single thread, so many of them run side by side.
+    """
+    gz_ratio = 4.0  # Expected size of uncompressed fastq/fasta vs gzipped
+    stats_mem_per_cpu = 0.3  # GB, numpy buffers of one counting process
+    screen_db_factor = 6.0  # mash screen memory vs .msh file size (sketches plus hash table)
+    screen_base_mem = 0.2  # GB
+
+    @staticmethod
+    def input_bytes(paths):
+        size = 0
+        for seq_file in paths:
+            file_size = os.path.getsize(seq_file)
+            size += file_size * JobPlanner.gz_ratio if seq_file.endswith('.gz') else file_size
+        return size
+
+    @staticmethod
+    def share_cpu(cost, mean_cost, cpu, parallel):
+        if mean_cost == 0:
+            return 1
+        return int(min(cpu, max(1, round(cpu * cost / (mean_cost * parallel)))))
+
+    @staticmethod
+    def plan(sample_dict, db_size, cpu, parallel):
+        """
+        Return a dictionary with the cost, threads and memory (GB) of the stats and screen jobs of each sample,
+        ordered from the largest to the smallest sample (largest first shortens the total run time).
+        """
+        costs = {sample: JobPlanner.input_bytes(info_dict['path']) for sample, info_dict in sample_dict.items()}
+        mean_cost = sum(costs.values()) / len(costs) if costs else 0
+        parallel = max(1, min(parallel, len(costs)))
+
+        plan = dict()
+        for sample in sorted(costs, key=lambda x: costs[x], reverse=True):
+            cost = costs[sample]
+            stats_cpu = JobPlanner.share_cpu(cost, mean_cost, cpu, parallel)
+            if any(x.endswith('.gz') for x in sample_dict[sample]['path']) \
+                    or cost < SeqStats.min_split_size:
+                stats_mem = JobPlanner.stats_mem_per_cpu  # Single process
+            else:
+                stats_mem = JobPlanner.stats_mem_per_cpu * stats_cpu
+            screen_cpu = JobPlanner.share_cpu(cost + db_size, mean_cost + db_size, cpu, parallel)
+            screen_mem = JobPlanner.screen_base_mem + JobPlanner.screen_db_factor * db_size / 1000000000
+
+            plan[sample] = {'cost': cost,
+                            'stats_cpu': stats_cpu,
+                            'stats_mem': stats_mem,
+                            'screen_cpu': screen_cpu,
+                            'screen_mem': screen_mem}
+        return plan
@@ -0,0 +1,398 @@
+import os
+import sys
+import json
+import mmap
+import time
+import queue
+import threading
+import itertools
+import urllib.error
+import urllib.request
+from argparse import ArgumentParser
+from concurrent import futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import cpu_count
+import numpy as np
+import pandas as pd
+import pkg_resources
+from psutil import virtual_memory
+from mashID_methods import Methods
+from mashID_cache import ResultCache
+from mashID_scheduler import ResourcePool
+
+
+__author__ = 'duceppemo'
+__version__ = '0.1.1'
+
+
+class DatabaseWarmer(object):
+    """
+    Keep the database files memory-mapped and paged in, so every mash screen reads them from memory instead of
+    the disk. Files are mapped again if they change (e.g. the database was rebuilt).
+    """
+    def __init__(self, mash_db):
+        self.mash_db = mash_db
+        self.maps = dict()  # Path: (size, mtime, file, mmap)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def touch(mm):
+        # Read one byte per page so the whole file is in the page cache
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+            mm.madvise(mmap.MADV_WILLNEED)
+        pages = np.frombuffer(mm, dtype=np.uint8)[::mmap.PAGESIZE]
+        try:
+            return int(pages.sum())
+        finally:
+            del pages  # Release the buffer before the mmap is closed
+
+    def warm(self):
+        with self.lock:
+            for db_file in Methods.get_db_files(self.mash_db):
+                stat = os.stat(db_file)
+                state = self.maps.get(db_file)
+                if state and state[:2] == (stat.st_size, stat.st_mtime_ns):
+                    DatabaseWarmer.touch(state[3])  # Cheap when still in memory
+                    continue
+                if state:
+                    DatabaseWarmer.release(state)
+                if stat.st_size == 0:
+                    continue
+                f = open(db_file, 'rb')
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[db_file] = (stat.st_size, stat.st_mtime_ns, f, mm)
+                DatabaseWarmer.touch(mm)
+
+    @staticmethod
+    def release(state):
+        state[3].close()
+        state[2].close()
+
+    def close(self):
+        with self.lock:
+            for state in self.maps.values():
+                DatabaseWarmer.release(state)
+            self.maps = dict()
+
+
+class IdentificationService(object):
+    """
+    Queue of identification jobs run by a single long-running process. Each job starts as soon as it is taken
+    from the queue, and all the running jobs share a pool of threads and memory, with the database kept warm.
+    Each job writes the same outputs as mashID.py in its own output folder. Finished jobs are forgotten after
+    "job_ttl" seconds, or sooner when more than "max_finished" of them are kept (the outputs stay on disk).
+    """
+    defaults = {'identity': 0.9,
+                'p_value': 0.05,
+                'n_hits': 10,
+                'sort_by': 'identity',
+                'early_stop': None,
+                'max_bp': None}
+
+    def __init__(self, mash_db, cpu, mem, parallel, cache=None, max_jobs=8, job_ttl=3600, max_finished=100):
+        self.mash_db = mash_db
+        self.cpu, self.parallel = Methods.check_cpus(cpu, parallel)
+        self.mem = Methods.check_mem(mem)
+        self.cache = cache
+        self.job_ttl = job_ttl
+        self.max_finished = max_finished
+
+        self.pool = ResourcePool(self.cpu, self.mem)
+        self.warmer = DatabaseWarmer(mash_db)
+        self.queue = queue.Queue()
+        self.jobs = dict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # Maximum number of jobs run at the same time, the pool decides what actually runs
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_jobs)
+
+        self.warmer.warm()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def submit(self, params):
+        unknown = set(params) - set(IdentificationService.defaults) - {'input', 'output'}
+        if unknown:
+            raise Exception('Unknown job parameter(s): {}'.format(', '.join(sorted(unknown))))
+        if 'input' not in params or 'output' not in params:
+            raise Exception('A job needs an "input" and an "output".')
+        job = dict(IdentificationService.defaults, **params)
+        job['input'] = os.path.abspath(job['input'])
+        job['output'] = os.path.abspath(job['output'])
+        if not os.path.exists(job['input']):
+            raise Exception('Input {} does not exist.'.format(job['input']))
+        Methods.check_identity_range(job['identity'])
+        Methods.check_p_value(job['p_value'])
+
+        with self.lock:
+            self.evict()
+            job['id'] = str(next(self.ids))
+            job['status'] = 'queued'
+            job['submitted'] = time.time()
+            self.jobs[job['id']] = job
+        self.queue.put(job['id'])
+        return self.get(job['id'])
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self.lock:
+            self.evict()
+            return [{'id': x['id'], 'status': x['status']} for x in self.jobs.values()]
+
+    def set(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+            if 'finished' in values:
+                self.evict()
+
+    def evict(self):
+        # Called with the lock held. Oldest finished jobs first
+        finished = sorted((x for x in self.jobs.values() if 'finished' in x), key=lambda x: x['finished'])
+        expired = time.time() - self.job_ttl
+        n_extra = len(finished) - self.max_finished
+        for i, job in enumerate(finished):
+            if i < n_extra or job['finished'] < expired:
+                del self.jobs[job['id']]
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()  # Wait for a job
+            self.warmer.warm()
+            self.executor.submit(self.run_job, job_id)
+
+    def run_job(self, job_id):
+        self.set(job_id, status='running', started=time.time())
+        job = self.get(job_id)
+        try:
+            Methods.make_folder(job['output'])
+            sample_dict = Methods.get_files(job['input'])
+            hit_tables = dict()
+            samples_df = Methods.mash_screen_parallel(self.mash_db, job['output'], sample_dict,
+                                                      job['identity'], job['p_value'], self.cpu, self.mem,
+                                                      self.parallel, job['n_hits'], job['sort_by'], self.cache,
+                                                      job['early_stop'], job['max_bp'], self.pool,
+                                                      tables=hit_tables)
+            output_tsv = job['output'] + '/topID.tsv'
+            samples_df.to_csv(output_tsv + '.tmp', sep="\t", index=False)
+            os.replace(output_tsv + '.tmp', output_tsv)
+
+            # Same columns as the <sample>_mashID.tsv files
+            tables = {x: json.loads(df.reset_index().to_json(orient='records')) for x, df in hit_tables.items()}
+            self.set(job_id, status='done', finished=time.time(),
+                     summary=json.loads(samples_df.to_json(orient='records')), tables=tables)
+        except Exception as e:
+            self.set(job_id, status='failed', finished=time.time(), error=str(e))
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    JSON API:
+        POST /jobs          {"input": ..., "output": ..., "identity": ..., ...} -> job
+        GET  /jobs          -> list of jobs and their status
+        GET  /jobs/<id>     -> job, with the summary and per-sample tables once done
+        GET  /health        -> database and queue state
+    """
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.rstrip('/')
+        if path == '/health':
+            self.reply(200, {'database': service.mash_db, 'queued': service.queue.qsize()})
+        elif path == '/jobs':
+            self.reply(200, service.list())
+        elif path.startswith('/jobs/'):
+            job = service.get(path.split('/')[-1])
+            if job is None:
+                self.reply(404, {'error': 'No such job'})
+            else:
+                self.reply(200, job)
+        else:
+            self.reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.reply(404, {'error': 'Not found'})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self.reply(202, self.server.service.submit(params))
+        except Exception as e:
+            self.reply(400, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass  # Jobs are reported by the service
+
+
+class ServiceClient(object):
+    """
+    Client of a running identification service.
+    """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise Exception(json.loads(e.read()).get('error', str(e)))
+
+    def submit(self, input_path, output_folder, **params):
+        params.update({'input': os.path.abspath(input_path), 'output': os.path.abspath(output_folder)})
+        return self.request('/jobs', params)
+
+    def status(self, job_id):
+        return self.request('/jobs/' + job_id)
+
+    def wait(self, job_id, interval=1.0):
+        while True:
+            job = self.status(job_id)
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(interval)
+
+
+def serve(args):
+    if args.database:
+        mash_db = os.path.abspath(args.database)
+    else:  # use the default Mycobacteria DB
+        mash_db = pkg_resources.resource_filename('dependencies', 'mycobacteria_mash_sketches.msh')
+    cache = ResultCache(os.path.abspath(args.cache), args.cache_size) if args.cache else None
+    Methods.backend = args.backend
+
+    service = IdentificationService(mash_db, args.threads, args.memory, args.parallel, cache,
+                                    args.max_jobs, args.job_ttl, args.max_finished)
+    server = ThreadingHTTPServer((args.host, args.port), JobHandler)
+    server.service = service
+    print('Serving {} on http://{}:{}'.format(mash_db, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.executor.shutdown(wait=False)
+        service.warmer.close()
+
+
+def submit(args):
+    client = ServiceClient(args.url)
+    params = {'identity': args.identity, 'p_value': args.p_value, 'n_hits': args.n_hits, 'sort_by': args.sort_by,
+              'early_stop': args.early_stop, 'max_bp': args.max_bp}
+    job = client.submit(args.input, args.output, **params)
+    print('Job {} {}'.format(job['id'], job['status']))
+    if args.wait:
+        job = client.wait(job['id'])
+        if job['status'] == 'failed':
+            raise Exception('Job {} failed: {}'.format(job['id'], job['error']))
+        print('\nIdentification results:\n')
+        print(pd.DataFrame(job['summary']).to_string(index=False, justify='left'))
+
+
+if __name__ == "__main__":
+    max_cpu = cpu_count()
+    max_mem = int(virtual_memory().total * 0.85 / 1000000000)  # in GB
+
+    parser = ArgumentParser(description='Run mashID as a local service that keeps the database warm, and submit '
+                                        'jobs to it.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Start the service.')
+    serve_parser.add_argument('-d', '--database', metavar='/path/to/mash_databse.msh',
+                              help='Mash sketch database, or the "_shards.json" manifest of a sharded database. '
+                                   'Will run a Mycobacteria mash database by default.',
+                              type=str, required=False)
+    serve_parser.add_argument('--host', metavar='127.0.0.1',
+                              type=str, default='127.0.0.1', required=False,
+                              help='Address to listen on. Default is 127.0.0.1 (local only). Optional.')
+    serve_parser.add_argument('--port', metavar='8765',
+                              type=int, default=8765, required=False,
+                              help='Port to listen on. Default is 8765. Optional.')
+    serve_parser.add_argument('-t', '--threads', metavar=str(max_cpu),
+                              type=int, default=max_cpu, required=False,
+                              help='Number of threads shared by all the jobs. Default is maximum available({}). '
+                                   'Optional.'.format(max_cpu))
+    serve_parser.add_argument('-p', '--parallel', metavar='2',
+                              type=int, default=2, required=False,
+                              help='Typical number of samples to process in parallel per job. Default is 2. '
+                                   'Optional.')
+    serve_parser.add_argument('-m', '--memory', metavar=str(max_mem),
+                              type=int, default=max_mem, required=False,
+                              help='Memory in GB shared by all the jobs. Default is 85%% of total memory ({})'.format(
+                                  max_mem))
+    serve_parser.add_argument('--backend', choices=['mash', 'native'],
+                              default='mash', required=False, type=str,
+                              help='Screen with mash, or in-process with the NumPy engine of mashID_msh.py. '
+                                   'Default is "mash". Optional.')
+    serve_parser.add_argument('--max-jobs', metavar='8',
+                              type=int, default=8, required=False,
+                              help='Maximum number of jobs run at the same time. Default is 8. Optional.')
+    serve_parser.add_argument('--job-ttl', metavar='3600',
+                              type=float, default=3600, required=False,
+                              help='Seconds a finished job and its results are kept by the service. '
+                                   'Default is 3600. Optional.')
+    serve_parser.add_argument('--max-finished', metavar='100',
+                              type=int, default=100, required=False,
+                              help='Maximum number of finished jobs kept by the service. Default is 100. Optional.')
+    serve_parser.add_argument('--cache', metavar='/cache/folder/',
+                              type=str, required=False,
+                              help='Folder to cache the mash screen results and file stats. Optional.')
+    serve_parser.add_argument('--cache-size', metavar='10',
+                              type=float, default=10, required=False,
+                              help='Maximum size of the cache in GB. Default is 10. Optional.')
+
+    submit_parser = subparsers.add_parser('submit', help='Submit a job to a running service.')
+    submit_parser.add_argument('--url', metavar='http://127.0.0.1:8765',
+                               type=str, default='http://127.0.0.1:8765', required=False,
+                               help='Address of the service. Default is http://127.0.0.1:8765. Optional.')
+    submit_parser.add_argument('-i', '--input', metavar='/input/folder/',
+                               help='Input directory with fastq/fasta files or a single fastq/fasta file, gzipped '
+                                    'or not.',
+                               type=str, required=True)
+    submit_parser.add_argument('-o', '--output', metavar='/output/folder/',
+                               help='Output directory',
+                               type=str, required=True)
+    submit_parser.add_argument('--identity', metavar='0.9',
+                               help='Minimum identity to report. [0-1]. Default is 0.9',
+                               type=float, default=0.9, required=False)
+    submit_parser.add_argument('--p-value', metavar='0.05',
+                               help='Maximum p-value to report',
+                               type=float, default=0.05, required=False)
+    submit_parser.add_argument('-n', '--n-hits', metavar='10',
+                               help='Number of top-hits to report. Default is 10.',
+                               type=int, default=10, required=False)
+    submit_parser.add_argument('-s', '--sort-by', choices=['identity', 'multiplicity'],
+                               default='identity', required=False, type=str,
+                               help='How to sort the result tables. Default is "identity". Optional.')
+    submit_parser.add_argument('--early-stop', metavar='10000',
+                               type=int, const=10000, nargs='?', required=False,
+                               help='Same as mashID.py. Optional.')
+    submit_parser.add_argument('--max-bp', metavar='500000000',
+                               type=int, required=False,
+                               help='Same as mashID.py. Optional.')
+    submit_parser.add_argument('--wait', action='store_true',
+                               help='Wait for the job to finish and print its summary. Optional.')
+    parser.add_argument('-v', '--version', action='version',
+                        version=f'{os.path.basename(__file__)}: version {__version__}')
+
+    arguments = parser.parse_args()
+    if arguments.command == 'serve':
+        serve(arguments)
+    else:
+        try:
+            submit(arguments)
+        except Exception as e:
+            sys.exit(str(e))
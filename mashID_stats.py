@@ -0,0 +1,193 @@
+import os
+import gzip
+import mmap
+import shutil
+import subprocess
+import multiprocessing
+from concurrent import futures
+from contextlib import contextmanager
+import numpy as np
+from mashID_metrics import RunMetrics
+
+
+class SeqStats(object):
+    """
+    Native read/contig and base counter for fastq and fasta files, gzipped or not.
+    Files are processed as raw bytes in large chunks and lines are counted and measured with numpy, so no
+    per-line Python work is done. Gzipped files are decompressed with the fastest available decompressor
+    (python-isal, pigz or gzip) and large uncompressed files are split into memory-mapped chunks that are
+    counted in separate processes.
+    """
+    chunk_size = 64 * 1024 * 1024  # 64 MB
+    min_split_size = 256 * 1024 * 1024  # Smaller uncompressed files are counted in a single process
+    fastq_extensions = ('.fq', '.fastq')
+
+    @staticmethod
+    def is_fastq(seq_file):
+        if seq_file.endswith('.gz'):
+            seq_file = seq_file[:-3]
+        return seq_file.endswith(SeqStats.fastq_extensions)
+
+    @staticmethod
+    @contextmanager
+    def open_decompressed(seq_file, cpu=1):
+        # python-isal (multithreaded igzip) > pigz > gzip module
+        try:
+            from isal import igzip_threaded
+            with igzip_threaded.open(seq_file, 'rb', threads=max(1, cpu)) as f:
+                yield f
+            return
+        except ImportError:
+            pass
+
+        pigz = shutil.which('pigz')
+        if pigz:
+            p = subprocess.Popen([pigz, '-dc', '-p', str(max(1, cpu)), seq_file],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            RunMetrics.track_process(p.pid)
+            try:
+                yield p.stdout
+            finally:
+                p.stdout.close()
+                RunMetrics.wait_process(p)
+            if p.returncode != 0:
+                raise Exception('pigz failed to decompress {}'.format(seq_file))
+            return
+
+        with gzip.open(seq_file, 'rb') as f:
+            yield f
+
+    @staticmethod
+    def empty_counts():
+        # Number of lines, total length of lines by line index modulo 4, number of fasta headers, fasta bp
+        return 0, (0, 0, 0, 0), 0, 0
+
+    @staticmethod
+    def scan_block(buf, fastq):
+        """
+        Count lines in a line-aligned block of bytes. Only the final line of a file may lack a newline.
+        """
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        if arr.size == 0:
+            return SeqStats.empty_counts()
+
+        ends = np.flatnonzero(arr == 10)  # '\n'
+        if arr[-1] != 10:
+            ends = np.append(ends, arr.size)  # Last line of file without newline
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        lengths = ends - starts
+        # Do not count carriage returns from Windows line endings
+        lengths -= (lengths > 0) & (arr[np.maximum(ends - 1, 0)] == 13)
+
+        if fastq:
+            return ends.size, tuple(int(lengths[i::4].sum()) for i in range(4)), 0, 0
+        else:
+            is_header = (lengths > 0) & (arr[np.minimum(starts, arr.size - 1)] == 62)  # '>'
+            return ends.size, (0, 0, 0, 0), int(is_header.sum()), int(lengths[~is_header].sum())
+
+    @staticmethod
+    def merge_counts(total, part):
+        lines, phase, headers, bp = total
+        p_lines, p_phase, p_headers, p_bp = part
+        # The block's first line is line number "lines" of the file
+        shift = lines % 4
+        phase = tuple(phase[i] + p_phase[(i - shift) % 4] for i in range(4))
+        return lines + p_lines, phase, headers + p_headers, bp + p_bp
+
+    @staticmethod
+    def finalize(counts, fastq):
+        lines, phase, headers, bp = counts
+        if fastq:
+            return (lines + 2) // 4, phase[1]  # Sequence is the second line of each record
+        else:
+            return headers, bp
+
+    @staticmethod
+    def count_stream(handle, fastq):
+        counts = SeqStats.empty_counts()
+        tail = b''
+        while True:
+            chunk = handle.read(SeqStats.chunk_size)
+            if not chunk:
+                break
+            cut = chunk.rfind(b'\n')
+            if cut == -1:  # No complete line in this chunk
+                tail += chunk
+                continue
+            block = tail + chunk[:cut + 1] if tail else chunk[:cut + 1]
+            tail = chunk[cut + 1:]
+            counts = SeqStats.merge_counts(counts, SeqStats.scan_block(block, fastq))
+        if tail:
+            counts = SeqStats.merge_counts(counts, SeqStats.scan_block(tail, fastq))
+        return counts
+
+    @staticmethod
+    def aligned_bounds(mm, start, end, size):
+        # Split [start, end) in line-aligned blocks of about "size" bytes
+        while start < end:
+            stop = mm.find(b'\n', min(start + size, end) - 1)
+            stop = end if stop == -1 or stop + 1 > end else stop + 1
+            yield start, stop
+            start = stop
+
+    @staticmethod
+    def scan_mapped(mm, start, stop, fastq):
+        arr = np.frombuffer(mm, dtype=np.uint8, count=stop - start, offset=start)
+        try:
+            return SeqStats.scan_block(arr, fastq)
+        finally:
+            del arr  # Release the buffer before the mmap is closed
+
+    @staticmethod
+    def count_range(seq_file, start, end, fastq):
+        counts = SeqStats.empty_counts()
+        with open(seq_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for block_start, block_stop in SeqStats.aligned_bounds(mm, start, end, SeqStats.chunk_size):
+                    counts = SeqStats.merge_counts(counts,
+                                                   SeqStats.scan_mapped(mm, block_start, block_stop, fastq))
+        return counts
+
+    @staticmethod
+    def count_part(seq_file, start, end, fastq):
+        # Also return the worker's pid, so the parent can add the worker to the metrics of the stage
+        return os.getpid(), SeqStats.count_range(seq_file, start, end, fastq)
+
+    @staticmethod
+    def count_split(seq_file, fastq, cpu):
+        size = os.path.getsize(seq_file)
+        with open(seq_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                ranges = list(SeqStats.aligned_bounds(mm, 0, size, -(-size // cpu)))
+
+        counts = SeqStats.empty_counts()
+        # "spawn" because this is usually called from a worker thread
+        with futures.ProcessPoolExecutor(max_workers=len(ranges),
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+            starts, ends = zip(*ranges)
+            for pid, part in executor.map(SeqStats.count_part, [seq_file] * len(ranges), starts, ends,
+                                          [fastq] * len(ranges)):
+                RunMetrics.track_process(pid)  # Still alive until the pool shuts down
+                counts = SeqStats.merge_counts(counts, part)  # Results come back in file order
+        return counts
+
+    @staticmethod
+    def count(seq_file, cpu=1):
+        """
+        Return the number of reads (fastq) or contigs (fasta) and the total number of bp in a sequence file.
+        """
+        fastq = SeqStats.is_fastq(seq_file)
+
+        if seq_file.endswith('.gz'):
+            with SeqStats.open_decompressed(seq_file, cpu) as f:
+                counts = SeqStats.count_stream(f, fastq)
+        elif os.path.getsize(seq_file) == 0:
+            counts = SeqStats.empty_counts()
+        elif cpu > 1 and os.path.getsize(seq_file) >= SeqStats.min_split_size:
+            counts = SeqStats.count_split(seq_file, fastq, cpu)
+        else:
+            counts = SeqStats.count_range(seq_file, 0, os.path.getsize(seq_file), fastq)
+
+        return SeqStats.finalize(counts, fastq)
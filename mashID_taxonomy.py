@@ -0,0 +1,108 @@
+import os
+import threading
+import pandas as pd
+
+
+class Taxonomy(object):
+    """
+    Accession and taxonomy of each reference of a database, keyed on its sketch ID (the fasta path given to
+    mash sketch). make_mashID_db.py writes it next to the database as "<name>.tax.tsv", from the first fasta
+    header of each genome, so hits are annotated with a join instead of parsing their comment at report time.
+    """
+    columns = ['ID', 'Accession', 'Genus', 'Species', 'Subspecies', 'Name', 'Taxid']
+    tables = dict()  # Table file: (mtime, table), loaded once per process
+    lock = threading.Lock()
+
+    @staticmethod
+    def accession(sketch_id):
+        # File name without its last extension
+        return '.'.join(os.path.basename(sketch_id).split('.')[:-1])
+
+    @staticmethod
+    def accessions(sketch_ids):
+        # Same as accession() on a pandas Series of sketch IDs
+        return sketch_ids.astype(str).str.extract(r'([^/]*)\.[^./]*$', expand=False).fillna('')
+
+    @staticmethod
+    def parse_header(header):
+        """
+        Genus, species and subspecies (or variant) from a fasta header or a mash comment, e.g.
+        "[3 seqs] NZ_CP000001.1 Mycobacterium tuberculosis variant bovis AF2122/97 chromosome".
+        """
+        fields = header.split()
+        if fields and fields[0].startswith('['):  # "[N seqs]" added by mash to files with several sequences
+            fields = fields[2:]
+        fields = [x.strip('[],') for x in fields[1:]]  # Skip the accession, "[Genus]" means misclassified
+        genus = fields[0] if len(fields) > 0 else ''
+        species = fields[1] if len(fields) > 1 else ''
+        subspecies = ''
+        for keyword, label in (('variant', 'variant'), ('subsp.', 'subsp.'), ('subsp', 'subsp.'),
+                               ('subspecies', 'subsp.')):
+            if keyword in fields[2:-1]:
+                subspecies = '{} {}'.format(label, fields[fields.index(keyword, 2) + 1])
+                break
+        name = ' '.join(x for x in (genus, species, subspecies) if x) or 'unknown'
+        return {'Genus': genus, 'Species': species, 'Subspecies': subspecies, 'Name': name}
+
+    @staticmethod
+    def table_path(mash_db):
+        for suffix in ('_shards.json', '.msh'):
+            if mash_db.endswith(suffix):
+                return mash_db[:-len(suffix)] + '.tax.tsv'
+        return mash_db + '.tax.tsv'
+
+    @staticmethod
+    def write(table_file, rows):
+        df = pd.DataFrame(rows, columns=Taxonomy.columns)
+        df.sort_values(by=['ID'], inplace=True)
+        df.to_csv(table_file + '.tmp', sep='\t', index=False)
+        os.replace(table_file + '.tmp', table_file)
+        return df
+
+    @staticmethod
+    def load(mash_db):
+        """
+        Taxonomy table of a database (indexed on the sketch ID), or None if it has none.
+        """
+        table_file = Taxonomy.table_path(mash_db)
+        try:
+            mtime = os.stat(table_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with Taxonomy.lock:
+            loaded = Taxonomy.tables.get(table_file)
+            if loaded is None or loaded[0] != mtime:
+                table = pd.read_csv(table_file, sep='\t', dtype=str, keep_default_na=False, index_col='ID')
+                loaded = Taxonomy.tables[table_file] = (mtime, table)
+        return loaded[1]
+
+    @staticmethod
+    def annotate(df, table):
+        """
+        Add the taxonomy columns to the hits and replace their Query-ID by the accession.
+        """
+        df = df.join(table, on='Query-ID')
+        missing = df['Accession'].isna()  # Reference not in the table (e.g. database changed since)
+        df.loc[missing, 'Accession'] = Taxonomy.accessions(df.loc[missing, 'Query-ID'])
+        df['Query-ID'] = df.pop('Accession')
+        return df
+
+    @staticmethod
+    def species_hits(df):
+        """
+        One line per species from annotated hits (ranked best first): number of references hit, best identity,
+        shared hashes and accession of the best hit, highest multiplicity and lowest p-value.
+        """
+        species_df = df[df['Genus'].fillna('') != ''].copy()  # Hits with a genus in the table
+        species_df['Name'] = species_df['Genus'] + ' ' + species_df['Species']
+        species_df = species_df.groupby('Name', sort=False).agg(**{
+            'References': ('Query-ID', 'size'),
+            'Identity': ('Identity', 'max'),
+            'Shared-Hashes': ('Shared-Hashes', 'first'),
+            'Median-Multiplicity': ('Median-Multiplicity', 'max'),
+            'P-Value': ('P-Value', 'min'),
+            'Best-Hit': ('Query-ID', 'first')})
+        species_df.reset_index(inplace=True)
+        species_df.index = species_df.index + 1
+        species_df.index.name = 'Rank'
+        return species_df
@@ -0,0 +1,256 @@
+import os
+import time
+from itertools import chain
+from concurrent import futures
+from mashID_methods import Methods
+from mashID_metrics import RunMetrics
+from mashID_reads import ReadStream
+from mashID_scheduler import ResourcePool, JobPlanner
+
+
+class RunWatcher(object):
+    """
+    Identify the samples of a sequencing run while it is going (e.g. MinKNOW writing fastq chunks in a folder).
+    The input folder is polled for new files, which are grouped by sample like Methods.get_files does. Only the
+    new chunks are screened and their hits are merged with the previous ones of the same sample. The per-sample
+    and "topID.tsv" outputs are rewritten after each round, and a sample is resolved once its top hit is stable
+    (or once "max_bp" were screened). The new chunks of resolved samples are only counted, not screened.
+    """
+    end_of_run = 'final_summary'  # MinKNOW writes "final_summary_*.txt" when the run is over
+
+    def __init__(self, input_folder, output_folder, mash_db, identity, p_value, cpu, parallel, n_hit, sortby,
+                 interval=30, settle=10, stable_rounds=2, idle=None, mem=None, cache=None, max_bp=None):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.mash_db = mash_db
+        self.identity = identity
+        self.p_value = p_value
+        self.cpu = cpu
+        self.parallel = parallel
+        self.n_hit = n_hit
+        self.sortby = sortby
+        self.interval = interval  # Seconds between two scans of the input folder
+        self.settle = settle  # Seconds without change before a file is considered complete
+        self.stable_rounds = stable_rounds  # Rounds with the same top hit to resolve a sample
+        self.idle = idle  # Stop after that many seconds without new files
+        self.cache = cache
+        self.max_bp = max_bp  # Maximum bp screened per sample, the following chunks are subsampled then skipped
+        self.pool = ResourcePool(cpu, mem)
+
+        self.files = dict()  # Path: (size, mtime, time the file was first seen with that size and mtime)
+        self.done = set()  # Files already screened
+        self.samples = dict()  # Sample: merged results
+
+        if not os.path.isdir(self.input_folder):
+            raise Exception('Watch mode needs an input folder.')
+
+    @staticmethod
+    def scan(folder):
+        # Sequence files in folder, recursively
+        for entry in os.scandir(folder):
+            if entry.is_dir():
+                yield from RunWatcher.scan(entry.path)
+            elif entry.name.endswith(tuple(Methods.accepted_extensions)):
+                yield entry
+
+    @staticmethod
+    def run_ended(folder):
+        return any(x.name.startswith(RunWatcher.end_of_run) for x in os.scandir(folder))
+
+    def new_chunks(self):
+        """
+        Group by sample the files that were not screened yet and did not change for "settle" seconds.
+        """
+        now = time.time()
+        chunks = dict()
+        present = set()
+        for entry in RunWatcher.scan(self.input_folder):
+            file_path = os.path.realpath(entry.path)  # follow symbolic links
+            present.add(file_path)
+            if file_path in self.done:
+                continue
+            stat = entry.stat()
+            state = self.files.get(file_path)
+            if state is None or state[:2] != (stat.st_size, stat.st_mtime_ns):
+                self.files[file_path] = (stat.st_size, stat.st_mtime_ns, now)  # New or still being written
+                continue
+            if now - state[2] >= self.settle:
+                chunks.setdefault(Methods.sample_name(entry.name), list()).append(file_path)
+        for file_path in self.files.keys() - present - self.done:
+            del self.files[file_path]  # Removed before it was screened
+        return chunks
+
+    def new_sample(self):
+        return {'path': list(),
+                'reads': list(),
+                'bp': list(),
+                'hits': dict(),  # Query-ID: hit, merged over all the chunks
+                'previous': None,  # Top hits of the previous round
+                'stable': 0,  # Number of rounds in a row with the same top hit
+                'resolved': False,
+                'screened_reads': 0,
+                'screened_bp': 0}
+
+    @staticmethod
+    def merge_hits(hits, lines):
+        """
+        Merge the mash screen output of a new chunk with the hits of the previous ones, per reference: highest
+        identity and shared hashes, summed median multiplicity (depth adds up across chunks) and lowest p-value.
+        """
+        for line in lines:
+            if not line.strip() or line.startswith('#'):
+                continue
+            ident, shared, mult, p_value, query_id, comment = line.rstrip('\n').split('\t', 5)
+            hit = hits.get(query_id)
+            if hit is None:
+                hits[query_id] = [ident, shared, mult, p_value, query_id, comment]
+                continue
+            if float(ident) > float(hit[0]):
+                hit[0] = ident
+            if int(shared.split('/')[0]) > int(hit[1].split('/')[0]):
+                hit[1] = shared
+            hit[2] = str(int(hit[2]) + int(mult))
+            if float(p_value) < float(hit[3]):
+                hit[3] = p_value
+
+    def budget(self, sample):
+        # bp that can still be screened for a sample, None if there is no limit
+        info_dict = self.samples.get(sample)
+        if info_dict is None:
+            return self.max_bp
+        if info_dict['resolved']:
+            return 0
+        if self.max_bp is None:
+            return None
+        return max(0, self.max_bp - info_dict['screened_bp'])
+
+    def screen_lines(self, paths, cpu, fraction, screened):
+        """
+        Mash screen output of new chunks, from the cache if they were already screened. With "fraction", the reads
+        are subsampled on their way to mash and the number of reads and bp screened is stored in "screened".
+        """
+        key = None
+        if self.cache:
+            key = Methods.screen_cache_key(self.cache, self.mash_db, paths, self.identity, self.p_value, self.n_hit,
+                                           self.sortby, fraction=fraction)
+            cached = self.cache.open_entry(key)
+            if cached:
+                with cached:
+                    return list(Methods.read_screened(cached, screened))
+
+        returncodes = list()
+        records = None
+        if fraction:
+            records = lambda: ReadStream.head(paths, None, screened, fraction=fraction)
+        lines = Methods.stream_mash_screen(self.mash_db, paths, self.identity, self.p_value, cpu, self.n_hit,
+                                           self.sortby, returncodes, records)
+        if fraction:
+            lines = chain(lines, Methods.screened_marker(screened))
+        lines = list(lines)
+        if any(returncodes):
+            raise Exception('mash screen failed on {}'.format(', '.join(paths)))
+        if key:
+            self.cache.put(key, ''.join(lines))
+        return lines
+
+    def screen_chunks(self, sample, paths, plan, budget):
+        with self.pool.reserve(plan['stats_cpu'], plan['stats_mem']) as n_cpu:
+            with RunMetrics.stage(sample, 'stats', input_bytes=Methods.file_bytes(paths), threads=n_cpu):
+                _, reads, bp = Methods.get_stats(paths, sample, n_cpu, self.cache)
+        if budget == 0:  # Resolved, only the stats are needed
+            return sample, paths, reads, bp, None, None
+
+        fraction = budget / sum(bp) if budget is not None and sum(bp) > budget else None
+        screened = dict()
+        with self.pool.reserve(plan['screen_cpu'], plan['screen_mem']) as n_cpu:
+            with RunMetrics.stage(sample, 'screen', input_bytes=Methods.file_bytes(paths), threads=n_cpu):
+                lines = self.screen_lines(paths, n_cpu, fraction, screened)
+        if not fraction:
+            screened = {'reads': sum(reads), 'bp': sum(bp)}
+        return sample, paths, reads, bp, lines, screened
+
+    def update(self, sample, paths, reads, bp, lines, screened):
+        info_dict = self.samples.setdefault(sample, self.new_sample())
+        info_dict['path'].extend(paths)
+        info_dict['reads'].extend(reads)
+        info_dict['bp'].extend(bp)
+        self.done.update(paths)
+        if lines is None:
+            return
+
+        info_dict['screened_reads'] += screened['reads']
+        info_dict['screened_bp'] += screened['bp']
+        RunWatcher.merge_hits(info_dict['hits'], lines)
+        hits = Methods.top_hits(['\t'.join(x) for x in info_dict['hits'].values()], max(2, self.n_hit),
+                                self.sortby)
+        if Methods.converged(info_dict['previous'], hits):
+            info_dict['stable'] += 1
+        else:
+            info_dict['stable'] = 0
+        info_dict['previous'] = hits
+        max_bp_reached = self.max_bp is not None and info_dict['screened_bp'] >= self.max_bp
+        if info_dict['stable'] + 1 >= self.stable_rounds or max_bp_reached:
+            info_dict['resolved'] = True
+            # Same name as in the summary (taxonomy table of the database if it has one)
+            top_hit = Methods.summary_row(sample, info_dict, Methods.hits_df(hits[:1], self.mash_db))
+            print('\t{} resolved: {}'.format(sample, top_hit['Query-Comment']))
+
+    def write_outputs(self, tables=None):
+        rows = list()
+        for sample, info_dict in self.samples.items():
+            hits = Methods.top_hits(['\t'.join(x) for x in info_dict['hits'].values()], self.n_hit, self.sortby)
+            df = Methods.hits_df(hits, self.mash_db)
+            output_tsv = os.path.join(self.output_folder, sample + '_mashID.tsv')
+            df.to_csv(output_tsv + '.tmp', sep='\t')
+            os.replace(output_tsv + '.tmp', output_tsv)
+            if tables is not None:
+                tables[sample] = df
+            rows.append(Methods.summary_row(sample, info_dict, df))
+
+        samples_df = Methods.summary_df(rows, self.max_bp is not None)
+        samples_df['Status'] = [('resolved' if self.samples[x]['resolved'] else 'running')
+                                for x in samples_df['Sample']]
+        output_tsv = os.path.join(self.output_folder, 'topID.tsv')
+        samples_df.to_csv(output_tsv + '.tmp', sep='\t', index=False)
+        os.replace(output_tsv + '.tmp', output_tsv)
+        return samples_df
+
+    def run(self, tables=None):
+        """
+        Watch the input folder until the run is over (and all its files are screened), the watch is idle for too
+        long or it is interrupted. Return the last summary. If "tables" is a dict, it holds the last hits of each
+        sample (Sample: DataFrame).
+        """
+        print('Watching {} for new sequence files...'.format(self.input_folder))
+        samples_df = None
+        last_new = time.time()
+        try:
+            while True:
+                ended = RunWatcher.run_ended(self.input_folder)
+                chunks = self.new_chunks()
+                if chunks:
+                    last_new = time.time()
+                    print('Screening {} new file(s) from {} sample(s)...'.format(
+                        sum(len(x) for x in chunks.values()), len(chunks)))
+                    plan = JobPlanner.plan({x: {'path': y} for x, y in chunks.items()},
+                                           Methods.get_db_size(self.mash_db), self.cpu, self.parallel)
+                    n_workers = min(len(plan), max(self.parallel, self.cpu))  # The pool decides what runs
+                    with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+                        jobs = [executor.submit(self.screen_chunks, sample, chunks[sample], plan[sample],
+                                                self.budget(sample))
+                                for sample in plan]
+                        for job in futures.as_completed(jobs):
+                            self.update(*job.result())
+                    samples_df = self.write_outputs(tables)
+                elif ended and len(self.done) == len(self.files):
+                    print('Sequencing run is over.')
+                    break
+                elif self.idle and time.time() - last_new > self.idle:
+                    print('No new file for {} seconds, stopping.'.format(self.idle))
+                    break
+                if not chunks:
+                    time.sleep(min(self.interval, self.settle) if self.files.keys() - self.done else self.interval)
+        except KeyboardInterrupt:
+            print('Watch interrupted.')
+
+        return samples_df
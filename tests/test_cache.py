@@ -0,0 +1,15 @@
+import os
+from mashID_cache import ResultCache
+
+
+def test_key_changes_when_file_rewritten(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), 1)
+    seq_file = tmp_path / 'sample.fasta'
+    seq_file.write_text('>r1\nACGT\n')
+    key = cache.stats_key(str(seq_file))
+    assert cache.stats_key(str(seq_file)) == key
+
+    seq_file.write_text('>r1\nACGTACGT\n')
+    stat = seq_file.stat()
+    os.utime(str(seq_file), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert cache.stats_key(str(seq_file)) != key
@@ -0,0 +1,55 @@
+import os
+import pandas as pd
+import pytest
+from mashID_dataset import HitDataset
+from mashID_distributed import DistributedRun
+from mashID_methods import Methods
+
+HITS = [['0.98', '990/1000', '12', '0', 'ref1.fna', 'NZ_CP1 Mycobacterium tuberculosis H37Rv'],
+        ['0.95', '900/1000', '3', '1e-200', 'ref2.fna', 'NZ_CP2 Mycobacterium bovis']]
+
+
+def test_run_written_from_hit_tables(tmp_path):
+    pytest.importorskip('pyarrow')
+    output_folder = tmp_path / 'out'
+    output_folder.mkdir()
+    tables = {'sample1': Methods.hits_df(HITS), 'sample2': Methods.hits_df([])}
+    samples_df = pd.DataFrame({'Sample': ['sample1', 'sample2'], 'Reads': [10, 20], 'Length': [1000, 2000]})
+    mash_db = tmp_path / 'db.msh'
+    mash_db.write_bytes(b'')
+
+    # Tables only, "_mashID.tsv" files are not read
+    params = {'version': 'test', 'min_identity': 0.5, 'max_p_value': 1, 'n_hits': 10, 'sort_by': 'identity',
+              'early_stop': None, 'max_bp': None, 'backend': 'native'}
+    run_file = HitDataset.write_run(str(tmp_path / 'dataset'), str(output_folder), samples_df, tables, str(mash_db),
+                                    params)
+    df = pd.read_parquet(run_file)
+    assert list(df['sample']) == ['sample1', 'sample1', 'sample2']
+    assert list(df['rank'][:2]) == [1, 2]
+    assert list(df['shared_hashes'][:2]) == [990, 900]
+    assert list(df['sketch_hashes'][:2]) == [1000, 1000]
+    assert list(df['name'][:2]) == ['Mycobacterium tuberculosis', 'Mycobacterium bovis']
+    assert df['accession'][0] == 'ref1'
+    assert df['rank'].isna()[2]
+
+
+def test_distributed_result_keeps_hits(tmp_path):
+    run = DistributedRun(str(tmp_path / 'in'), str(tmp_path / 'out'), 'db.msh', 0.5, 1, 1, 1, 1, 10, 'identity')
+    df = Methods.hits_df(HITS)
+    # Annotated, second reference not in the taxonomy table
+    for column, value in [('Genus', 'Mycobacterium'), ('Species', 'tuberculosis'), ('Subspecies', ''),
+                          ('Name', 'Mycobacterium tuberculosis'), ('Taxid', '1773')]:
+        df[column] = [value, None]
+    run.save_result('sample1', {'Sample': 'sample1', 'Reads': 10, 'Length': 1000}, df)
+    run.save_result('sample2', {'Sample': 'sample2', 'Reads': 20, 'Length': 2000}, Methods.hits_df([]))
+    assert sorted(os.listdir(run.results)) == ['sample1.json', 'sample2.json']
+
+    tables = dict()
+    samples_df = run.summary(['sample2', 'sample1'], tables)
+    assert list(samples_df['Sample']) == ['sample1', 'sample2']
+    pd.testing.assert_frame_equal(tables['sample1'], df, check_dtype=False)
+    assert tables['sample2'].empty
+    hits = HitDataset.sample_hits(tables['sample1'])
+    assert list(hits['p_value']) == [0, 1e-200]
+    assert list(hits['taxid']) == ['1773', None]
+    assert list(hits['subspecies']) == [None, None]
@@ -0,0 +1,63 @@
+import os
+import re
+import sys
+import time
+import random
+import subprocess
+import numpy as np
+import pandas as pd
+from mashID_benchmark import Benchmark
+from mashID_distributed import DistributedRun
+from mashID_msh import KmerHasher
+
+K = 21
+META = {'kmer_size': K, 'preserve_case': False, 'alphabet': 'ACGT', 'noncanonical': False, 'hash_seed': 42,
+        'use64': True}
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER = """
+import sys
+from mashID_methods import Methods
+from mashID_distributed import DistributedRun
+Methods.backend = 'native'
+DistributedRun(sys.argv[1], sys.argv[2], sys.argv[3], 0.5, 1, 1, 1, 2, 10, 'identity', lease_time=8).run()
+"""
+
+
+def test_workers_share_samples(tmp_path):
+    rng = random.Random(1)
+    reads = [''.join(rng.choice('ACGT') for _ in range(300)) for _ in range(2)]
+    references = [('{}.fna'.format(i), 'NZ_{} Mycobacterium species{}'.format(i, i), 5000000,
+                   np.unique(KmerHasher.kmer_hashes([x.encode()], META))[:20]) for i, x in enumerate(reads)]
+    mash_db = str(tmp_path / 'db.msh')
+    Benchmark.write_msh(mash_db, K, references)
+
+    input_folder = tmp_path / 'reads'
+    input_folder.mkdir()
+    samples = ['sample{}'.format(i) for i in range(6)]
+    for i, sample in enumerate(samples):
+        (input_folder / (sample + '.fasta')).write_text('>r1\n{}\n'.format(reads[i % 2]))
+
+    # Lease of a worker that crashed an hour ago
+    output_folder = tmp_path / 'out'
+    lease_folder = output_folder / DistributedRun.work_folder / 'leases'
+    lease_folder.mkdir(parents=True)
+    lease = lease_folder / 'sample3.lease'
+    lease.write_text('crashed-1\n')
+    os.utime(str(lease), (time.time() - 3600, time.time() - 3600))
+
+    env = dict(os.environ, PYTHONPATH=REPO)
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, str(input_folder), str(output_folder), mash_db],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+               for _ in range(3)]
+    outputs = [x.communicate(timeout=120)[0] for x in workers]
+    assert all(x.returncode == 0 for x in workers), outputs
+
+    # Threads of a worker print at the same time, so lines may be interleaved
+    screened = [x for output in outputs for x in re.findall(r'Worker \S+ screening (sample\d+)', output)]
+    assert sorted(screened) == samples  # Each sample exactly once
+    assert sum(output.count('Taking over expired lease of sample3') for output in outputs) == 1
+
+    summary = pd.read_csv(str(output_folder / 'topID.tsv'), sep='\t')
+    assert sorted(summary['Sample']) == samples
+    assert list(summary['Identification']) == ['Mycobacterium species0', 'Mycobacterium species1'] * 3
+    assert not list(lease_folder.glob('*.lease'))
@@ -0,0 +1,29 @@
+import sys
+import json
+import subprocess
+from mashID_metrics import RunMetrics
+
+BUSY = 'import time\nend = time.process_time() + 0.3\nwhile time.process_time() < end:\n    pass\n'
+
+
+def test_final_cpu_time_of_short_child(tmp_path):
+    metrics = RunMetrics.start(str(tmp_path / 'metrics.jsonl'), 1, 1)
+    try:
+        with RunMetrics.stage('sample', 'screen') as record:
+            p = subprocess.Popen([sys.executable, '-c', BUSY])
+            RunMetrics.track_process(p.pid)
+            assert RunMetrics.wait_process(p) == 0
+            assert p.returncode == 0
+            assert p.pid not in metrics.processes
+    finally:
+        metrics.close()
+
+    # All the CPU time of the child, not only what was sampled while it ran
+    assert record['child_cpu'] >= 0.3
+    with open(str(tmp_path / 'metrics.jsonl')) as f:
+        assert json.loads(f.readline())['child_cpu'] >= 0.3
+
+
+def test_wait_without_metrics():
+    p = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    assert RunMetrics.wait_process(p) == 3
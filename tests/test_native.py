@@ -0,0 +1,160 @@
+import math
+import random
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from mashID_benchmark import Benchmark
+from mashID_msh import KmerHasher, MshReader, NativeScreen
+
+K = 21
+META = {'kmer_size': K, 'preserve_case': False, 'alphabet': 'ACGT', 'noncanonical': False, 'hash_seed': 42,
+        'use64': True}
+
+
+def murmur3(key, seed):
+    h1, h2 = KmerHasher.murmur3(np.frombuffer(key, dtype=np.uint8).reshape(1, len(key)), seed)
+    return int(h1[0]), int(h2[0])
+
+
+def test_murmur3_empty_key():
+    assert murmur3(b'', 0) == (0, 0)
+
+
+def test_murmur3_smhasher_verification():
+    # SMHasher's VerificationTest: hash keys 0, 01, 012... with seed 256 - length, then hash all the hashes
+    hashes = b''
+    for i in range(256):
+        h1, h2 = murmur3(bytes(range(i)), 256 - i)
+        hashes += h1.to_bytes(8, 'little') + h2.to_bytes(8, 'little')
+    h1, _ = murmur3(hashes, 0)
+    assert h1 & 0xffffffff == 0x6384ba69
+
+
+def test_kmer_hashes_canonical():
+    sequence = 'ACGTTGCATGCAAGGCTTACGATCGGATCCA'
+    reverse = sequence[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+    forward_hashes = np.sort(KmerHasher.kmer_hashes([sequence.encode()], META))
+    reverse_hashes = np.sort(KmerHasher.kmer_hashes([reverse.encode()], META))
+    assert len(forward_hashes) == len(sequence) - K + 1
+    assert np.array_equal(forward_hashes, reverse_hashes)
+
+
+@pytest.mark.parametrize('kmer_size', [21, 15])
+def test_msh_round_trip(tmp_path, kmer_size):
+    references = [('GCF_1.fna', '[1 seqs] NZ_1 Mycobacterium tuberculosis H37Rv', 4411532,
+                   np.array([3, 17, 2 ** 31 + 5], dtype=np.uint64)),
+                  ('GCF_2.fna', 'NZ_2 Mycobacterium bovis AF2122/97', 2 ** 33, np.array([8], dtype=np.uint64))]
+    msh_file = str(tmp_path / 'db.msh')
+    Benchmark.write_msh(msh_file, kmer_size, references)
+    with open(msh_file, 'rb') as f:
+        sketch = MshReader(f.read()).read()
+
+    assert sketch['kmer_size'] == kmer_size
+    assert sketch['hash_seed'] == 42
+    assert sketch['use64'] == (kmer_size > 16)
+    assert sketch['alphabet'] == 'ACGT'
+    assert not sketch['noncanonical'] and not sketch['preserve_case']
+    assert sketch['names'] == [x[0] for x in references]
+    assert sketch['comments'] == [x[1] for x in references]
+    assert sketch['lengths'] == [x[2] for x in references]
+    for hashes, reference in zip(sketch['hashes'], references):
+        assert hashes.tolist() == reference[3].tolist()
+
+
+def binomial_p_value(shared, total, length):
+    # P(X >= shared), X ~ Binomial(total, r) with r the chance of a random k-mer hit, as in mash
+    r = 1.0 / (1.0 + 4.0 ** K / length)
+    return min(1.0, sum(math.comb(total, j) * r ** j * (1 - r) ** (total - j) for j in range(shared, total + 1)))
+
+
+@pytest.fixture
+def screen_case(tmp_path):
+    """
+    Reads: read1 twice and read2 once. References:
+        A: 10 hashes of read1 and 10 absent hashes
+        B, C: the same 5 hashes of read2 (tied at identity 1), C is the longest
+        D: 2 of the hashes of A and 8 absent hashes, lower identity than A
+    """
+    rng = random.Random(1)
+    read1 = ''.join(rng.choice('ACGT') for _ in range(200)).encode()
+    read2 = ''.join(rng.choice('ACGT') for _ in range(200)).encode()
+    hashes1 = np.unique(KmerHasher.kmer_hashes([read1], META))
+    hashes2 = np.unique(KmerHasher.kmer_hashes([read2], META))
+    assert not np.intersect1d(hashes1, hashes2).size
+
+    seen = set(hashes1.tolist()) | set(hashes2.tolist())
+    absent = list()
+    while len(absent) < 18:
+        value = rng.getrandbits(64)
+        if value not in seen:
+            absent.append(value)
+            seen.add(value)
+
+    a_hashes = hashes1[:10].tolist() + absent[:10]
+    bc_hashes = hashes2[:5].tolist()
+    d_hashes = hashes1[:2].tolist() + absent[10:]
+    references = [('A.fna', 'NZ_A Mycobacterium avium', 5000000, np.sort(np.array(a_hashes, dtype=np.uint64))),
+                  ('B.fna', 'NZ_B Mycobacterium bovis', 1000000, np.array(bc_hashes, dtype=np.uint64)),
+                  ('C.fna', 'NZ_C Mycobacterium caprae', 4000000, np.array(bc_hashes, dtype=np.uint64)),
+                  ('D.fna', 'NZ_D Mycobacterium marinum', 6000000, np.sort(np.array(d_hashes, dtype=np.uint64)))]
+    msh_file = str(tmp_path / 'db.msh')
+    Benchmark.write_msh(msh_file, K, references)
+
+    reads_file = str(tmp_path / 'reads.fasta')
+    records = [b'>r1\n' + read1 + b'\n', b'>r1b\n' + read1 + b'\n', b'>r2\n' + read2 + b'\n']
+    with open(reads_file, 'wb') as f:
+        f.write(b''.join(records))
+    return msh_file, reads_file, [(x, len(x.split(b'\n')[1])) for x in records]
+
+
+def parse(lines):
+    # {name: (identity, shared, total, median multiplicity, p-value)}
+    hits = dict()
+    for line in lines:
+        ident, hashes, mult, p_value, name = line.rstrip('\n').split('\t')[:5]
+        shared, total = hashes.split('/')
+        hits[name] = (float(ident), int(shared), int(total), int(mult), float(p_value))
+    return hits
+
+
+def test_native_screen_winner_take_all(screen_case):
+    msh_file, _, records = screen_case
+    hits = parse(NativeScreen.screen(NativeScreen.get_db(msh_file), records, 0, 1))
+
+    # D only has hashes also in A, which has a higher identity, and B is tied with the longer C
+    assert sorted(hits) == ['A.fna', 'C.fna']
+    ident, shared, total, mult, p_value = hits['A.fna']
+    assert (shared, total, mult) == (10, 20, 2)
+    assert ident == pytest.approx(0.5 ** (1 / K), abs=1e-6)
+    assert p_value == pytest.approx(binomial_p_value(10, 20, 5000000), rel=1e-4)
+    ident, shared, total, mult, p_value = hits['C.fna']
+    assert (ident, shared, total, mult) == (1.0, 5, 5, 1)
+    assert p_value == pytest.approx(binomial_p_value(5, 5, 4000000), rel=1e-4)
+
+
+def test_native_screen_all_hits(screen_case):
+    msh_file, _, records = screen_case
+    hits = parse(NativeScreen.screen(NativeScreen.get_db(msh_file), records, 0, 1, winner_take_all=False))
+
+    assert sorted(hits) == ['A.fna', 'B.fna', 'C.fna', 'D.fna']
+    assert hits['B.fna'][:4] == (1.0, 5, 5, 1)
+    ident, shared, total, mult, p_value = hits['D.fna']
+    assert (shared, total, mult) == (2, 10, 2)
+    assert ident == pytest.approx(0.2 ** (1 / K), abs=1e-6)
+    assert p_value == pytest.approx(binomial_p_value(2, 10, 6000000), rel=1e-4)
+
+
+@pytest.mark.skipif(shutil.which('mash') is None, reason='mash is not installed')
+def test_native_screen_same_as_mash(screen_case):
+    msh_file, reads_file, records = screen_case
+    p = subprocess.run(['mash', 'screen', '-w', '-i', '0', '-v', '1', msh_file, reads_file],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True)
+    mash_hits = parse(p.stdout.splitlines())
+    native_hits = parse(NativeScreen.screen(NativeScreen.get_db(msh_file), records, 0, 1))
+
+    assert sorted(mash_hits) == sorted(native_hits)
+    for name, (ident, shared, total, mult, p_value) in mash_hits.items():
+        assert native_hits[name][1:4] == (shared, total, mult)
+        assert native_hits[name][0] == pytest.approx(ident, abs=1e-6)
+        assert native_hits[name][4] == pytest.approx(p_value, rel=1e-3, abs=1e-300)
@@ -0,0 +1,84 @@
+import os
+import gzip
+import json
+import random
+import numpy as np
+import pytest
+from make_mashID_db import MakeDB
+from mashID_benchmark import Benchmark
+from mashID_cache import ResultCache
+from mashID_methods import Methods
+from mashID_msh import KmerHasher
+
+K = 21
+META = {'kmer_size': K, 'preserve_case': False, 'alphabet': 'ACGT', 'noncanonical': False, 'hash_seed': 42,
+        'use64': True}
+
+
+@pytest.fixture
+def fake_mash(tmp_path, monkeypatch):
+    # Reads its standard input and reports no hit, like mash when the reads stop early
+    bin_folder = tmp_path / 'bin'
+    bin_folder.mkdir()
+    mash = bin_folder / 'mash'
+    mash.write_text('#!/bin/sh\ncat > /dev/null\n')
+    mash.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_folder, os.pathsep, os.environ['PATH']))
+    monkeypatch.setattr(Methods, 'backend', 'mash')
+
+
+def test_truncated_reads_fail_the_screen(tmp_path, fake_mash):
+    data = gzip.compress(b'@r\nACGTACGTAC\n+\nIIIIIIIIII\n' * 100000)
+    reads = tmp_path / 'sample.fastq.gz'
+    reads.write_bytes(data[:len(data) // 2])
+    mash_db = tmp_path / 'db.msh'
+    mash_db.write_bytes(b'')
+    cache = ResultCache(str(tmp_path / 'cache'), 1)
+
+    with pytest.raises(EOFError):
+        Methods.mash_screen('sample', str(mash_db), [str(reads)], str(tmp_path), 0.9, 0.05, 1, 10, 'identity',
+                            cache, fraction=0.5)
+    assert not list(cache.entries())  # Partial output is not cached
+
+
+def test_tiered_database_screens_selected_shards_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(Methods, 'backend', 'native')
+    rng = random.Random(1)
+    reads = [''.join(rng.choice('ACGT') for _ in range(300)) for _ in range(3)]
+    hashes = [np.unique(KmerHasher.kmer_hashes([x.encode()], META))[:20] for x in reads]
+    # One cluster per shard, tier 1 has the representative of each cluster
+    references = [('{}.fna'.format(x), 'NZ_{} Mycobacterium {}'.format(x, x), 5000000, y)
+                  for x, y in zip('ABC', hashes)]
+    for i, reference in enumerate(references):
+        Benchmark.write_msh(str(tmp_path / 'shard{}.msh'.format(i)), K, [reference])
+    Benchmark.write_msh(str(tmp_path / 'tier1.msh'), K, references)
+    manifest = {'kmer_size': K, 'sketch_size': 20, 'shards': ['shard0.msh', 'shard1.msh', 'shard2.msh'],
+                'tier1': 'tier1.msh', 'rank': 'species', 'representatives': {'A.fna': 'a', 'B.fna': 'b', 'C.fna': 'c'},
+                'clusters': {'a': 0, 'b': 1, 'c': 2}}
+    mash_db = tmp_path / 'db_shards.json'
+    mash_db.write_text(json.dumps(manifest))
+    sample = tmp_path / 'sample.fasta'
+    sample.write_text('>r1\n{}\n>r2\n{}\n'.format(reads[0], reads[1]))  # Reads of clusters a and b
+
+    screened = list()
+    stream_mash_screen_db = Methods.stream_mash_screen_db
+
+    def count_screens(db_file, *args):
+        screened.append(db_file)
+        return stream_mash_screen_db(db_file, *args)
+    monkeypatch.setattr(Methods, 'stream_mash_screen_db', count_screens)
+
+    returncodes = list()
+    lines = list(Methods.stream_mash_screen(str(mash_db), [str(sample)], 0.9, 0.05, 1, 2, 'identity', returncodes))
+    assert len(screened) == 2  # Tier 1, then the shards of clusters a and b together
+    assert screened[0] == str(tmp_path / 'tier1.msh')
+    assert sorted(x.split('\t')[4] for x in lines) == ['A.fna', 'B.fna']
+    assert returncodes == [0]
+
+
+def test_cluster_name_same_as_taxonomy():
+    assert MakeDB.cluster_name('>NZ_1.1 [Clostridium] difficile 630 chromosome', 'species') == 'Clostridium difficile'
+    assert MakeDB.cluster_name('>NZ_1.1 [Clostridium] difficile 630 chromosome', 'genus') == 'Clostridium'
+    assert MakeDB.cluster_name('[2 seqs] NZ_1.1 Mycobacterium avium subsp. hominissuis', 'species') == \
+        'Mycobacterium avium'
+    assert MakeDB.cluster_name('>NZ_1.1', 'species') == 'unknown'
@@ -0,0 +1,95 @@
+import random
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from http.server import ThreadingHTTPServer
+from mashID_benchmark import Benchmark
+from mashID_methods import Methods
+from mashID_msh import KmerHasher
+from mashID_server import IdentificationService, JobHandler, ServiceClient
+
+K = 21
+META = {'kmer_size': K, 'preserve_case': False, 'alphabet': 'ACGT', 'noncanonical': False, 'hash_seed': 42,
+        'use64': True}
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # Native backend, so no mash is needed
+    monkeypatch.setattr(Methods, 'backend', 'native')
+    rng = random.Random(1)
+    read = ''.join(rng.choice('ACGT') for _ in range(300))
+    hashes = np.unique(KmerHasher.kmer_hashes([read.encode()], META))[:20]
+    msh_file = str(tmp_path / 'db.msh')
+    Benchmark.write_msh(msh_file, K, [('A.fna', 'NZ_A Mycobacterium avium', 5000000, hashes)])
+
+    input_folder = tmp_path / 'reads'
+    input_folder.mkdir()
+    (input_folder / 'sample1.fasta').write_text('>r1\n{}\n>r2\n{}\n'.format(read, read))
+
+    service = IdentificationService(msh_file, 1, 1, 1, max_jobs=2)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), JobHandler)  # Ephemeral port
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield ServiceClient('http://127.0.0.1:{}'.format(server.server_address[1])), service, tmp_path
+    server.shutdown()
+    server.server_close()
+    service.executor.shutdown(wait=True)
+    service.warmer.close()
+
+
+def test_submit_and_wait(service):
+    client, _, tmp_path = service
+    job = client.submit(str(tmp_path / 'reads'), str(tmp_path / 'out'), identity=0.5, p_value=1)
+    assert job['status'] == 'queued'
+    job = client.wait(job['id'], interval=0.05)
+
+    assert job['status'] == 'done', job.get('error')
+    assert [x['Sample'] for x in job['summary']] == ['sample1']
+    hits = job['tables']['sample1']
+    assert len(hits) == 1 and hits[0]['Rank'] == 1
+    assert hits[0]['Shared-Hashes'] == '20/20' and hits[0]['Median-Multiplicity'] == 2
+    # Same table as the one written to disk
+    df = pd.read_csv(str(tmp_path / 'out' / 'sample1_mashID.tsv'), sep='\t')
+    assert list(hits[0]) == list(df.columns)
+    assert (tmp_path / 'out' / 'topID.tsv').exists()
+
+
+@pytest.mark.parametrize('params, error', [
+    ({'output': 'out', 'colour': 'blue'}, 'Unknown job parameter(s): colour'),
+    ({'output': None}, 'A job needs an "input" and an "output".'),
+    ({'output': 'out', 'identity': 2}, 'identity value must be between 0 and 1.'),
+    ({'output': 'out', 'p_value': 2}, 'P-value must be between 0 and 1.'),
+])
+def test_bad_jobs(service, params, error):
+    client, _, tmp_path = service
+    params = dict(params, input=str(tmp_path / 'reads'))
+    if params['output'] is None:
+        del params['output']
+    with pytest.raises(Exception) as e:
+        client.request('/jobs', params)
+    assert str(e.value) == error
+
+
+def test_missing_input_and_job(service):
+    client, _, tmp_path = service
+    with pytest.raises(Exception, match='does not exist'):
+        client.submit(str(tmp_path / 'missing'), str(tmp_path / 'out'))
+    with pytest.raises(Exception, match='No such job'):
+        client.status('99')
+
+
+def test_finished_jobs_evicted(service):
+    _, service, _ = service
+    service.max_finished = 1
+    now = time.time()
+    with service.lock:
+        service.jobs = {'1': {'id': '1', 'finished': now - 2},
+                        '2': {'id': '2', 'finished': now - 1},
+                        '3': {'id': '3'},  # Still running
+                        '4': {'id': '4', 'finished': now - 2 * service.job_ttl}}
+        service.evict()
+        assert sorted(service.jobs) == ['2', '3']